@@ -0,0 +1,79 @@
+"""
+ログイン日時(last_login / login_date)の書き込みをまとめて行うライトビハインドバッファ．
+ログイン時はメモリ上に最新の日時を記録するだけで，一定間隔または一定件数毎に1回のUPDATEで反映する．
+"""
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Case, DateTimeField, F, Value, When
+from django.utils import timezone
+
+from .flusher import PeriodicFlusher
+
+
+class LoginActivityBuffer(PeriodicFlusher):
+    """
+    ユーザー毎に最新の(last_login, login_date)だけを保持し，flush()でUPDATE ... CASEにまとめて書き込む．
+    保持件数がmax_entriesに達した場合は間隔を待たずに書き込む．
+    """
+
+    def __init__(self, flush_interval=30, max_entries=1000) -> None:
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        # user_id -> (last_login, login_date)．last_loginがNoneの場合は更新しない
+        self._pending: Dict[int, Tuple[Optional[datetime], datetime]] = {}
+        self._pending_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "LoginActivityBuffer":
+        conf = settings.LOGIN_ACTIVITY_BUFFER
+        return cls(flush_interval=conf["FLUSH_INTERVAL"], max_entries=conf["MAX_ENTRIES"])
+
+    def record(self, user_id: int, login: bool = True) -> None:
+        """
+        ログイン(login=True)またはトークンの更新(login=False, login_dateのみ)を記録する
+        """
+        now = timezone.now()
+        with self._pending_lock:
+            last_login = now if login else self._pending.get(user_id, (None, now))[0]
+            self._pending[user_id] = (last_login, now)
+            full = len(self._pending) >= self.max_entries
+        if self._thread is None:
+            self.start()
+        if full:
+            self.wakeup()
+
+    def flush(self) -> int:
+        from .models import Account
+
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        items = list(pending.items())
+        for start in range(0, len(items), self.max_entries):
+            batch = items[start : start + self.max_entries]
+            last_logins = [
+                When(id=user_id, then=Value(last_login)) for user_id, (last_login, _) in batch if last_login
+            ]
+            Account.objects.filter(id__in=[user_id for user_id, _ in batch]).update(
+                login_date=Case(
+                    *[When(id=user_id, then=Value(login_date)) for user_id, (_, login_date) in batch],
+                    output_field=DateTimeField(),
+                ),
+                last_login=Case(*last_logins, default=F("last_login"), output_field=DateTimeField()),
+            )
+        return len(items)
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        self._pending_lock = threading.Lock()
+
+
+login_activity = LoginActivityBuffer.from_settings()
+os.register_at_fork(after_in_child=login_activity._after_fork)
@@ -1,6 +1,55 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class AccountConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "account"
+
+    def ready(self):
+        from config.metrics import registry
+
+        registry.register_collector(collect_metrics)
+        # 接続の作成時にリクエスト毎の計測用のexecute_wrapperを追加するシグナルを登録する
+        from config import middleware  # noqa: F401
+
+        # ユーザーの保存時にバージョン・検索のキャッシュを更新するシグナルを登録する
+        # キャッシュの設定を確認するシステムチェックを登録する
+        from . import checks  # noqa: F401
+        from . import versions  # noqa: F401
+        from .search import ensure_sqlite_triggers
+
+        post_migrate.connect(ensure_sqlite_triggers, sender=self)
+
+
+def collect_metrics():
+    """
+    プロセス内のキャッシュ・プールの状態をPrometheusのメトリクスとして返す
+    """
+    from config.authenticate import token_cache
+
+    from .hashers import hashing_pool
+    from .images import variant_pool
+    from .presence import presence
+    from .ratelimit import rate_limiter
+    from .revocation import revocations
+    from .search import prefix_cache
+
+    stats = token_cache.stats()
+    for name in ("hits", "misses", "evictions"):
+        yield f"auth_token_cache_{name}_total", "counter", {}, stats[name]
+    yield "auth_token_cache_size", "gauge", {}, stats["size"]
+    yield "password_hashing_rejected_total", "counter", {}, hashing_pool.rejected
+    yield "image_variant_jobs_pending", "gauge", {}, variant_pool.pending()
+    yield "image_variant_jobs_dropped_total", "counter", {}, variant_pool.dropped
+    yield "image_variant_failed_images", "gauge", {}, variant_pool.failures()
+    yield "presence_heartbeats_total", "counter", {}, presence.heartbeats
+    yield "presence_online_users", "gauge", {}, presence.local_count()
+    yield "revoked_tokens", "gauge", {}, revocations.count()
+    for (scope, kind, result), count in sorted(rate_limiter.counts.items()):
+        yield "rate_limit_requests_total", "counter", {"scope": scope, "key": kind, "result": result}, count
+    yield "rate_limit_tracked_keys", "gauge", {}, rate_limiter.count()
+    yield "rate_limit_evictions_total", "counter", {}, rate_limiter.evictions
+    for name in ("hits", "misses", "evictions"):
+        yield f"account_search_cache_{name}_total", "counter", {}, getattr(prefix_cache, name)
+    yield "account_search_cache_prefixes", "gauge", {}, prefix_cache.count()
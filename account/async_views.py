@@ -0,0 +1,252 @@
+"""
+ASGI(uvicorn等)で動かすための非同期版ビュー．
+DBアクセスには非同期ORM(aget / afirst / acreate)を使うため，リクエスト毎にスレッドを占有しない．
+どのルートで使うかはsettings.ACCOUNT_ASYNC_ROUTESで選択する(account/urls.py参照)．
+"""
+from typing import List
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import IntegrityError
+from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response
+from django.utils.translation import gettext_lazy as _
+from django.views import View
+from rest_framework import exceptions, serializers, status
+from rest_framework_simplejwt import exceptions as jwt_exp
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from config.authenticate import ClaimsOnlyAuthentication, CustomAuthentication
+from config.dbrouter import read_replica
+from config.renderers import ORJSONParser
+
+from .activity import login_activity
+from .hashers import hashing_pool
+from .models import Account
+from .ratelimit import LoginRateThrottle, RegisterRateThrottle
+from .serializers import AccountReadSerializer, AccountRegisterSerializer, check_conflicts
+from .tokens import RevocableTokenRefreshSerializer, revoke_cookie_tokens, token_error
+from .versions import account_versions, add_version_headers
+
+
+class LoginSerializer(serializers.Serializer):
+    email = serializers.CharField()
+    password = serializers.CharField(trim_whitespace=False)
+
+
+def set_token_cookies(res, access, refresh=None):
+    res.set_cookie(
+        key="access_token",
+        value=access,
+        expires=settings.SIMPLE_JWT["ACCESS_TOKEN_LIFETIME"],
+        httponly=True,
+    )
+    if refresh is not None:
+        res.set_cookie(
+            key="refresh_token",
+            value=refresh,
+            expires=settings.SIMPLE_JWT["REFRESH_TOKEN_LIFETIME"],
+            httponly=True,
+        )
+    return res
+
+
+class AsyncAPIView(View):
+    """
+    非同期ビューの基底クラス．
+    DRFのAPIViewと同様にCSRFはCookie認証側で扱い，APIExceptionはJSONのエラーレスポンスに変換する．
+    """
+
+    authentication_classes: List[type] = []
+    throttle_classes: List[type] = []
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True  # type: ignore[attr-defined]
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user, request.auth = await self.authenticate(request)
+            self.check_throttles(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            return self.handle_exception(exc)
+
+    async def authenticate(self, request):
+        for authentication_class in self.authentication_classes:
+            result = await authentication_class().aauthenticate(request)
+            if result is not None:
+                return result
+        return AnonymousUser(), None
+
+    def check_throttles(self, request):
+        if self.throttle_classes:
+            # throttleはrequest.dataを参照する
+            self.get_data(request)
+        waits = []
+        for throttle_class in self.throttle_classes:
+            throttle = throttle_class()
+            if not throttle.allow_request(request, self):
+                waits.append(throttle.wait())
+        if waits:
+            raise exceptions.Throttled(max(waits))
+
+    def handle_exception(self, exc):
+        data = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+        res = JsonResponse(data, status=exc.status_code, safe=False)
+        if getattr(exc, "wait", None):
+            res["Retry-After"] = "%d" % exc.wait
+        return res
+
+    def get_data(self, request):
+        # throttleとビューで2回読まないようにrequest.dataに保持する(DRFのRequestと同じ属性名)
+        if not hasattr(request, "data"):
+            request.data = (
+                ORJSONParser().parse(request) if request.content_type == "application/json" else request.POST
+            )
+        return request.data
+
+
+class AsyncTokenObtainView(AsyncAPIView):
+    """
+    JWTをCookieにセットして送る(非同期版)
+    """
+
+    throttle_classes = [LoginRateThrottle]
+    query_budget = 1
+
+    async def post(self, request, *args, **kwargs):
+        serializer = LoginSerializer(data=self.get_data(request))
+        serializer.is_valid(raise_exception=True)
+
+        user = await Account.objects.filter(email=serializer.validated_data["email"]).afirst()
+        if user is None:
+            # ユーザーの有無がレスポンス時間から分からないようにハッシュ計算を行う
+            await hashing_pool.amake_password(serializer.validated_data["password"])
+        elif await user.acheck_password(serializer.validated_data["password"]) and user.is_active:
+            refresh = RefreshToken.for_user(user)
+            login_activity.record(user.id)
+            res = JsonResponse({"success": 1}, status=status.HTTP_200_OK)
+            set_token_cookies(res, str(refresh.access_token), str(refresh))
+            # csrftokenを設定
+            get_token(request)
+            return res
+        raise exceptions.AuthenticationFailed(
+            _("No active account found with the given credentials"), "no_active_account"
+        )
+
+
+class AsyncTokenRefreshView(AsyncAPIView):
+    """
+    リフレッシュトークンを使って新しいアクセストークンを作成する(非同期版)
+    """
+
+    query_budget = 0
+
+    async def post(self, request, *args, **kwargs):
+        serializer = RevocableTokenRefreshSerializer(data=self.get_data(request))
+        try:
+            serializer.is_valid(raise_exception=True)
+        except jwt_exp.TokenError as e:
+            raise jwt_exp.InvalidToken(e.args[0])
+
+        refresh = RefreshToken(serializer.initial_data["refresh"], verify=False)
+        login_activity.record(refresh[api_settings.USER_ID_CLAIM], login=False)
+
+        res = JsonResponse({}, status=status.HTTP_200_OK)
+        return set_token_cookies(res, serializer.validated_data["access"], serializer.validated_data.get("refresh"))
+
+
+class AsyncTokenDeleteView(AsyncAPIView):
+    """
+    Cookieに保存しているTokenを失効させて削除する(非同期版)
+    """
+
+    query_budget = 0
+
+    async def get(self, request, *args, **kwargs):
+        revoke_cookie_tokens(request.COOKIES)
+        res = JsonResponse({}, status=status.HTTP_200_OK)
+        res.delete_cookie("access_token")
+        res.delete_cookie("refresh_token")
+        return res
+
+
+class AsyncAccountRegister(AsyncAPIView):
+    """
+    アカウント登録を行う(非同期版)
+    """
+
+    throttle_classes = [RegisterRateThrottle]
+    # 重複の確認，アカウントと変更イベント(アウトボックス)のINSERT(SQLiteではatomicのBEGINも数える)
+    query_budget = 4
+
+    async def post(self, request, *args, **kwargs):
+        serializer = AccountRegisterSerializer(data=self.get_data(request))
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        check_conflicts(await Account.objects.afind_conflicts(data["username"], data["email"]))
+        password = await hashing_pool.amake_password(data["password"])
+        try:
+            user = await Account.objects.acreate(
+                username=data["username"], email=data["email"], image=data.get("image"), password=password
+            )
+        except IntegrityError:
+            check_conflicts(await Account.objects.afind_conflicts(data["username"], data["email"]))
+            raise
+        return JsonResponse(AccountReadSerializer(user).data, status=status.HTTP_201_CREATED)
+
+
+class AsyncGetAccountInfo(AsyncAPIView):
+    """
+    アカウント情報を取得する(非同期版)．If-None-Matchが一致する場合は行を取得せずに304を返す
+    """
+
+    # 認証の失敗はGetAccountInfoと同じ応答にするため，ビューの中で認証する
+    authentication_classes: List[type] = []
+    query_budget = 1
+
+    async def get(self, request):
+        authentication = ClaimsOnlyAuthentication()
+        raw_token = authentication.get_request_token(request)
+        if raw_token is None:
+            return JsonResponse({"error": "Unauthorized"}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            token_user, _ = authentication.authenticate(request)
+        except exceptions.AuthenticationFailed:
+            return JsonResponse({"error": token_error(raw_token)}, status=status.HTTP_401_UNAUTHORIZED)
+        etag = account_versions.etag(token_user.id, request.META.get("HTTP_IF_NONE_MATCH"))
+        if etag is not None:
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                not_modified["ETag"] = etag
+                return not_modified
+
+        with read_replica(token_user.id):
+            user = await Account.objects.filter(id=token_user.id).afirst()
+        if user is None:
+            return JsonResponse({"error": "User not found"}, status=status.HTTP_401_UNAUTHORIZED)
+        if not user.is_active:
+            return JsonResponse({"error": "User is not active"}, status=status.HTTP_400_BAD_REQUEST)
+        res = JsonResponse(AccountReadSerializer(user).data, status=status.HTTP_200_OK)
+        return add_version_headers(res, user)
+
+
+class AsyncGetAccountStatus(AsyncAPIView):
+    """
+    有効なトークンを持っているかを返す(非同期版，DBアクセスなし)．不正・期限切れ・失効済みのトークンは{"status": 0}
+    """
+
+    query_budget = 0
+
+    async def get(self, request):
+        try:
+            authenticated = ClaimsOnlyAuthentication().authenticate(request) is not None
+        except exceptions.AuthenticationFailed:
+            authenticated = False
+        return JsonResponse({"status": 1 if authenticated else 0}, status=status.HTTP_200_OK)
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+# プロセス毎に別の内容を持つキャッシュ
+PROCESS_LOCAL_CACHES = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def process_local_backend(alias):
+    """
+    aliasのキャッシュがプロセス内のキャッシュの場合はそのBACKEND，共有するキャッシュの場合はNone
+    """
+    backend = settings.CACHES.get(alias, {}).get("BACKEND")
+    return backend if backend in PROCESS_LOCAL_CACHES else None
+
+
+@register(Tags.caches)
+def check_revocation_cache(app_configs, **kwargs):
+    """
+    失効させたトークンはキャッシュを通じて他のプロセスに伝えるため，複数のワーカー(SERVER["WORKERS"])で
+    プロセス内のキャッシュを使うと，他のワーカーで失効させたトークンが使え続ける
+    """
+    if settings.SERVER["WORKERS"] <= 1:
+        return []
+    alias = settings.TOKEN_REVOCATION["CACHE"]
+    backend = process_local_backend(alias)
+    if backend is None:
+        return []
+    return [
+        Warning(
+            f"TOKEN_REVOCATION uses the process-local cache '{alias}' ({backend}) "
+            f"with {settings.SERVER['WORKERS']} workers.",
+            hint="Revoked tokens are not shared between worker processes. "
+            "Set REDIS_URL (or TOKEN_REVOCATION_CACHE) to a cache shared by all processes.",
+            id="account.W001",
+        )
+    ]
+
+
+@register(Tags.caches)
+def check_token_cache(app_configs, **kwargs):
+    """
+    複数のワーカー(SERVER["WORKERS"])で動かす場合，ユーザーの保存・削除を他のワーカーのトークンのキャッシュに
+    伝えるため，AUTH_TOKEN_CACHEの世代は共有するキャッシュに置く
+    """
+    conf = settings.AUTH_TOKEN_CACHE
+    if settings.SERVER["WORKERS"] <= 1 or conf["SIZE"] <= 0:
+        return []
+    backend = process_local_backend(conf["CACHE"])
+    if backend is None:
+        return []
+    return [
+        Error(
+            f"AUTH_TOKEN_CACHE uses the process-local cache '{conf['CACHE']}' ({backend}) "
+            f"with {settings.SERVER['WORKERS']} workers.",
+            hint="Deactivated or deleted users keep authenticating in other workers until their tokens expire. "
+            "Set REDIS_URL (or AUTH_TOKEN_CACHE_CACHE) to a shared cache, or AUTH_TOKEN_CACHE_SIZE=0.",
+            id="account.E001",
+        )
+    ]
+
+
+@register(Tags.caches)
+def check_version_cache(app_configs, **kwargs):
+    """
+    get/の304はACCOUNT_VERSIONSのキャッシュだけで判定するため，複数のワーカーでプロセス内のキャッシュを使うと
+    他のワーカーで保存したユーザーに古い内容の304を返す
+    """
+    if settings.SERVER["WORKERS"] <= 1:
+        return []
+    alias = settings.ACCOUNT_VERSIONS["CACHE"]
+    backend = process_local_backend(alias)
+    if backend is None:
+        return []
+    return [
+        Error(
+            f"ACCOUNT_VERSIONS uses the process-local cache '{alias}' ({backend}) "
+            f"with {settings.SERVER['WORKERS']} workers.",
+            hint="get/ keeps answering 304 with stale accounts saved in other workers. "
+            "Set REDIS_URL (or ACCOUNT_VERSION_CACHE) to a cache shared by all processes.",
+            id="account.E002",
+        )
+    ]
@@ -0,0 +1,116 @@
+"""
+accountテーブルのCSV / NDJSONでのエクスポート．
+行はQuerySet.iterator(chunk_size)で取得し(PostgreSQLではサーバーサイドカーソル)，チャンク毎に変換して返すため，
+メモリ使用量は行数によらず一定になる．
+"""
+import csv
+import zlib
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+from config.renderers import ORJSONRenderer
+
+from .models import Account
+
+# エクスポートできるフィールド(パスワードのハッシュは含めない)
+EXPORT_FIELDS = [
+    "id",
+    "username",
+    "email",
+    "image",
+    "is_active",
+    "is_staff",
+    "is_admin",
+    "date_joined",
+    "login_date",
+    "last_login",
+    "version",
+]
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+DEFAULT_CHUNK_SIZE = 2000
+# CSVのセルがこれらの文字で始まる場合は数式として解釈されないようにする(タブ・CRも数式の前に置けるため含める)
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+# この大きさ以上になったらまとめて返す(1行ずつ返すとWSGIサーバー・gzipの呼び出しが多くなる)
+BUFFER_SIZE = 64 * 1024
+
+
+def parse_fields(value: Optional[str]) -> List[str]:
+    """
+    カンマ区切りのフィールド名を検証する(省略時は全て)
+    """
+    if not value:
+        return list(EXPORT_FIELDS)
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in EXPORT_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)} (available: {', '.join(EXPORT_FIELDS)})")
+    return fields
+
+
+def iter_rows(fields: Sequence[str], chunk_size: int = DEFAULT_CHUNK_SIZE, using: Optional[str] = None):
+    """
+    id順にフィールドの値のタプルを返す．モデルインスタンスは作らない
+    """
+    queryset = Account.objects.order_by("id").values_list(*fields)
+    if using is not None:
+        queryset = queryset.using(using)
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+class _Echo:
+    """
+    csv.writerの書き込み先(書き込んだ内容をそのまま返す)
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_cell(value):
+    """
+    表計算ソフトで数式として解釈される文字列(=, +, -, @等で始まる)は先頭に'を付ける(CSVインジェクション対策)
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_lines(fields: Sequence[str], rows: Iterable[tuple]) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([csv_cell(value) for value in row])
+
+
+def ndjson_lines(fields: Sequence[str], rows: Iterable[tuple]) -> Iterator[bytes]:
+    renderer = ORJSONRenderer()
+    for row in rows:
+        yield renderer.render(dict(zip(fields, row))) + b"\n"
+
+
+def export_stream(fmt: str, fields: Sequence[str], rows: Iterable[tuple], compress: bool = False) -> Iterator[bytes]:
+    """
+    rowsをfmtの形式に変換し，BUFFER_SIZE程度のバイト列毎に返す．compressがTrueの場合はgzipで圧縮する
+    """
+    lines: Iterable = csv_lines(fields, rows) if fmt == "csv" else ndjson_lines(fields, rows)
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer: List[bytes] = []
+    size = 0
+    for line in lines:
+        data = line.encode() if isinstance(line, str) else line
+        buffer.append(data)
+        size += len(data)
+        if size >= BUFFER_SIZE:
+            chunk = b"".join(buffer)
+            buffer, size = [], 0
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    chunk = b"".join(buffer)
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
@@ -0,0 +1,116 @@
+import atexit
+import logging
+import os
+import threading
+from typing import Optional, Set
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# start()したflusher(stop_flushers()で止める)と，このプロセスでstop_flushers()をatexitに登録したか
+_started: Set["PeriodicFlusher"] = set()
+_registered = False
+_registry_lock = threading.Lock()
+
+
+def stop_flushers() -> None:
+    """
+    start()した全てのflusherを止め，残っている内容をflush()する．
+    プロセスの終了時(atexit)に呼ばれる他，os._exit()で終了するpreforkのワーカーは終了前に呼び出す
+    """
+    with _registry_lock:
+        flushers = list(_started)
+    for flusher in flushers:
+        flusher.stop()
+
+
+def _register(flusher: "PeriodicFlusher") -> None:
+    global _registered
+    with _registry_lock:
+        _started.add(flusher)
+        if not _registered:
+            # start()・stop()を繰り返してもatexitにはプロセス毎に1回だけ登録する
+            _registered = True
+            atexit.register(stop_flushers)
+
+
+def _after_fork() -> None:
+    # 親プロセスのスレッドは引き継がれないため，子プロセスでstart()し直したものだけを止める
+    # (atexitの登録は子プロセスにも引き継がれる)
+    global _registry_lock
+    _registry_lock = threading.Lock()
+    _started.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class PeriodicFlusher:
+    """
+    flush()を別スレッドで一定間隔毎に呼び出す基底クラス．
+    スレッドは最初にstart()した時に起動し(fork後の子プロセスで起動させるため)，終了時にstop_flushers()で最後のflush()を行う．
+    """
+
+    flush_interval: float = 10
+
+    def __init__(self) -> None:
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def flush(self):
+        raise NotImplementedError
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._wakeup.clear()
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+        _register(self)
+
+    def wakeup(self) -> None:
+        """
+        次の間隔を待たずにflush()させる
+        """
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        """
+        スレッドを止め，残っている内容をflush()する
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+        with _registry_lock:
+            _started.discard(self)
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+            self._flush()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self._stopped:
+                self._flush()
+
+    def _flush(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to flush %s", type(self).__name__)
+        finally:
+            connections.close_all()
+
+    def _after_fork(self) -> None:
+        # 親プロセスのスレッドは子プロセスには引き継がれない
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework import exceptions, status
+
+
+class HashingPoolBusy(exceptions.APIException):
+    """
+    ハッシュ計算の待ち行列が満杯のときに送出する(503 + Retry-After)
+    """
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Password hashing is busy, please try again later."
+    default_code = "hashing_busy"
+    wait = 1
+
+
+def _init_worker():
+    # spawnで起動したワーカープロセスではDjangoの設定を読み込み直す
+    if not settings.configured:
+        import django
+
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+        django.setup()
+
+
+def _make_password(password: str) -> str:
+    return hashers.make_password(password)
+
+
+def _check_password(password: str, encoded: str) -> Tuple[bool, bool]:
+    # setterが呼ばれた場合はハッシュの再計算(アルゴリズム・反復回数の更新)が必要
+    must_update: List[str] = []
+    is_correct = hashers.check_password(password, encoded, setter=must_update.append)
+    return is_correct, bool(must_update)
+
+
+class HashingPool:
+    """
+    PBKDF2などのパスワードハッシュ計算をワーカープールで実行する．
+    同時に受け付ける件数はworkers + max_queueまでで，超えた分はHashingPoolBusyで即座に拒否する．
+    backendは"thread"(hashlibはGILを解放する)，"process"，"inline"(呼び出し元で実行)のいずれか．
+    """
+
+    def __init__(self, backend: str = "thread", workers: Optional[int] = None, max_queue: int = 64):
+        if backend not in ("thread", "process", "inline"):
+            raise ValueError(f"Unknown hashing backend: {backend}")
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "HashingPool":
+        conf = settings.PASSWORD_HASHING_POOL
+        return cls(backend=conf["BACKEND"], workers=conf["WORKERS"], max_queue=conf["MAX_QUEUE"])
+
+    def submit(self, fn, *args) -> Future:
+        if self.backend == "inline":
+            future: Future = Future()
+            future.set_result(fn(*args))
+            return future
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingPoolBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def make_password(self, password: str) -> str:
+        return self.submit(_make_password, password).result()
+
+    def make_passwords(self, passwords: Sequence[str]) -> List[str]:
+        """
+        複数のパスワードをまとめてワーカーに渡してハッシュ化する(件数はworkers + max_queue以下にすること)
+        """
+        futures = [self.submit(_make_password, password) for password in passwords]
+        return [future.result() for future in futures]
+
+    def check_password(self, password: str, encoded: str) -> Tuple[bool, bool]:
+        """
+        (パスワードが正しいか, ハッシュの再計算が必要か)を返す
+        """
+        if password is None or not hashers.is_password_usable(encoded):
+            return False, False
+        return self.submit(_check_password, password, encoded).result()
+
+    async def amake_password(self, password: str) -> str:
+        return await asyncio.wrap_future(self.submit(_make_password, password))
+
+    async def acheck_password(self, password: str, encoded: str) -> Tuple[bool, bool]:
+        if password is None or not hashers.is_password_usable(encoded):
+            return False, False
+        return await asyncio.wrap_future(self.submit(_check_password, password, encoded))
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _get_executor(self) -> Executor:
+        # fork後の子プロセスで生成されるよう，最初の利用時に作成する
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.backend == "process":
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hashing")
+        return self._executor
+
+    def _after_fork(self) -> None:
+        # 親プロセスのエグゼキューターは子プロセスでは使えないため破棄する
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+        self._lock = threading.Lock()
+
+
+hashing_pool = HashingPool.from_settings()
+os.register_at_fork(after_in_child=hashing_pool._after_fork)
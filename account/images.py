@@ -0,0 +1,243 @@
+"""
+アップロードされた画像の縮小版(バリアント)を作成・配信する．
+バリアントは元画像と同じディレクトリに images/ab/<ハッシュ>_<サイズ>.webp として保存する．
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Optional, Set
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponseRedirect
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET
+
+logger = logging.getLogger(__name__)
+
+CONTENT_HASH_RE = re.compile(r"images/[0-9a-f]{2}/(?P<hash>[0-9a-f]{64})(\.[A-Za-z0-9]{1,5})?$")
+
+
+def content_hash_from_url(url: Optional[str]) -> Optional[str]:
+    """
+    content-addressedで保存した画像のURL(またはパス)からハッシュを取り出す
+    """
+    if not url:
+        return None
+    match = CONTENT_HASH_RE.search(url)
+    return match.group("hash") if match else None
+
+
+def verify_image(upload_file) -> bool:
+    """
+    Pillowで画像として読み込めるか(破損していないか，画素数が上限以下か)を確認する．全体のデコードは行わない
+    """
+    from PIL import Image
+
+    upload_file.seek(0)
+    try:
+        with Image.open(upload_file) as image:
+            if image.width * image.height > Image.MAX_IMAGE_PIXELS:
+                return False
+            image.verify()
+    except Exception:
+        # 破損した画像ではOSError以外(SyntaxError，ValueErrorなど)も送出される
+        return False
+    finally:
+        upload_file.seek(0)
+    return True
+
+
+def variant_name(content_hash: str, size: int) -> str:
+    return f"images/{content_hash[:2]}/{content_hash}_{size}.{settings.IMAGE_VARIANT_FORMAT.lower()}"
+
+
+def generate_variants(name: str) -> Dict[int, str]:
+    """
+    元画像から各サイズのバリアントを作成する(作成済みのサイズは省略)
+    """
+    from PIL import Image, ImageOps
+
+    content_hash = content_hash_from_url(name)
+    if content_hash is None:
+        return {}
+    targets = {size: variant_name(content_hash, size) for size in settings.IMAGE_VARIANT_SIZES}
+    targets = {size: target for size, target in targets.items() if not default_storage.exists(target)}
+    if not targets:
+        return {}
+
+    with default_storage.open(name) as f, Image.open(f) as original:
+        # JPEGはデコード時に縮小して読み込む
+        original.draft("RGB", (max(targets), max(targets)))
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        for size, target in sorted(targets.items(), reverse=True):
+            # 大きいサイズから順に縮小して次のサイズの元にする
+            image.thumbnail((size, size), Image.LANCZOS)
+            buffer = BytesIO()
+            image.save(buffer, settings.IMAGE_VARIANT_FORMAT, quality=settings.IMAGE_VARIANT_QUALITY)
+            default_storage.save(target, ContentFile(buffer.getvalue()))
+    return targets
+
+
+def original_name(content_hash: str) -> Optional[str]:
+    directory = f"images/{content_hash[:2]}"
+    try:
+        _, names = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if name.startswith(content_hash) and "_" not in name:
+            return f"{directory}/{name}"
+    return None
+
+
+@require_GET
+def image_variant(request, content_hash, size):
+    """
+    バリアントを返す．内容はURLで決まるため，If-None-Matchが一致する場合はストレージにアクセスせず304を返す
+    """
+    if size not in settings.IMAGE_VARIANT_SIZES or not re.fullmatch(r"[0-9a-f]{64}", content_hash):
+        raise Http404
+    etag = quote_etag(f"{content_hash}-{size}")
+    cache_control = f"public, max-age={settings.IMAGE_VARIANT_MAX_AGE}, immutable"
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified["Cache-Control"] = cache_control
+        return not_modified
+
+    try:
+        f = default_storage.open(variant_name(content_hash, size))
+    except FileNotFoundError:
+        # 作成前の場合は作成を依頼し，元画像に転送する(キャッシュさせない)
+        original = original_name(content_hash)
+        if original is None:
+            raise Http404
+        variant_pool.schedule(original)
+        res = HttpResponseRedirect(default_storage.url(original))
+        res["Cache-Control"] = "no-cache"
+        return res
+    res = FileResponse(f, content_type=f"image/{settings.IMAGE_VARIANT_FORMAT.lower()}")
+    res["ETag"] = etag
+    res["Cache-Control"] = cache_control
+    return res
+
+
+def variant_urls(image_url):
+    """
+    画像のURLから各サイズのバリアントのURLを返す(content-addressedでない画像の場合は空)
+    """
+    content_hash = content_hash_from_url(image_url)
+    if content_hash is None:
+        return {}
+    prefix = variant_url_prefix()
+    return {str(size): f"{prefix}{content_hash}/{size}/" for size in settings.IMAGE_VARIANT_SIZES}
+
+
+_variant_url_prefixes: Dict[str, str] = {}
+
+
+def variant_url_prefix() -> str:
+    """
+    バリアントのURLのハッシュより前の部分．reverse()は一覧の各行で呼ぶには遅いため，スクリプトのプレフィックス毎に1回だけ解決する
+    """
+    from django.urls import get_script_prefix, reverse
+
+    script_prefix = get_script_prefix()
+    prefix = _variant_url_prefixes.get(script_prefix)
+    if prefix is None:
+        placeholder = f"{'0' * 64}/0/"
+        url = reverse("imageVariant", kwargs={"content_hash": "0" * 64, "size": 0})
+        prefix = _variant_url_prefixes[script_prefix] = url[: -len(placeholder)]
+    return prefix
+
+
+class ImageVariantPool:
+    """
+    バリアントの作成をリクエストとは別のスレッドで行う．
+    同じ画像の作成中・待機中の依頼は重ねず，待機中の依頼がmax_queue件を超えた場合は捨てる(次の配信時に再度依頼される)．
+    作成に失敗した画像は最大max_failures件を記録し，retry_after秒が経つまで再試行しない
+    """
+
+    def __init__(
+        self, workers: int, max_queue: int = 100, max_failures: int = 10000, retry_after: float = 3600
+    ) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.dropped = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 作成中・待機中の画像
+        self._pending: Set[str] = set()
+        # 作成に失敗した画像 -> 失敗した時刻(time.monotonic())
+        self._failed: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "ImageVariantPool":
+        return cls(
+            settings.IMAGE_VARIANT_WORKERS,
+            max_queue=settings.IMAGE_VARIANT_MAX_QUEUE,
+            retry_after=settings.IMAGE_VARIANT_RETRY_AFTER,
+        )
+
+    def schedule(self, name: str) -> bool:
+        """
+        作成を依頼する．依頼しなかった(作成中，失敗済み，待ち行列が満杯)場合はFalseを返す
+        """
+        with self._lock:
+            if name in self._pending:
+                return False
+            failed_at = self._failed.get(name)
+            if failed_at is not None:
+                if time.monotonic() - failed_at < self.retry_after:
+                    return False
+                del self._failed[name]
+            if len(self._pending) >= self.workers + self.max_queue:
+                self.dropped += 1
+                return False
+            self._pending.add(name)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-variant")
+            executor = self._executor
+        executor.submit(self._generate, name)
+        return True
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def failures(self) -> int:
+        return len(self._failed)
+
+    def _generate(self, name: str) -> None:
+        try:
+            generate_variants(name)
+        except Exception:
+            logger.exception("Failed to generate image variants for %s", name)
+            with self._lock:
+                self._failed[name] = time.monotonic()
+                self._failed.move_to_end(name)
+                while len(self._failed) > self.max_failures:
+                    self._failed.popitem(last=False)
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _after_fork(self) -> None:
+        # 親プロセスの依頼は子プロセスでは実行されない
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+
+variant_pool = ImageVariantPool.from_settings()
+os.register_at_fork(after_in_child=variant_pool._after_fork)
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from config.schema import RENDERERS, cache_path, code_version, get_schema, schema_language
+
+
+class Command(BaseCommand):
+    help = "OpenAPIスキーマを生成してsettings.SCHEMA_CACHE['DIR']に保存する(api/schema/は保存したスキーマを返す)．"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(RENDERERS), action="append", help="生成する形式(既定は全て)")
+        parser.add_argument("--lang", action="append", default=[], help="既定の言語以外に生成する言語(?lang=)")
+
+    def handle(self, *args, **options):
+        langs = [""]
+        for lang in options["lang"]:
+            if not schema_language(lang):
+                raise CommandError(f"Unknown language: {lang} (see settings.LANGUAGES)")
+            langs.append(lang)
+
+        version = code_version()
+        for fmt in options["format"] or sorted(RENDERERS):
+            for lang in langs:
+                content, etag = get_schema(fmt, lang, build=True)
+                self.stdout.write(f"{cache_path(version, fmt, lang)} ({len(content)} bytes, ETag {etag})")
+        self.stdout.write(self.style.SUCCESS(f"Built schema for version {version} in {settings.SCHEMA_CACHE['DIR']}"))
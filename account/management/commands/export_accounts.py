@@ -0,0 +1,57 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from account.export import DEFAULT_CHUNK_SIZE, EXPORT_FIELDS, FORMATS, export_stream, iter_rows, parse_fields
+
+
+class Command(BaseCommand):
+    help = "アカウントをCSVまたはNDJSONのファイルに書き出す．" "行はサーバーサイドカーソルでチャンク毎に読み込むため，行数によらずメモリ使用量は一定．"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="出力先(.csv / .ndjson，.gzを付けるとgzipで圧縮．-で標準出力)")
+        parser.add_argument("--format", choices=sorted(FORMATS), help="ファイル形式(省略時は拡張子から判定)")
+        parser.add_argument("--fields", help=f"カンマ区切りの出力するフィールド(既定: {','.join(EXPORT_FIELDS)})")
+        parser.add_argument("--gzip", action="store_true", help="gzipで圧縮する(拡張子が.gzの場合は常に圧縮)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="1回に取得する行数")
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS, help="読み込むデータベース(レプリカなど)")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        compress = options["gzip"] or path.endswith(".gz")
+        name = path[:-3] if path.endswith(".gz") else path
+        fmt = options["format"] or ("csv" if name.endswith(".csv") else "ndjson")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        try:
+            fields = parse_fields(options["fields"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        self.exported = 0
+        start = time.perf_counter()
+        stream = export_stream(
+            fmt, fields, self.count(iter_rows(fields, options["chunk_size"], options["database"])), compress
+        )
+        if path == "-":
+            for chunk in stream:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+        with open(path, "wb") as f:
+            for chunk in stream:
+                f.write(chunk)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Exported {self.exported} accounts to {path} in {elapsed:.1f}s ({self.exported / elapsed:.1f} rows/s)"
+            )
+        )
+
+    def count(self, rows):
+        for row in rows:
+            self.exported += 1
+            yield row
@@ -0,0 +1,155 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from account.hashers import HashingPool
+from account.models import Account
+from account.outbox import record_created
+from account.serializers import AccountRegisterSerializer
+
+
+def read_rows(f, fmt):
+    """
+    (行番号, dict)を1行ずつ返す
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            row = {"__error__": f"Invalid JSON: {e.msg}"}
+        yield line_num, row if isinstance(row, dict) else {"__error__": "Row must be a JSON object"}
+
+
+class Command(BaseCommand):
+    help = (
+        "CSV(ヘッダー: username,email,password[,image])またはNDJSONのファイルからアカウントを一括登録する．"
+        "ファイルはチャンク毎に読み込み，パスワードは複数プロセスで並列にハッシュ化してbulk_createで登録する．"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="取り込むファイル(.csv / .ndjson / .jsonl)")
+        parser.add_argument("--format", choices=["csv", "ndjson"], help="ファイル形式(省略時は拡張子から判定)")
+        parser.add_argument("--batch-size", type=int, default=1000, help="1回に検証・登録する行数")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ハッシュ計算のプロセス数")
+        parser.add_argument("--report", help="エラー行のレポート(CSV)の出力先．省略時は<path>.errors.csv")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if path.endswith(".csv") else "ndjson")
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive")
+        report_path = options["report"] or f"{path}.errors.csv"
+
+        pool = HashingPool(backend="process", workers=options["workers"], max_queue=batch_size)
+        self.imported = self.failed = 0
+        start = time.perf_counter()
+        try:
+            with open(path, newline="", encoding="utf-8") as f, open(report_path, "w", newline="") as report:
+                self.report = csv.writer(report)
+                self.report.writerow(["line", "username", "email", "error"])
+                rows = read_rows(f, fmt)
+                while chunk := list(islice(rows, batch_size)):
+                    self.import_chunk(chunk, pool)
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(
+                        f"{self.imported} imported, {self.failed} failed ({self.imported / elapsed:.1f} rows/s)"
+                    )
+        except FileNotFoundError as e:
+            raise CommandError(e)
+        finally:
+            pool.shutdown()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {self.imported} accounts in {elapsed:.1f}s ({self.imported / elapsed:.1f} rows/s), "
+                f"{self.failed} errors written to {report_path}"
+            )
+        )
+
+    def import_chunk(self, chunk, pool):
+        valid = []
+        usernames, emails = set(), set()
+        for line, row in chunk:
+            if "__error__" in row:
+                self.write_error(line, row, row["__error__"])
+                continue
+            serializer = AccountRegisterSerializer(data=row)
+            if not serializer.is_valid():
+                self.write_error(line, row, json.dumps(serializer.errors, ensure_ascii=False))
+                continue
+            data = serializer.validated_data
+            # ファイル内での重複
+            if data["username"] in usernames or data["email"] in emails:
+                self.write_error(line, row, "Duplicated in file")
+                continue
+            usernames.add(data["username"])
+            emails.add(data["email"])
+            valid.append((line, data))
+
+        # 登録済みのユーザーとの重複をチャンク毎に1回のクエリで確認する
+        taken = Account.objects.filter(Q(username__in=usernames) | Q(email__in=emails)).values_list(
+            "username", "email"
+        )
+        taken_usernames, taken_emails = set(), set()
+        for username, email in taken:
+            taken_usernames.add(username)
+            taken_emails.add(email)
+        rows = []
+        for line, data in valid:
+            if data["username"] in taken_usernames:
+                self.write_error(line, data, "This username has already used")
+            elif data["email"] in taken_emails:
+                self.write_error(line, data, "This email has already used")
+            else:
+                rows.append((line, data))
+        if not rows:
+            return
+
+        now = timezone.now()
+        passwords = pool.make_passwords([data["password"] for _, data in rows])
+        accounts = [
+            Account(
+                username=data["username"],
+                email=data["email"],
+                image=data.get("image"),
+                password=password,
+                is_active=True,
+                date_joined=now,
+            )
+            for (_, data), password in zip(rows, passwords)
+        ]
+        try:
+            with transaction.atomic():
+                Account.objects.bulk_create(accounts, batch_size=len(accounts))
+                # bulk_createはsave()を呼ばないため，作成イベントは同じトランザクションでまとめて書き込む
+                record_created(accounts)
+            self.imported += len(accounts)
+        except IntegrityError:
+            # 取り込み中に同じユーザーが登録された場合は1件ずつ登録し直す
+            for (line, data), account in zip(rows, accounts):
+                try:
+                    with transaction.atomic():
+                        account.save(force_insert=True)
+                    self.imported += 1
+                except IntegrityError as e:
+                    self.write_error(line, data, str(e))
+
+    def write_error(self, line, row, error):
+        self.failed += 1
+        self.report.writerow([line, row.get("username", ""), row.get("email", ""), error])
@@ -0,0 +1,41 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from account.outbox import OutboxRelay
+
+
+class Command(BaseCommand):
+    help = "アカウントの変更イベント(アウトボックス)をsettings.OUTBOX['SINKS']の配信先にid順のバッチで配信する．" "SIGTERM / SIGINTで配信中のバッチを終えてから終了する．"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sinks", help=f"カンマ区切りの配信先(既定は全て: {','.join(settings.OUTBOX['SINKS'])})")
+        parser.add_argument("--once", action="store_true", help="未配信のイベントを全て配信してから終了する")
+        parser.add_argument("--interval", type=float, default=settings.OUTBOX["POLL_INTERVAL"], help="確認間隔(秒)")
+
+    def handle(self, *args, **options):
+        names = options["sinks"].split(",") if options["sinks"] else None
+        unknown = set(names or []) - set(settings.OUTBOX["SINKS"])
+        if unknown:
+            raise CommandError(f"Unknown sinks: {', '.join(sorted(unknown))}")
+        relay = OutboxRelay.from_settings(names)
+        if not relay.sinks:
+            raise CommandError("No sinks are configured (set OUTBOX_FILE or OUTBOX_HTTP_URL)")
+
+        if options["once"]:
+            # 失敗した配信先は再送を待たずに終了する
+            while relay.deliver():
+                pass
+        else:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *_: relay.stop())
+            self.stdout.write(f"Relaying outbox events to {', '.join(sink.name for sink in relay.sinks)}")
+            relay.run(interval=options["interval"])
+        for sink in relay.sinks:
+            message = f"{sink.name}: {relay.delivered[sink.name]} events delivered"
+            if relay.skipped[sink.name]:
+                message += f", gave up waiting for {relay.skipped[sink.name]} missing ids"
+            self.stdout.write(message)
+        if any(relay.failures.values()):
+            raise CommandError("Some sinks failed, see the log for details")
@@ -0,0 +1,54 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from config.server import INTERFACES, PreforkServer, load_application
+
+
+class Command(BaseCommand):
+    help = (
+        "アプリケーションを読み込んでからワーカーをforkして起動する(config/server.py)．"
+        "SIGTERM / SIGINTで処理中のリクエストを待ってから終了し，SIGHUPで全てのワーカーを入れ替える．"
+    )
+
+    def add_arguments(self, parser):
+        conf = settings.SERVER
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument("--interface", choices=sorted(INTERFACES), default=conf["INTERFACE"])
+        parser.add_argument("--workers", type=int, default=conf["WORKERS"], help="ワーカープロセス数")
+        parser.add_argument("--max-requests", type=int, default=conf["MAX_REQUESTS"], help="ワーカーを入れ替えるまでのリクエスト数")
+        parser.add_argument("--max-requests-jitter", type=int, default=conf["MAX_REQUESTS_JITTER"])
+        parser.add_argument("--max-memory-mb", type=int, default=conf["MAX_MEMORY_MB"], help="ワーカー固有のメモリ(USS)の上限")
+        parser.add_argument("--graceful-timeout", type=int, default=conf["GRACEFUL_TIMEOUT"])
+        parser.add_argument("--access-log", action="store_true")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        application = load_application(options["interface"])
+        preloaded = time.monotonic() - started
+        self.stdout.write(f"Preloaded the {options['interface']} application in {preloaded * 1000:.0f}ms")
+        self.stdout.write(f"Listening on http://{options['host']}:{options['port']} ({options['workers']} workers)")
+
+        def report(server):
+            self.stdout.write(f"{server.workers} workers ready in {(time.monotonic() - started) * 1000:.0f}ms")
+            for row in server.memory_report():
+                self.stdout.write("  " + " ".join(f"{key}={value}" for key, value in row.items()))
+
+        server = PreforkServer(
+            application,
+            interface=options["interface"],
+            host=options["host"],
+            port=options["port"],
+            workers=options["workers"],
+            max_requests=options["max_requests"],
+            max_requests_jitter=options["max_requests_jitter"],
+            max_memory_mb=options["max_memory_mb"],
+            graceful_timeout=options["graceful_timeout"],
+            access_log=options["access_log"],
+            metrics_dir=settings.SERVER["METRICS_DIR"],
+            on_ready=report,
+        )
+        server.run()
+        self.stdout.write(f"Stopped ({server.recycled} workers recycled)")
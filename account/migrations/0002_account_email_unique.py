@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="account",
+            name="email",
+            field=models.EmailField(max_length=255, unique=True, verbose_name="Eメール"),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0002_account_email_unique"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="account",
+            index=models.Index(fields=["username", "id"], name="account_username_id_idx"),
+        ),
+    ]
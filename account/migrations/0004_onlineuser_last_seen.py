@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0003_account_username_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="onlineuser",
+            name="last_seen",
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0004_onlineuser_last_seen"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="account",
+            name="version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
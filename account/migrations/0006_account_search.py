@@ -0,0 +1,63 @@
+# ユーザー名・メールアドレスの検索用のインデックス(account/search.py)
+# PostgreSQLではpg_trgm拡張を作成するため，CREATE EXTENSIONの権限が必要
+
+from django.db import migrations
+
+POSTGRES_FORWARDS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX account_username_lower_idx ON account (LOWER(username) text_pattern_ops)",
+    "CREATE INDEX account_email_lower_idx ON account (LOWER(email) text_pattern_ops)",
+    "CREATE INDEX account_username_trgm_idx ON account USING gin (LOWER(username) gin_trgm_ops)",
+    "CREATE INDEX account_email_trgm_idx ON account USING gin (LOWER(email) gin_trgm_ops)",
+]
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS account_username_lower_idx",
+    "DROP INDEX IF EXISTS account_email_lower_idx",
+    "DROP INDEX IF EXISTS account_username_trgm_idx",
+    "DROP INDEX IF EXISTS account_email_trgm_idx",
+]
+SQLITE_FORWARDS = [
+    "CREATE INDEX account_username_lower_idx ON account (LOWER(username))",
+    "CREATE INDEX account_email_lower_idx ON account (LOWER(email))",
+    "CREATE VIRTUAL TABLE account_search "
+    "USING fts5(username, email, content='account', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER account_search_insert AFTER INSERT ON account BEGIN "
+    "INSERT INTO account_search(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "CREATE TRIGGER account_search_delete AFTER DELETE ON account BEGIN "
+    "INSERT INTO account_search(account_search, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); END",
+    "CREATE TRIGGER account_search_update AFTER UPDATE OF username, email ON account BEGIN "
+    "INSERT INTO account_search(account_search, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); "
+    "INSERT INTO account_search(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "INSERT INTO account_search(account_search) VALUES ('rebuild')",
+]
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS account_search_insert",
+    "DROP TRIGGER IF EXISTS account_search_delete",
+    "DROP TRIGGER IF EXISTS account_search_update",
+    "DROP TABLE IF EXISTS account_search",
+    "DROP INDEX IF EXISTS account_username_lower_idx",
+    "DROP INDEX IF EXISTS account_email_lower_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0005_account_version"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"postgresql": POSTGRES_FORWARDS, "sqlite": SQLITE_FORWARDS}),
+            run({"postgresql": POSTGRES_BACKWARDS, "sqlite": SQLITE_BACKWARDS}),
+        ),
+    ]
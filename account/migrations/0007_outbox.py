@@ -0,0 +1,39 @@
+# Generated by Django 4.2.1 on 2026-10-18 13:01
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0006_account_search"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxCheckpoint",
+            fields=[
+                ("sink", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("position", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "db_table": "account_outbox_checkpoint",
+            },
+        ),
+        migrations.CreateModel(
+            name="OutboxEvent",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("event_type", models.CharField(max_length=64)),
+                ("account_id", models.BigIntegerField()),
+                ("version", models.PositiveIntegerField()),
+                ("payload", models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ("created_at", models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                "db_table": "account_outbox",
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0007_outbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboxcheckpoint",
+            name="gaps",
+            field=models.JSONField(default=list),
+        ),
+    ]
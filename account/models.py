@@ -1,7 +1,15 @@
+from contextlib import nullcontext
+
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, _user_has_perm
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, router, transaction
+from django.db.models import F, Q
+from django.db.models.expressions import Combinable
+from django.db.models.sql import UpdateQuery
 from django.utils import timezone
 
+from .hashers import hashing_pool
+
 
 class AccountManager(BaseUserManager):
     """
@@ -21,6 +29,27 @@ class AccountManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def find_conflicts(self, username, email):
+        """
+        username・emailのうち既に使われているものを1回のクエリで返す
+        """
+        rows = self.filter(Q(username=username) | Q(email=email)).values_list("username", "email")[:2]
+        return self._conflicts(rows, username, email)
+
+    async def afind_conflicts(self, username, email):
+        rows = self.filter(Q(username=username) | Q(email=email)).values_list("username", "email")[:2]
+        return self._conflicts([row async for row in rows], username, email)
+
+    @staticmethod
+    def _conflicts(rows, username, email):
+        conflicts = set()
+        for taken_username, taken_email in rows:
+            if taken_username == username:
+                conflicts.add("username")
+            if taken_email == email:
+                conflicts.add("email")
+        return conflicts
+
     def create_superuser(self, username, email, password, **extra_fields):
         request_data = {"username": username, "email": email, "password": password}
         user = self.create_user(request_data)
@@ -38,6 +67,8 @@ class Account(AbstractBaseUser):
 
     class Meta(object):
         db_table = "account"
+        # ユーザー一覧のキーセットページング用
+        indexes = [models.Index(fields=["username", "id"], name="account_username_id_idx")]
 
     username = models.CharField(verbose_name="ユーザ名", max_length=255, unique=True)
     email = models.EmailField(verbose_name="Eメール", max_length=255, unique=True)
@@ -47,11 +78,148 @@ class Account(AbstractBaseUser):
     date_joined = models.DateTimeField(default=timezone.now)
     login_date = models.DateTimeField(default=timezone.now)
     image = models.URLField("URL", max_length=1000, blank=True, null=True)
+    # 保存毎に増やすバージョン(get/のETag．account/versions.py)
+    version = models.PositiveIntegerField(default=1)
 
     objects = AccountManager()
 
     USERNAME_FIELD = "email"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 変更のあったフィールドを判定するため，読み込んだ(保存した)時点の値を覚えておく(from_db()・save())
+        self._loaded_values = {}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 遅延読み込み(only() / defer())のフィールドは含まない
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        # QuerySet.updateでは増えないため，レスポンスに含まれるフィールドはsave()で更新する
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not update_fields:
+            return
+        adding = self._state.adding
+        changed = None if adding else self.changed_fields(update_fields)
+        if changed is not None and not changed:
+            # 値の変わらない保存では何も書き込まない(バージョンも増やさず，イベントも書き込まない)
+            return
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        previous_version = self.version
+        if not adding:
+            # 同時に保存された場合も増分を失わないよう，DBの値に1を足す(保存した値はUPDATE ... RETURNINGで受け取る)
+            self.version = F("version") + 1
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "version"}
+        # イベントを書き込まず，バージョンをRETURNINGで受け取れる場合はUPDATEの1クエリだけのためトランザクションを使わない
+        single_update = changed is not None and not OUTBOX_FIELDS.intersection(changed) and update_returning(using)
+        try:
+            with nullcontext() if single_update else transaction.atomic(using=using, savepoint=False):
+                event_type = self.outbox_event_type(changed, using)
+                super().save(*args, **kwargs)
+                if isinstance(self.version, Combinable):
+                    # RETURNINGに対応していないデータベースでは同じトランザクションで読み直す
+                    self.refresh_from_db(using=using, fields=["version"])
+                if event_type is not None:
+                    deferred = self.get_deferred_fields().intersection(OUTBOX_PAYLOAD_FIELDS)
+                    if deferred:
+                        self.refresh_from_db(using=using, fields=deferred)
+                    # 変更イベントはアカウントと同じトランザクションでアウトボックスに書き込む
+                    OutboxEvent.objects.using(using).create(
+                        event_type=event_type, account_id=self.pk, version=self.version, payload=self.outbox_payload()
+                    )
+        except BaseException:
+            self.version = previous_version
+            raise
+        saved = kwargs.get("update_fields") or [field.attname for field in self._meta.concrete_fields]
+        self._loaded_values.update((name, self.__dict__[name]) for name in saved if name in self.__dict__)
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # F("version") + 1のUPDATEは，保存したバージョンをRETURNINGで同じクエリから受け取る
+        version = next((value for field, _, value in values if field.attname == "version"), None)
+        if not isinstance(version, Combinable) or self._meta.select_on_save or not update_returning(using):
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        query = base_qs.filter(pk=pk_val).query.chain(UpdateQuery)
+        query.add_update_fields(values)
+        sql, params = query.get_compiler(using).as_sql()
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            cursor.execute(f"{sql} RETURNING {connection.ops.quote_name('version')}", params)
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        self.version = row[0]
+        return True
+
+    def changed_fields(self, update_fields=None):
+        """
+        読み込んだ(保存した)時点から値の変わったフィールド(update_fieldsを指定した場合はその中から)．
+        遅延読み込みのまま代入していないフィールドは保存されないため含めない
+        """
+        deferred = self.get_deferred_fields()
+        names = update_fields if update_fields is not None else [field.attname for field in self._meta.concrete_fields]
+        return {
+            name
+            for name in names
+            if name not in deferred
+            and (name not in self._loaded_values or self._loaded_values[name] != self.__dict__[name])
+        }
+
+    def outbox_event_type(self, changed=None, using=None):
+        """
+        保存時にアウトボックスに書き込むイベントの種類(changedは変更のあったフィールド，作成時はNone)．
+        OUTBOX_FIELDSが変わらない保存(last_login，パスワードの再ハッシュなど)ではNoneを返す
+        """
+        if self._state.adding:
+            return "account.created"
+        if changed is not None and not OUTBOX_FIELDS.intersection(changed):
+            return None
+        if changed is not None and "is_active" in changed and not self.is_active:
+            was_active = self._loaded_values.get("is_active")
+            if was_active is None:
+                # is_activeを遅延読み込みにしてから代入した場合は保存前の値を読む
+                was_active = (
+                    type(self)
+                    ._base_manager.using(using)
+                    .filter(pk=self.pk)
+                    .values_list("is_active", flat=True)
+                    .first()
+                )
+            if was_active:
+                return "account.deactivated"
+        return "account.updated"
+
+    def outbox_payload(self):
+        return {field: getattr(self, field) for field in OUTBOX_PAYLOAD_FIELDS}
+
+    def set_password(self, raw_password):
+        # ハッシュ計算はワーカープールで行う
+        self.password = hashing_pool.make_password(raw_password)
+        self._password = raw_password
+
+    def check_password(self, raw_password):
+        is_correct, must_update = hashing_pool.check_password(raw_password, self.password)
+        if is_correct and must_update:
+            self.set_password(raw_password)
+            self._password = None
+            self.save(update_fields=["password"])
+        return is_correct
+
+    async def aset_password(self, raw_password):
+        self.password = await hashing_pool.amake_password(raw_password)
+        self._password = raw_password
+
+    async def acheck_password(self, raw_password):
+        is_correct, must_update = await hashing_pool.acheck_password(raw_password, self.password)
+        if is_correct and must_update:
+            await self.aset_password(raw_password)
+            self._password = None
+            await self.asave(update_fields=["password"])
+        return is_correct
+
     def user_has_perm(self, user, perm, obj):
         return _user_has_perm(user, perm, obj)
 
@@ -69,8 +237,76 @@ class Account(AbstractBaseUser):
         return f"{self.id}:{self.username}"
 
 
+def update_returning(using) -> bool:
+    """
+    UPDATE ... RETURNINGを使えるか(PostgreSQL，SQLite 3.35以降)
+    """
+    connection = connections[using]
+    return connection.vendor in ("postgresql", "sqlite") and connection.features.can_return_columns_from_insert
+
+
+# 変更イベントのpayloadに含めるフィールド
+OUTBOX_PAYLOAD_FIELDS = [
+    "id",
+    "username",
+    "email",
+    "image",
+    "is_active",
+    "is_staff",
+    "is_admin",
+    "date_joined",
+    "version",
+]
+# これらのフィールドを含まないupdate_fieldsでの保存ではイベントを書き込まない
+OUTBOX_FIELDS = frozenset(OUTBOX_PAYLOAD_FIELDS) - {"id", "date_joined", "version"}
+
+
 class OnlineUser(models.Model):
+    """
+    オンラインのユーザー(account.presenceが一定間隔でまとめて書き込むスナップショット)
+    """
+
     user = models.OneToOneField(Account, on_delete=models.CASCADE)
+    last_seen = models.DateTimeField(default=timezone.now, db_index=True)
 
     def __str__(self):
         return self.user.username
+
+
+class OutboxEvent(models.Model):
+    """
+    アカウントの変更イベント(トランザクションアウトボックス)．
+    アカウントの保存と同じトランザクションで書き込み，account.outboxのリレーがid順に配信する
+    """
+
+    class Meta(object):
+        db_table = "account_outbox"
+
+    id = models.BigAutoField(primary_key=True)
+    event_type = models.CharField(max_length=64)
+    # アカウントを削除してもイベントは残すため外部キーにしない
+    account_id = models.BigIntegerField()
+    version = models.PositiveIntegerField()
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.id}:{self.event_type}:{self.account_id}"
+
+
+class OutboxCheckpoint(models.Model):
+    """
+    配信先(sink)毎に配信済みの最後のイベントのidと，それより前で欠けているid
+    """
+
+    class Meta(object):
+        db_table = "account_outbox_checkpoint"
+
+    sink = models.CharField(max_length=64, primary_key=True)
+    position = models.BigIntegerField(default=0)
+    # position以下で欠けているidの範囲([最初, 最後, 記録した時刻(UNIX時間)])．現れたら配信する
+    gaps = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.sink}:{self.position}"
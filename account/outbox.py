@@ -0,0 +1,300 @@
+"""
+アカウントの変更イベント(トランザクションアウトボックス，models.OutboxEvent)の配信．
+イベントはAccount.save()がアカウントと同じトランザクションで書き込み，
+リレー(`python manage.py relay_outbox`)が配信先(sink)毎にid順のバッチで配信して，配信済みの位置をOutboxCheckpointに保存する．
+配信に失敗したバッチは間隔を空けて同じ位置から再送するため，同じイベントが重複して届くことがある(受信側はイベントのidで重複を除く)．
+コミットが遅れたイベントはidの順より後に届くことがあるため，アカウント毎の新旧はversionで判断する．
+"""
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Account, OutboxCheckpoint, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+# 配信先毎に記録する欠けたidの範囲の上限(超えたら古いものから諦める)
+MAX_GAPS = 1000
+
+
+def remove_ids(gaps: List[List], ids: List[int]) -> List[List]:
+    """
+    欠けているidの範囲([最初, 最後, 記録した時刻])から，現れたidを除く
+    """
+    remaining = []
+    for first, last, since in gaps:
+        for event_id in sorted(event_id for event_id in ids if first <= event_id <= last):
+            if first < event_id:
+                remaining.append([first, event_id - 1, since])
+            first = event_id + 1
+        if first <= last:
+            remaining.append([first, last, since])
+    return remaining
+
+
+def serialize_event(event: OutboxEvent) -> Dict:
+    return {
+        "id": event.id,
+        "type": event.event_type,
+        "account_id": event.account_id,
+        "version": event.version,
+        "payload": event.payload,
+        "created_at": event.created_at,
+    }
+
+
+def record_created(accounts: List[Account], using: Optional[str] = None) -> List[OutboxEvent]:
+    """
+    bulk_createで作成したアカウント(save()を経由しない)の作成イベントを書き込む．
+    アカウントと同じトランザクションの中で呼び出すこと
+    """
+    events = [
+        OutboxEvent(
+            event_type="account.created",
+            account_id=account.pk,
+            version=account.version,
+            payload=account.outbox_payload(),
+        )
+        for account in accounts
+    ]
+    return OutboxEvent.objects.using(using or "default").bulk_create(events, batch_size=1000)
+
+
+class Sink:
+    """
+    配信先．send()は全てのイベントを受け取った場合のみ正常に戻り，失敗した場合は例外を送出する
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def send(self, events: List[Dict]) -> None:
+        raise NotImplementedError
+
+
+class FileSink(Sink):
+    """
+    1行に1イベントのNDJSONでファイルに追記する
+    """
+
+    def __init__(self, name: str, path: str) -> None:
+        super().__init__(name)
+        self.path = path
+
+    def send(self, events: List[Dict]) -> None:
+        data = "".join(json.dumps(event, cls=DjangoJSONEncoder) + "\n" for event in events)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class HTTPSink(Sink):
+    """
+    {"events": [...]}をJSONでPOSTする．2xx以外の応答と通信エラーは失敗とする
+    """
+
+    def __init__(self, name: str, url: str, timeout: float = 10, headers: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(name)
+        self.url = url
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+
+    def send(self, events: List[Dict]) -> None:
+        body = json.dumps({"events": events}, cls=DjangoJSONEncoder).encode()
+        request = urllib.request.Request(self.url, data=body, headers=self.headers, method="POST")
+        # 4xx / 5xxはHTTPError(URLErrorのサブクラス)になる
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class OutboxRelay:
+    """
+    配信先毎に配信済みの位置から順にbatch_size件ずつ配信する．
+    失敗した配信先はretry_base秒から倍々に(最大retry_max秒)待ってから同じ位置から再送し，他の配信先は止めない．
+    PostgreSQLではidの採番順とコミット順が異なるため，位置より前で欠けているid(コミットが遅れているか，ロールバックされたもの)を
+    配信先毎に記録し，現れたら配信する(idの順より遅れて届く)．gap_timeout秒経っても現れないidはロールバックされたものとみなす．
+    配信先の位置の行をSELECT ... FOR UPDATE SKIP LOCKEDでロックするため，複数のリレーを動かしても同じ配信先には1つだけが配信する
+    (SQLiteには行ロックがないため，リレーは1つだけ動かすこと)
+    """
+
+    def __init__(
+        self,
+        sinks: List[Sink],
+        batch_size: int = 100,
+        gap_timeout: float = 300.0,
+        retry_base: float = 1.0,
+        retry_max: float = 60.0,
+        retention: Optional[timedelta] = None,
+        using: str = "default",
+    ) -> None:
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.retention = retention
+        self.using = using
+        self.delivered: Dict[str, int] = {sink.name: 0 for sink in sinks}
+        self.failures: Dict[str, int] = {sink.name: 0 for sink in sinks}
+        # 現れないまま諦めたidの数
+        self.skipped: Dict[str, int] = {sink.name: 0 for sink in sinks}
+        self._retry_at: Dict[str, float] = {}
+        self._checkpoints_created = False
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_settings(cls, names: Optional[List[str]] = None) -> "OutboxRelay":
+        conf = settings.OUTBOX
+        sinks = []
+        for name, sink_conf in conf["SINKS"].items():
+            if names is None or name in names:
+                sinks.append(import_string(sink_conf["BACKEND"])(name, **sink_conf.get("OPTIONS", {})))
+        return cls(
+            sinks,
+            batch_size=conf["BATCH_SIZE"],
+            gap_timeout=conf["GAP_TIMEOUT_SECONDS"],
+            retry_max=conf["RETRY_MAX_SECONDS"],
+            retention=timedelta(hours=conf["RETENTION_HOURS"]) if conf["RETENTION_HOURS"] else None,
+        )
+
+    def positions(self) -> Dict[str, int]:
+        checkpoints = OutboxCheckpoint.objects.using(self.using).filter(sink__in=[sink.name for sink in self.sinks])
+        positions = {sink.name: 0 for sink in self.sinks}
+        positions.update(checkpoints.values_list("sink", "position"))
+        return positions
+
+    def deliver(self) -> int:
+        """
+        各配信先に1バッチずつ配信し，配信したイベント数の合計を返す．他のリレーが配信中の配信先は飛ばす
+        """
+        if not self._checkpoints_created:
+            # ロックする行を用意しておく
+            OutboxCheckpoint.objects.using(self.using).bulk_create(
+                [OutboxCheckpoint(sink=sink.name) for sink in self.sinks], ignore_conflicts=True
+            )
+            self._checkpoints_created = True
+        total = 0
+        for sink in self.sinks:
+            if time.monotonic() < self._retry_at.get(sink.name, 0):
+                continue
+            with transaction.atomic(using=self.using):
+                checkpoint = (
+                    OutboxCheckpoint.objects.using(self.using)
+                    .select_for_update(skip_locked=True)
+                    .filter(sink=sink.name)
+                    .first()
+                )
+                if checkpoint is not None:
+                    total += self._deliver(sink, checkpoint)
+        return total
+
+    def _deliver(self, sink: Sink, checkpoint: OutboxCheckpoint) -> int:
+        events = OutboxEvent.objects.using(self.using).order_by("id")
+        gaps = self._expire(sink, checkpoint.gaps)
+        late: List[OutboxEvent] = []
+        if gaps:
+            missing = reduce(or_, (Q(id__range=(first, last)) for first, last, _ in gaps))
+            late = list(events.filter(missing)[: self.batch_size])
+        batch = list(events.filter(id__gt=checkpoint.position)[: self.batch_size - len(late)])
+        if not late and not batch:
+            if gaps != checkpoint.gaps:
+                checkpoint.gaps = gaps
+                checkpoint.save(update_fields=["gaps", "updated_at"])
+            return 0
+        try:
+            sink.send([serialize_event(event) for event in late + batch])
+        except Exception:
+            self.failures[sink.name] += 1
+            delay = min(self.retry_base * 2 ** (self.failures[sink.name] - 1), self.retry_max)
+            self._retry_at[sink.name] = time.monotonic() + delay
+            logger.exception("Failed to deliver outbox events to %s (retrying in %.0fs)", sink.name, delay)
+            return 0
+        self.failures[sink.name] = 0
+        self._retry_at.pop(sink.name, None)
+
+        gaps = remove_ids(gaps, [event.id for event in late])
+        now = time.time()
+        previous = checkpoint.position
+        for event in batch:
+            if event.id > previous + 1:
+                gaps.append([previous + 1, event.id - 1, now])
+            previous = event.id
+        if len(gaps) > MAX_GAPS:
+            self._skip(sink, gaps[:-MAX_GAPS])
+            gaps = gaps[-MAX_GAPS:]
+        checkpoint.position = previous
+        checkpoint.gaps = gaps
+        checkpoint.save()
+        self.delivered[sink.name] += len(late) + len(batch)
+        return len(late) + len(batch)
+
+    def _expire(self, sink: Sink, gaps: List[List]) -> List[List]:
+        now = time.time()
+        expired = [gap for gap in gaps if now - gap[2] >= self.gap_timeout]
+        if expired:
+            self._skip(sink, expired)
+        return [gap for gap in gaps if now - gap[2] < self.gap_timeout]
+
+    def _skip(self, sink: Sink, gaps: List[List]) -> None:
+        self.skipped[sink.name] += sum(last - first + 1 for first, last, _ in gaps)
+        logger.warning(
+            "Gave up waiting for outbox events %s for %s",
+            ", ".join(f"{first}-{last}" if first != last else str(first) for first, last, _ in gaps),
+            sink.name,
+        )
+
+    def prune(self) -> int:
+        """
+        retentionより古く，設定された全ての配信先(このリレーが担当していないものも含む)に配信済みのイベントを削除する
+        """
+        if self.retention is None:
+            return 0
+        names = {*settings.OUTBOX["SINKS"], *(sink.name for sink in self.sinks)}
+        checkpoints = OutboxCheckpoint.objects.using(self.using).filter(sink__in=names)
+        positions = dict(checkpoints.values_list("sink", "position"))
+        position = min((positions.get(name, 0) for name in names), default=0)
+        if not position:
+            return 0
+        events = OutboxEvent.objects.using(self.using).filter(
+            id__lte=position, created_at__lt=timezone.now() - self.retention
+        )
+        deleted, _ = events.delete()
+        return deleted
+
+    def run(self, interval: float = 1.0, prune_interval: float = 60.0) -> None:
+        """
+        stop()が呼ばれるまで配信を続ける．配信するイベントがある間は待たずに次のバッチを配信する
+        """
+        pruned_at = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                delivered = self.deliver()
+                if time.monotonic() - pruned_at > prune_interval:
+                    pruned_at = time.monotonic()
+                    self.prune()
+            except Exception:
+                # DBに接続できない場合など．接続を閉じて次の間隔で再試行する
+                logger.exception("Outbox relay failed")
+                delivered = 0
+            finally:
+                connections[self.using].close_if_unusable_or_obsolete()
+            if not delivered:
+                self._stopped.wait(interval)
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,220 @@
+"""
+オンライン状態(プレゼンス)をプロセス内のシャード化したストアで管理する．
+ハートビートはメモリ上で処理し，OnlineUserテーブルには一定間隔でまとめて書き込む．
+オンラインの人数と一覧は全プロセスのハートビートが集まるOnlineUserから求める(人数はflush()毎に数えた値を使う)．
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .flusher import PeriodicFlusher
+
+# flush()で数えたオンラインの人数(PRESENCE["CACHE"]を指定した場合)
+COUNT_KEY = "presence:count"
+
+
+class _Shard:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # user_id -> 最後にハートビートを受けた時刻(time.time())
+        self.last_seen: Dict[int, float] = {}
+        # 前回のフラッシュ以降にハートビートを受けたユーザー
+        self.dirty: Set[int] = set()
+        # 前回のフラッシュ以降に切断したユーザー(OnlineUserの行を削除する)
+        self.disconnected: Set[int] = set()
+
+
+class PresenceStore(PeriodicFlusher):
+    """
+    ハートビートから一定時間(ttl)以内のユーザーをオンラインとみなす．期限切れのエントリはsweep()で取り除く．
+    flush()で変更のあったユーザーをOnlineUserにまとめてupsertし，切断したユーザーと期限切れの行を削除する．
+    count() / online_users()はOnlineUserを参照するため，他プロセスのハートビートはflush_interval秒以内に反映される．
+    count()はリクエスト毎にOnlineUserを数えず，flush()の最後に数えた値(flush_interval秒間有効)を返す．
+    cacheを指定するとハートビートと人数をキャッシュにも複製し，他プロセスのis_online() / count()から参照できる．
+    """
+
+    def __init__(self, ttl=60, shards=16, flush_interval=10, batch_size=1000, cache=None) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.cache_alias = cache
+        self.heartbeats = 0
+        # cacheを指定しない場合の人数のスナップショット(time.monotonic()で数えた時刻，人数)
+        self._count: Optional[Tuple[float, int]] = None
+        self._shards = [_Shard() for _ in range(shards)]
+
+    @classmethod
+    def from_settings(cls) -> "PresenceStore":
+        conf = settings.PRESENCE
+        return cls(
+            ttl=conf["TTL"],
+            shards=conf["SHARDS"],
+            flush_interval=conf["FLUSH_INTERVAL"],
+            batch_size=conf["BATCH_SIZE"],
+            cache=conf["CACHE"],
+        )
+
+    def heartbeat(self, user_id: int) -> None:
+        shard = self._shard(user_id)
+        with shard.lock:
+            shard.last_seen[user_id] = time.time()
+            shard.dirty.add(user_id)
+            shard.disconnected.discard(user_id)
+        self.heartbeats += 1
+        if self._thread is None:
+            self.start()
+
+    def disconnect(self, user_id: int) -> None:
+        shard = self._shard(user_id)
+        with shard.lock:
+            shard.last_seen.pop(user_id, None)
+            shard.dirty.discard(user_id)
+            shard.disconnected.add(user_id)
+        if self.cache_alias:
+            caches[self.cache_alias].delete(self._cache_key(user_id))
+
+    def is_online(self, user_id: int) -> bool:
+        shard = self._shard(user_id)
+        last_seen = shard.last_seen.get(user_id)
+        if last_seen is not None and last_seen > time.time() - self.ttl:
+            return True
+        if self.cache_alias:
+            return caches[self.cache_alias].get(self._cache_key(user_id)) is not None
+        return False
+
+    def count(self) -> int:
+        """
+        全プロセスでttl秒以内にハートビートのあったユーザー数．
+        flush()で数えた値を返し，flush_interval秒以内に数えた値がない場合だけOnlineUserを数える
+        """
+        if self.cache_alias:
+            count = caches[self.cache_alias].get(COUNT_KEY)
+        elif self._count is not None and self._count[0] > time.monotonic() - self.flush_interval:
+            count = self._count[1]
+        else:
+            count = None
+        return self._snapshot_count() if count is None else count
+
+    def online_users(self, limit: Optional[int] = None) -> List[int]:
+        """
+        全プロセスでttl秒以内にハートビートのあったユーザー(最近のものから順)
+        """
+        users = self._online_rows().order_by("-last_seen", "user_id").values_list("user_id", flat=True)
+        return list(users if limit is None else users[:limit])
+
+    def local_count(self) -> int:
+        """
+        このプロセスで受けたハートビートのエントリの数．
+        エントリを走査しないため，前回のsweep()以降に期限切れになったもの(最大flush_interval秒分)を含む
+        """
+        return sum(len(shard.last_seen) for shard in self._shards)
+
+    def sweep(self) -> int:
+        """
+        期限切れのエントリを削除し，削除した件数を返す
+        """
+        threshold = time.time() - self.ttl
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                expired = [user_id for user_id, last_seen in shard.last_seen.items() if last_seen <= threshold]
+                for user_id in expired:
+                    del shard.last_seen[user_id]
+            removed += len(expired)
+        return removed
+
+    def flush(self) -> int:
+        """
+        前回以降にハートビートのあったユーザーをOnlineUserにupsertし，切断したユーザーと期限切れの行を削除する．
+        書き込みに失敗した場合は変更を戻して次回のフラッシュで書き込み直す
+        """
+        self.sweep()
+        changed: Dict[int, float] = {}
+        disconnected: Set[int] = set()
+        for shard in self._shards:
+            with shard.lock:
+                dirty, shard.dirty = shard.dirty, set()
+                gone, shard.disconnected = shard.disconnected, set()
+                changed.update((user_id, shard.last_seen[user_id]) for user_id in dirty if user_id in shard.last_seen)
+            disconnected |= gone
+        try:
+            self._write(changed, disconnected)
+        except Exception:
+            self._restore(changed, disconnected)
+            raise
+        return len(changed)
+
+    def _write(self, changed: Dict[int, float], disconnected: Set[int]) -> None:
+        from .models import Account, OnlineUser
+
+        if self.cache_alias and changed:
+            caches[self.cache_alias].set_many(
+                {self._cache_key(user_id): last_seen for user_id, last_seen in changed.items()}, timeout=self.ttl
+            )
+        gone = list(disconnected)
+        for start in range(0, len(gone), self.batch_size):
+            OnlineUser.objects.filter(user_id__in=gone[start : start + self.batch_size]).delete()
+        items = list(changed.items())
+        for start in range(0, len(items), self.batch_size):
+            batch = dict(items[start : start + self.batch_size])
+            # 削除されたユーザー(有効なトークンが残っている)のハートビートは外部キー制約に違反するため除く
+            existing = Account.objects.filter(id__in=batch).values_list("id", flat=True)
+            OnlineUser.objects.bulk_create(
+                [
+                    OnlineUser(user_id=user_id, last_seen=datetime.fromtimestamp(batch[user_id], dt_timezone.utc))
+                    for user_id in existing
+                ],
+                update_conflicts=True,
+                unique_fields=["user"],
+                update_fields=["last_seen"],
+            )
+        OnlineUser.objects.filter(last_seen__lte=timezone.now() - timedelta(seconds=self.ttl)).delete()
+        self._snapshot_count()
+
+    def _snapshot_count(self) -> int:
+        count = self._online_rows().count()
+        if self.cache_alias:
+            caches[self.cache_alias].set(COUNT_KEY, count, timeout=self.flush_interval)
+        else:
+            self._count = (time.monotonic(), count)
+        return count
+
+    def _restore(self, changed: Dict[int, float], disconnected: Set[int]) -> None:
+        # 取り出した後に新しいハートビート・切断があったユーザーはそちらを優先する
+        for user_id in changed:
+            shard = self._shard(user_id)
+            with shard.lock:
+                if user_id in shard.last_seen:
+                    shard.dirty.add(user_id)
+        for user_id in disconnected:
+            shard = self._shard(user_id)
+            with shard.lock:
+                if user_id not in shard.last_seen:
+                    shard.disconnected.add(user_id)
+
+    def _online_rows(self):
+        from .models import OnlineUser
+
+        return OnlineUser.objects.filter(last_seen__gt=timezone.now() - timedelta(seconds=self.ttl))
+
+    def _shard(self, user_id: int) -> _Shard:
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    def _cache_key(self, user_id: int) -> str:
+        return f"presence:{user_id}"
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        for shard in self._shards:
+            shard.lock = threading.Lock()
+
+
+presence = PresenceStore.from_settings()
+os.register_at_fork(after_in_child=presence._after_fork)
@@ -0,0 +1,203 @@
+"""
+ログイン・登録の試行回数の制限(レートリミット)．
+IPアドレスと対象のメールアドレスをキーに判定し，上限を超えた場合はパスワードのハッシュ計算やDBアクセスの前に
+429(Retry-After付き)を返す．
+既定ではプロセス内のシャード化したトークンバケットで判定し，CACHEを指定するとキャッシュの固定ウィンドウのカウンターで
+他プロセスと回数を共有する．
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .flusher import PeriodicFlusher
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24}
+
+
+def parse_rate(rate: str) -> Tuple[int, int]:
+    """
+    "回数/期間"(期間はs/m/h/dで始まる文字列．DRFのthrottleと同じ形式)を(回数, 秒)にする
+    """
+    num, period = rate.split("/")
+    return int(num), PERIODS[period[0]]
+
+
+class _Shard:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (スコープ, キーの種類, 値) -> (残りのトークン, 更新時刻, トークンが満杯に戻る時刻)．更新の古い順
+        self.buckets: "OrderedDict[Tuple[str, str, str], Tuple[float, float, float]]" = OrderedDict()
+
+
+class RateLimiter(PeriodicFlusher):
+    """
+    hit()は(キーの種類, 値)毎に1回分を消費し，いずれかが上限を超えた場合は再試行できるまでの秒数を返す．
+    トークンが満杯に戻ったバケットはsweep_interval秒毎に削除する．
+    それまでにバケットがmax_keysを超えた場合(多数のメールアドレスを使った試行など)は，シャード毎に更新の古いバケットから削除する．
+    """
+
+    def __init__(self, rates=None, enabled=True, shards=16, cache=None, sweep_interval=60, max_keys=100000) -> None:
+        super().__init__()
+        self.enabled = enabled
+        # スコープ -> キーの種類 -> (回数, 秒)
+        self.rates = {
+            scope: {kind: parse_rate(rate) for kind, rate in kinds.items()} for scope, kinds in (rates or {}).items()
+        }
+        self.cache_alias = cache
+        self.flush_interval = sweep_interval
+        self.max_keys_per_shard = max(max_keys // shards, 1)
+        # (スコープ, キーの種類, "allowed"/"rejected") -> 件数
+        self.counts: Counter = Counter()
+        self.evictions = 0
+        self._shards = [_Shard() for _ in range(shards)]
+
+    @classmethod
+    def from_settings(cls) -> "RateLimiter":
+        conf = settings.RATE_LIMIT
+        return cls(
+            rates=conf["RATES"],
+            enabled=conf["ENABLED"],
+            shards=conf["SHARDS"],
+            cache=conf["CACHE"],
+            sweep_interval=conf["SWEEP_INTERVAL"],
+            max_keys=conf["MAX_KEYS"],
+        )
+
+    def hit(self, scope: str, keys: Iterable[Tuple[str, str]]) -> Optional[float]:
+        if not self.enabled:
+            return None
+        rates = self.rates.get(scope, {})
+        wait: Optional[float] = None
+        for kind, value in keys:
+            rate = rates.get(kind)
+            if rate is None or not value:
+                continue
+            if self.cache_alias:
+                key_wait = self._hit_cache(scope, kind, value, *rate)
+            else:
+                key_wait = self._hit_local(scope, kind, value, *rate)
+            if key_wait is None:
+                self.counts[(scope, kind, "allowed")] += 1
+            else:
+                self.counts[(scope, kind, "rejected")] += 1
+                wait = max(wait or 0.0, key_wait)
+        return wait
+
+    def _hit_local(self, scope: str, kind: str, value: str, capacity: int, period: int) -> Optional[float]:
+        key = (scope, kind, value)
+        refill = capacity / period
+        now = time.monotonic()
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            tokens, updated, _ = shard.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * refill)
+            if tokens >= 1:
+                tokens -= 1
+                wait = None
+            else:
+                wait = (1 - tokens) / refill
+            shard.buckets[key] = (tokens, now, now + (capacity - tokens) / refill)
+            shard.buckets.move_to_end(key)
+            if len(shard.buckets) > self.max_keys_per_shard:
+                shard.buckets.popitem(last=False)
+                self.evictions += 1
+        if self._thread is None:
+            self.start()
+        return wait
+
+    def _hit_cache(self, scope: str, kind: str, value: str, capacity: int, period: int) -> Optional[float]:
+        cache = caches[self.cache_alias]
+        now = time.time()
+        window = int(now // period)
+        # メールアドレスをそのままキャッシュのキーにしない
+        digest = hashlib.sha256(value.encode()).hexdigest()[:32]
+        key = f"ratelimit:{scope}:{kind}:{digest}:{window}"
+        cache.add(key, 0, period + 1)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # addとincrの間に期限切れになった
+            cache.add(key, 1, period + 1)
+            count = 1
+        if count > capacity:
+            return (window + 1) * period - now
+        return None
+
+    def count(self) -> int:
+        return sum(len(shard.buckets) for shard in self._shards)
+
+    def flush(self) -> int:
+        """
+        トークンが満杯に戻ったバケットを削除し，削除した件数を返す
+        """
+        now = time.monotonic()
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                full = [key for key, (_, _, full_at) in shard.buckets.items() if full_at <= now]
+                for key in full:
+                    del shard.buckets[key]
+            removed += len(full)
+        return removed
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        for shard in self._shards:
+            shard.lock = threading.Lock()
+
+
+rate_limiter = RateLimiter.from_settings()
+os.register_at_fork(after_in_child=rate_limiter._after_fork)
+
+
+class RateLimitThrottle(BaseThrottle):
+    """
+    IPアドレスとリクエストのemailをキーにrate_limiterで判定するthrottle．
+    非同期版のビュー(AsyncAPIView)でも使えるよう，request.dataのみを参照する
+    """
+
+    scope = ""
+
+    def allow_request(self, request, view) -> bool:
+        self.wait_time = rate_limiter.hit(self.scope, self.get_keys(request))
+        return self.wait_time is None
+
+    def get_ident(self, request) -> str:
+        """
+        クライアントのIPアドレス．DRFのget_identはNUM_PROXIESが未設定の場合にX-Forwarded-Forをそのまま使い，
+        クライアントが任意の値を送って制限を回避できるため，REMOTE_ADDRを使う．
+        NUM_PROXIESを設定した場合のみ，X-Forwarded-Forの右からNUM_PROXIES番目(最も外側のプロキシが追加した値)を使う
+        """
+        num_proxies = api_settings.NUM_PROXIES
+        if num_proxies:
+            forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+            addrs = [addr.strip() for addr in forwarded.split(",") if addr.strip()]
+            if addrs:
+                return addrs[-min(num_proxies, len(addrs))]
+        return request.META.get("REMOTE_ADDR", "")
+
+    def get_keys(self, request) -> List[Tuple[str, str]]:
+        keys = [("ip", self.get_ident(request))]
+        email = request.data.get("email") if hasattr(request.data, "get") else None
+        if isinstance(email, str):
+            keys.append(("email", email.strip().lower()))
+        return keys
+
+    def wait(self) -> Optional[float]:
+        return self.wait_time
+
+
+class LoginRateThrottle(RateLimitThrottle):
+    scope = "login"
+
+
+class RegisterRateThrottle(RateLimitThrottle):
+    scope = "register"
@@ -0,0 +1,254 @@
+"""
+失効させたトークン(jti)のストア．
+判定はプロセス内の辞書を参照するだけ(O(1))で，DBにはアクセスしない．
+失効はキャッシュに連番付きで記録し，各プロセスは一定間隔で差分を取り込んで同期する．
+新しいプロセスは記録を最初から読まず，キャッシュのスナップショット(ある連番までの有効な失効)を読み込んでから以降の記録を取り込む．
+スナップショットは前回からの差分のチャンクを追加していくため，保存の費用は全体の件数ではなく差分の件数に比例する．
+エントリはトークン自身のexpを過ぎたら削除する(expの順のヒープで期限切れのものだけを取り出す)．
+"""
+import heapq
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .flusher import PeriodicFlusher
+
+SEQUENCE_KEY = "revocation:sequence"
+# (連番, [(チャンクのキー, チャンクのexpの最大値)])．チャンクは"revocation:snapshot:<保存時の連番>:<番号>"に
+# [(jti, exp)]として保存し，以降のスナップショットでは期限切れになるまで同じチャンクを参照する
+SNAPSHOT_KEY = "revocation:snapshot"
+SNAPSHOT_LOCK_KEY = "revocation:snapshot:lock"
+# 同期時に1回のget_manyで取得する件数(スナップショットの1チャンクの件数)
+SYNC_BATCH_SIZE = 1000
+# 連番を取得してから記録を書き込むまでの間の連番は，見つからなくてもMISSING_TIMEOUT秒まで取り込み直す．
+# 最新からMISSING_WINDOW件より前の連番が見つからないのは期限切れのため，取り込み直さない
+MISSING_WINDOW = 100
+MISSING_TIMEOUT = 60
+
+
+class RevocationStore(PeriodicFlusher):
+    """
+    revoke()はキャッシュのadd(アトミック)で記録するため，複数のプロセスで同じjtiを失効させても成功するのは1回だけ．
+    他のプロセスで失効させたjtiはsync_interval秒以内に取り込まれる．
+    前回のスナップショットから失効がsnapshot_every件以上増えると，いずれか1つのプロセスがスナップショットを保存し直す．
+    キャッシュはプロセス間で共有するもの(Redis等)であること(checks.check_revocation_cache)．
+    """
+
+    def __init__(self, cache="default", sync_interval=5, snapshot_every=1000) -> None:
+        super().__init__()
+        self.cache_alias = cache
+        self.flush_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        # jti -> exp(UNIX時刻)
+        self._revoked: Dict[str, float] = {}
+        # (exp, jti)のヒープ(compact()で期限切れのものから取り出す)
+        self._expiry: List[Tuple[float, str]] = []
+        self._revoked_lock = threading.Lock()
+        # 取り込み済みの連番
+        self._sequence = 0
+        # 記録がまだ見つからない連番 -> 最初に見つからなかった時刻
+        self._missing: Dict[int, float] = {}
+        self._snapshot_loaded = False
+        # まだスナップショットに含まれていない記録(連番 -> (jti, exp))．_pending_since以降の連番を全て持つ
+        self._pending: Dict[int, Tuple[str, float]] = {}
+        self._pending_since = 0
+
+    @classmethod
+    def from_settings(cls) -> "RevocationStore":
+        conf = settings.TOKEN_REVOCATION
+        return cls(cache=conf["CACHE"], sync_interval=conf["SYNC_INTERVAL"], snapshot_every=conf["SNAPSHOT_EVERY"])
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def is_revoked(self, jti: str) -> bool:
+        if self._thread is None:
+            # 起動前に失効させたjtiを取り込んでから判定する
+            self.sync()
+            self.start()
+        return jti in self._revoked
+
+    def revoke(self, jti: str, exp: float) -> bool:
+        """
+        jtiを失効させる．既に失効していた場合はFalseを返す
+        """
+        timeout = int(exp - time.time()) + 1
+        if timeout <= 0:
+            return True
+        with self._revoked_lock:
+            if jti in self._revoked:
+                return False
+            self._add(jti, exp)
+        if not self.cache.add(f"revocation:jti:{jti}", exp, timeout):
+            # 他のプロセスで失効済み
+            return False
+
+        self.cache.add(SEQUENCE_KEY, 0, None)
+        sequence = self.cache.incr(SEQUENCE_KEY)
+        self.cache.set(f"revocation:{sequence}", (jti, exp), timeout)
+        if self._thread is None:
+            self.start()
+        return True
+
+    def count(self) -> int:
+        return len(self._revoked)
+
+    def flush(self) -> None:
+        """
+        他のプロセスで失効させたjtiを取り込み，期限切れのエントリを削除してから，必要ならスナップショットを保存する
+        """
+        self.sync()
+        self.compact()
+        self.save_snapshot()
+
+    def sync(self) -> int:
+        if not self._snapshot_loaded:
+            self._snapshot_loaded = True
+            self.load_snapshot()
+        latest = self.cache.get(SEQUENCE_KEY, 0)
+        if latest < self._sequence:
+            # キャッシュが消えて連番が振り直された
+            self._sequence = 0
+            self._missing.clear()
+            self._pending.clear()
+            self._pending_since = 0
+        added = self._fetch(sorted(self._missing), latest)
+        if latest > self._sequence:
+            added += self._fetch(range(self._sequence + 1, latest + 1), latest)
+            self._sequence = latest
+        now = time.monotonic()
+        for sequence, missing_since in list(self._missing.items()):
+            if now - missing_since > MISSING_TIMEOUT:
+                del self._missing[sequence]
+        return added
+
+    def _fetch(self, sequences: Iterable[int], latest: int) -> int:
+        """
+        連番の記録を取り込む．期限切れの記録はキャッシュから消えているため取得されない
+        """
+        sequences = list(sequences)
+        added = 0
+        now = time.time()
+        for start in range(0, len(sequences), SYNC_BATCH_SIZE):
+            batch = sequences[start : start + SYNC_BATCH_SIZE]
+            found = self.cache.get_many([f"revocation:{sequence}" for sequence in batch])
+            with self._revoked_lock:
+                for sequence in batch:
+                    entry = found.get(f"revocation:{sequence}")
+                    if entry is None:
+                        if sequence > latest - MISSING_WINDOW:
+                            self._missing.setdefault(sequence, time.monotonic())
+                        continue
+                    self._missing.pop(sequence, None)
+                    if sequence > self._pending_since:
+                        self._pending[sequence] = entry
+                    jti, exp = entry
+                    if jti not in self._revoked and exp > now:
+                        self._add(jti, exp)
+                        added += 1
+        return added
+
+    def load_snapshot(self) -> bool:
+        """
+        スナップショットを読み込み，その連番から先の記録だけを取り込めるようにする．
+        スナップショットがない(または一部が追い出された)場合はFalseを返し，記録を最初から取り込む
+        """
+        for _ in range(2):
+            header: Optional[Tuple[int, List[Tuple[str, float]]]] = self.cache.get(SNAPSHOT_KEY)
+            if header is None:
+                return False
+            sequence, chunk_list = header
+            now = time.time()
+            # 全てのエントリが期限切れのチャンクはキャッシュから消えていてよい
+            keys = [key for key, exp in chunk_list if exp > now]
+            chunks = self.cache.get_many(keys)
+            if len(chunks) < len(keys):
+                # 読み込む間に新しいスナップショットに置き換えられた場合は読み直す
+                continue
+            with self._revoked_lock:
+                for chunk in chunks.values():
+                    for jti, exp in chunk:
+                        if exp > now and jti not in self._revoked:
+                            self._add(jti, exp)
+            if sequence > self._sequence:
+                self._sequence = sequence
+                self._pending.clear()
+                self._pending_since = sequence
+            return True
+        return False
+
+    def save_snapshot(self) -> bool:
+        """
+        前回のスナップショットから失効がsnapshot_every件以上増えている場合に，スナップショットを保存する．
+        前回のスナップショットに含まれない記録だけを新しいチャンクとして追加し，期限切れのチャンクは参照から外す．
+        前回以降の記録を全て持っていない(スナップショットが追い出された等)場合は取り込み済みの失効から作り直す
+        """
+        # 記録が見つからない連番からは，新しいプロセスが取り込み直せるようにする
+        sequence = min(self._missing, default=self._sequence + 1) - 1
+        header = self.cache.get(SNAPSHOT_KEY)
+        base = header[0] if header else 0
+        if base >= self._pending_since:
+            # 他のプロセスが保存したスナップショットに含まれる記録は持たない
+            self._pending = {seq: entry for seq, entry in self._pending.items() if seq > base}
+            self._pending_since = base
+        if sequence - base < self.snapshot_every:
+            return False
+        # 同時に保存するのは1つのプロセスだけにする
+        if not self.cache.add(SNAPSHOT_LOCK_KEY, os.getpid(), 60):
+            return False
+        try:
+            now = time.time()
+            if base >= self._pending_since:
+                entries = [entry for seq, entry in self._pending.items() if seq <= sequence and entry[1] > now]
+                chunk_list = [(key, exp) for key, exp in (header[1] if header else []) if exp > now]
+            else:
+                with self._revoked_lock:
+                    entries = list(self._revoked.items())
+                chunk_list = []
+            # expの順に分けると古いチャンクから丸ごと期限切れになる
+            entries.sort(key=lambda entry: entry[1])
+            for i, start in enumerate(range(0, len(entries), SYNC_BATCH_SIZE)):
+                chunk = entries[start : start + SYNC_BATCH_SIZE]
+                key, exp = f"{SNAPSHOT_KEY}:{sequence}:{i}", chunk[-1][1]
+                self.cache.set(key, chunk, int(exp - now) + 1)
+                chunk_list.append((key, exp))
+            # 連番は全ての失効が期限切れになっても必要なため，ヘッダーは期限なしで保存する
+            self.cache.set(SNAPSHOT_KEY, (sequence, chunk_list), None)
+            if header and base < self._pending_since:
+                self.cache.delete_many([key for key, _ in header[1]])
+            self._pending = {seq: entry for seq, entry in self._pending.items() if seq > sequence}
+            self._pending_since = sequence
+        finally:
+            self.cache.delete(SNAPSHOT_LOCK_KEY)
+        return True
+
+    def compact(self) -> int:
+        """
+        expを過ぎたエントリを削除する(期限切れの件数に比例し，全体は走査しない)
+        """
+        now = time.time()
+        removed = 0
+        with self._revoked_lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, jti = heapq.heappop(self._expiry)
+                if self._revoked.pop(jti, None) is not None:
+                    removed += 1
+        return removed
+
+    def _add(self, jti: str, exp: float) -> None:
+        # _revoked_lockを取得して呼び出す
+        self._revoked[jti] = exp
+        heapq.heappush(self._expiry, (exp, jti))
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        self._revoked_lock = threading.Lock()
+
+
+revocations = RevocationStore.from_settings()
+os.register_at_fork(after_in_child=revocations._after_fork)
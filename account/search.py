@@ -0,0 +1,373 @@
+"""
+ユーザー名・メールアドレスの検索(前方一致によるオートコンプリートとトライグラムによるあいまい検索)．
+PostgreSQLではLOWER(...)のtext_pattern_opsインデックスとpg_trgmのGINインデックス，
+SQLiteではLOWER(...)のインデックスとFTS5(trigramトークナイザー)の仮想テーブルを使う(migrations/0006参照)．
+前方一致の結果は接頭辞のトライ(PrefixTrie)にプロセス内でキャッシュする．
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from django.conf import settings
+from django.contrib.postgres.lookups import TrigramSimilar
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.db.models import Case, Value, When
+from django.db.models.functions import Greatest, Length, Lower
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Account
+
+# 検索語の最大長(これより長い部分は無視する)
+MAX_QUERY_LENGTH = 64
+# SQLiteのあいまい検索で，FTS5から取得する候補の数(件数の倍数)
+FUZZY_CANDIDATES = 5
+
+# SQLiteのFTS5の仮想テーブル(account_search)をaccountと同期するトリガー(migrations/0006と同じ)．
+# SQLiteではテーブルを作り直すマイグレーション(カラムの追加など)でトリガーが削除されるため，post_migrateでも作成する
+SQLITE_SEARCH_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS account_search_insert AFTER INSERT ON account BEGIN "
+    "INSERT INTO account_search(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "CREATE TRIGGER IF NOT EXISTS account_search_delete AFTER DELETE ON account BEGIN "
+    "INSERT INTO account_search(account_search, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); END",
+    "CREATE TRIGGER IF NOT EXISTS account_search_update AFTER UPDATE OF username, email ON account BEGIN "
+    "INSERT INTO account_search(account_search, rowid, username, email) "
+    "VALUES ('delete', old.id, old.username, old.email); "
+    "INSERT INTO account_search(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+]
+
+
+class SearchResult(NamedTuple):
+    """
+    検索結果の1件(AccountReadSerializerでそのままシリアライズできる)
+    """
+
+    id: int
+    username: str
+    email: str
+    image: Optional[str]
+
+    def matches(self, prefix: str) -> bool:
+        return self.username.lower().startswith(prefix) or self.email.lower().startswith(prefix)
+
+
+RESULT_FIELDS = SearchResult._fields
+
+
+def normalize(query: str) -> str:
+    return query.strip().lower()[:MAX_QUERY_LENGTH]
+
+
+def trigrams(value: str) -> Set[str]:
+    """
+    pg_trgmと同じく，単語毎に前に空白2つ・後に空白1つを付けて3文字ずつに分ける
+    """
+    grams: Set[str] = set()
+    for word in re.findall(r"\w+", value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    pg_trgmのsimilarity()と同じ(共通するトライグラムの割合)
+    """
+    grams_a, grams_b = trigrams(a), trigrams(b)
+    union = grams_a | grams_b
+    return len(grams_a & grams_b) / len(union) if union else 0.0
+
+
+def rank_prefix(query: str, results: List[SearchResult]) -> List[SearchResult]:
+    """
+    完全一致，ユーザー名の前方一致，メールアドレスの前方一致の順に，短いユーザー名を先に並べる
+    """
+
+    def key(result: SearchResult):
+        username, email = result.username.lower(), result.email.lower()
+        return (username != query and email != query, not username.startswith(query), len(username), username)
+
+    return sorted(results, key=key)
+
+
+class _Entry:
+    __slots__ = ("results", "limit", "expires")
+
+    def __init__(self, results: List[SearchResult], limit: int, expires: float) -> None:
+        self.results = results
+        self.limit = limit
+        self.expires = expires
+
+    @property
+    def complete(self) -> bool:
+        # limit件未満の場合は，その接頭辞に一致する全件を含む
+        return len(self.results) < self.limit
+
+
+class _Node:
+    __slots__ = ("children", "entry")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        self.entry: Optional[_Entry] = None
+
+
+class PrefixTrie:
+    """
+    前方一致の検索結果を接頭辞のトライに保持する．
+    結果が全件(complete)の接頭辞があれば，それより長い接頭辞の結果はその絞り込みで求められるためDBにアクセスしない．
+    保持する接頭辞がmax_entriesを超えたら最も長く使われていないものから削除する．
+    他プロセスでの登録・変更はttl秒以内に反映される(同じプロセスでの保存は即座に破棄する)．
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 30) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._root = _Node()
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "PrefixTrie":
+        conf = settings.ACCOUNT_SEARCH
+        return cls(max_entries=conf["CACHE_SIZE"], ttl=conf["CACHE_TTL"])
+
+    def get(self, prefix: str, limit: int) -> Optional[List[SearchResult]]:
+        """
+        prefixに一致する結果(最大limit件，順不同)を返す．キャッシュから求められない場合はNone
+        """
+        now = time.monotonic()
+        with self._lock:
+            found = None
+            node = self._root
+            for depth, char in enumerate(prefix, start=1):
+                node = node.children.get(char)  # type: ignore[assignment]
+                if node is None:
+                    break
+                entry = node.entry
+                if entry is None or entry.expires <= now:
+                    continue
+                if entry.complete or (depth == len(prefix) and entry.limit >= limit):
+                    found = (prefix[:depth], entry)
+            if found is None:
+                self.misses += 1
+                return None
+            key, entry = found
+            self._lru.move_to_end(key)
+            self.hits += 1
+        if key == prefix:
+            return entry.results
+        return [result for result in entry.results if result.matches(prefix)]
+
+    def set(self, prefix: str, results: List[SearchResult], limit: int) -> None:
+        if self.max_entries <= 0 or not prefix:
+            return
+        with self._lock:
+            node = self._root
+            for char in prefix:
+                node = node.children.setdefault(char, _Node())
+            node.entry = _Entry(results, limit, time.monotonic() + self.ttl)
+            self._lru[prefix] = None
+            self._lru.move_to_end(prefix)
+            while len(self._lru) > self.max_entries:
+                oldest, _ = self._lru.popitem(last=False)
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, value: str) -> None:
+        """
+        valueの接頭辞(valueに一致し得る全ての接頭辞)の結果を破棄する
+        """
+        with self._lock:
+            cached = []
+            node = self._root
+            for depth, char in enumerate(value, start=1):
+                node = node.children.get(char)  # type: ignore[assignment]
+                if node is None:
+                    break
+                if node.entry is not None:
+                    cached.append(value[:depth])
+            for prefix in reversed(cached):
+                del self._lru[prefix]
+                self._remove(prefix)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._root = _Node()
+            self._lru.clear()
+
+    def count(self) -> int:
+        return len(self._lru)
+
+    def _remove(self, prefix: str) -> None:
+        # 結果を削除し，子も結果も持たなくなったノードを取り除く
+        path = [self._root]
+        for char in prefix:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].entry = None
+        for depth in range(len(prefix), 0, -1):
+            node = path[depth]
+            if node.children or node.entry is not None:
+                break
+            del path[depth - 1].children[prefix[depth - 1]]
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+
+prefix_cache = PrefixTrie.from_settings()
+os.register_at_fork(after_in_child=prefix_cache._after_fork)
+
+
+class SearchEngine:
+    """
+    前方一致とあいまい検索のクエリ(データベース毎に実装する)
+    """
+
+    def __init__(self, using: str) -> None:
+        self.using = using
+
+    def queryset(self):
+        return Account.objects.using(self.using).filter(is_active=True)
+
+    def prefix(self, query: str, limit: int) -> List[SearchResult]:
+        """
+        ユーザー名・メールアドレスのそれぞれについて，前方一致する最大limit件をrank_prefix()の順で返す．
+        上位limit件をDBで選ぶため，並べ替えは一致した行全てに対して行う(キーの順で切り出すと短いユーザー名が漏れる)
+        """
+        results: Dict[int, SearchResult] = {}
+        username = Lower("username")
+        ordering = [Case(When(key=query, then=Value(0)), default=Value(1)), Length(username), username]
+        for field in ("username", "email"):
+            rows = self.prefix_queryset(field, query).order_by(*ordering).values_list(*RESULT_FIELDS)[:limit]
+            for row in rows:
+                results.setdefault(row[0], SearchResult(*row))
+        return list(results.values())
+
+    def prefix_queryset(self, field: str, query: str):
+        raise NotImplementedError
+
+    def fuzzy(self, query: str, limit: int) -> List[SearchResult]:
+        raise NotImplementedError
+
+
+class PostgresSearchEngine(SearchEngine):
+    """
+    LOWER(...)のtext_pattern_opsインデックスで前方一致，pg_trgmのGINインデックス(%演算子)であいまい検索を行う．
+    あいまい検索のしきい値はpg_trgm.similarity_threshold(既定は0.3)
+    """
+
+    def prefix_queryset(self, field: str, query: str):
+        return self.queryset().alias(key=Lower(field)).filter(key__startswith=query)
+
+    def fuzzy(self, query: str, limit: int) -> List[SearchResult]:
+        username, email = Lower("username"), Lower("email")
+        rows = (
+            self.queryset()
+            .filter(TrigramSimilar(username, query) | TrigramSimilar(email, query))
+            .annotate(similarity=Greatest(TrigramSimilarity(username, query), TrigramSimilarity(email, query)))
+            .order_by("-similarity", "id")
+            .values_list(*RESULT_FIELDS)[:limit]
+        )
+        return [SearchResult(*row) for row in rows]
+
+
+class SQLiteSearchEngine(SearchEngine):
+    """
+    LOWER(...)のインデックスの範囲検索で前方一致，FTS5(trigram)で候補を絞ってからトライグラムの類似度であいまい検索を行う
+    """
+
+    def prefix_queryset(self, field: str, query: str):
+        # LIKEはインデックスを使えないため，[query, queryの最後の文字を1つ進めた文字列)の範囲で検索する
+        upper = query[:-1] + chr(ord(query[-1]) + 1)
+        return self.queryset().alias(key=Lower(field)).filter(key__gte=query, key__lt=upper)
+
+    def fuzzy(self, query: str, limit: int) -> List[SearchResult]:
+        terms = ['"{}"'.format(query[i : i + 3].replace('"', '""')) for i in range(len(query) - 2)]
+        if not terms:
+            return []
+        # 連続するトライグラムをANDでまとめ，まとまりのいずれかを含む行を候補にする．
+        # 1文字の誤りで含まれなくなるトライグラムは最大3つのため，長い検索語ほど大きくまとめても候補から漏れにくく，
+        # 多くの行に含まれるトライグラムだけで一致する行(順位付けのコストが大きい)を減らせる
+        size = 1 if len(terms) <= 3 else 2 if len(terms) <= 6 else 3
+        groups = {" AND ".join(terms[i : i + size]) for i in range(len(terms) - size + 1)}
+        match = " OR ".join(f"({group})" for group in sorted(groups))
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                "SELECT rowid FROM account_search WHERE account_search MATCH %s ORDER BY rank LIMIT %s",
+                [match, limit * FUZZY_CANDIDATES],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+
+        threshold = settings.ACCOUNT_SEARCH["FUZZY_THRESHOLD"]
+        scored = []
+        for row in self.queryset().filter(id__in=ids).values_list(*RESULT_FIELDS):
+            result = SearchResult(*row)
+            score = max(similarity(query, result.username), similarity(query, result.email))
+            if score >= threshold:
+                scored.append((-score, result.id, result))
+        return [result for _, _, result in sorted(scored)[:limit]]
+
+
+def get_engine(using: str) -> SearchEngine:
+    if connections[using].vendor == "postgresql":
+        return PostgresSearchEngine(using)
+    return SQLiteSearchEngine(using)
+
+
+def search_accounts(query: str, limit: int) -> List[SearchResult]:
+    """
+    前方一致の結果を先に並べ，limit件に満たない場合はあいまい検索の結果で補う
+    """
+    query = normalize(query)
+    if not query:
+        return []
+    engine = get_engine(router.db_for_read(Account))
+    results = prefix_cache.get(query, limit)
+    if results is None:
+        results = engine.prefix(query, limit)
+        prefix_cache.set(query, results, limit)
+    results = rank_prefix(query, results)[:limit]
+
+    # 完全一致した場合は入力し終えたとみなし，あいまい検索は行わない
+    exact = any(query in (result.username.lower(), result.email.lower()) for result in results)
+    if not exact and len(results) < limit and len(query) >= settings.ACCOUNT_SEARCH["MIN_FUZZY_LENGTH"]:
+        found = {result.id for result in results}
+        results += [result for result in engine.fuzzy(query, limit) if result.id not in found][: limit - len(results)]
+    return results
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_prefix_cache(sender, instance, **kwargs):
+    """
+    保存・削除したユーザーに一致し得る接頭辞のキャッシュを破棄する
+    (ユーザー名を変更した場合の変更前の接頭辞はttlで失効する)
+    """
+    prefix_cache.invalidate(instance.username.lower())
+    prefix_cache.invalidate(instance.email.lower())
+
+
+def ensure_sqlite_triggers(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrateで，テーブルの作り直しにより削除されたFTS5の同期用のトリガーを作成し直す
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite" or "account_search" not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        for sql in SQLITE_SEARCH_TRIGGERS:
+            cursor.execute(sql)
@@ -1,12 +1,19 @@
+from typing import Any, Dict
+
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 
+from .images import variant_urls
 from .models import Account
 
 
 class AccountSerializer(serializers.ModelSerializer):
+    image_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = Account
-        fields = ["id", "username", "email", "password", "image"]
+        fields = ["id", "username", "email", "password", "image", "image_variants"]
+        extra_kwargs: Dict[str, Dict[str, Any]] = {"password": {"write_only": True}}
 
     def create(self, validated_data):
         user = Account(
@@ -17,3 +24,61 @@ class AccountSerializer(serializers.ModelSerializer):
         user.image = validated_data.get("image")
         user.save()
         return user
+
+    def get_image_variants(self, obj) -> Dict[str, str]:
+        return variant_urls(obj.image)
+
+
+class AccountReadSerializer(serializers.Serializer):
+    """
+    レスポンス専用の軽量なシリアライザー．
+    フィールドはスキーマ生成のためだけに宣言し，to_representationではフィールドを経由せずに辞書を組み立てる
+    """
+
+    id = serializers.IntegerField(read_only=True)
+    username = serializers.CharField(read_only=True)
+    email = serializers.EmailField(read_only=True)
+    image = serializers.URLField(read_only=True, allow_null=True)
+    image_variants = serializers.DictField(child=serializers.CharField(), read_only=True)
+
+    def to_representation(self, instance):
+        return {
+            "id": instance.id,
+            "username": instance.username,
+            "email": instance.email,
+            "image": instance.image,
+            "image_variants": variant_urls(instance.image),
+        }
+
+
+def check_conflicts(conflicts):
+    """
+    Account.objects.find_conflictsの結果を登録時のエラーに変換する
+    """
+    if "username" in conflicts:
+        raise serializers.ValidationError("This username has already used")
+    if "email" in conflicts:
+        raise serializers.ValidationError("This email has already used")
+
+
+class AccountRegisterSerializer(AccountSerializer):
+    """
+    一意性の検証(UniqueValidator)を行わないAccountSerializer．
+    ユーザー名・メールアドレスの重複は呼び出し側でfind_conflictsを使って1回のクエリで確認し，
+    同時登録による重複はDBの一意制約(IntegrityError)で検出する．
+    """
+
+    class Meta(AccountSerializer.Meta):
+        extra_kwargs: Dict[str, Dict[str, Any]] = {
+            **AccountSerializer.Meta.extra_kwargs,
+            "username": {"validators": []},
+            "email": {"validators": []},
+        }
+
+    def create(self, validated_data):
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError:
+            check_conflicts(Account.objects.find_conflicts(validated_data["username"], validated_data["email"]))
+            raise
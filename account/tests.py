@@ -0,0 +1,1637 @@
+import csv
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, path, resolve
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from drf_spectacular.drainage import GENERATOR_STATS
+from PIL import Image
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config import schema, urls as config_urls
+from config.authenticate import TokenCache, token_cache
+from config.dbrouter import PrimaryReplicaRouter, StickyUsers, read_replica
+from config.metrics import MetricsRegistry, archive_snapshot, registry
+from config.middleware import InstrumentationMiddleware, MiddlewareProfiles, QueryBudgetMiddleware, SameSiteMiddleware
+from config.querybudget import QueryBudgetExceeded, query_budget, sql_shape
+from config.renderers import ORJSONParser, ORJSONRenderer
+from config.server import PreforkServer
+
+from . import flusher, urls as account_urls
+from .activity import LoginActivityBuffer, login_activity
+from .async_views import AsyncGetAccountInfo, AsyncTokenObtainView
+from .checks import check_revocation_cache, check_token_cache, check_version_cache
+from .flusher import PeriodicFlusher
+from .hashers import HashingPool, HashingPoolBusy, hashing_pool
+from .images import ImageVariantPool, generate_variants, variant_pool
+from .models import Account, OnlineUser, OutboxCheckpoint, OutboxEvent
+from .outbox import OutboxRelay, Sink, remove_ids
+from .presence import PresenceStore
+from .ratelimit import LoginRateThrottle, RateLimiter
+from .revocation import SEQUENCE_KEY, RevocationStore, revocations
+from .search import prefix_cache
+from .versions import account_versions, add_version_headers
+
+PASSWORD = "correct-horse-battery"
+
+
+async def thread_view(request):
+    count = await Account.objects.acount()
+    response = JsonResponse({"thread": threading.get_ident(), "count": count})
+    response.set_cookie("probe", "1")
+    return response
+
+
+@query_budget(2)
+def budget_view(request):
+    # アカウントを1件ずつ取得する(N+1)
+    ids = list(Account.objects.order_by("id").values_list("id", flat=True))
+    return JsonResponse({"usernames": [Account.objects.get(id=pk).username for pk in ids]})
+
+
+# テスト用のビューを使うテストのROOT_URLCONF
+urlpatterns = [
+    path("api/v1/thread/", thread_view),
+    path("thread/", thread_view),
+    path("api/v1/budget/", budget_view),
+]
+
+
+def record_thread(cls, name, threads):
+    """
+    cls.nameを呼び出したスレッドをthreads[cls.__name__]に記録する
+    """
+    original = getattr(cls, name)
+
+    def wrapper(self, *args):
+        threads[cls.__name__] = threading.get_ident()
+        return original(self, *args)
+
+    return mock.patch.object(cls, name, wrapper)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    # TestCaseではatomicがSAVEPOINTになりクエリ数が本番と変わるため，クエリバジェットは確認しない
+    QUERY_BUDGET={"MODE": "off", "N_PLUS_ONE_THRESHOLD": 3},
+)
+class AccountTestCase(TestCase):
+    """
+    プロセス内のキャッシュをテスト毎に空にし，パスワードのハッシュには高速なMD5を使う
+    """
+
+    def setUp(self):
+        token_cache.clear()
+
+    def tearDown(self):
+        # 終了時(テスト用のDBの削除後)にフラッシュされないよう，バッファの内容をテストの中で書き込む
+        login_activity.flush()
+
+    def create_account(self, username="alice", **extra_fields):
+        data = {"username": username, "email": f"{username}@example.com", "password": PASSWORD}
+        return Account.objects.create_user(data, **extra_fields)
+
+    def login(self, account, client=None):
+        client = client or self.client
+        res = client.post(
+            "/api/v1/login/", {"email": account.email, "password": PASSWORD}, content_type="application/json"
+        )
+        self.assertEqual(res.status_code, 200)
+        return res
+
+
+class TokenCacheTests(AccountTestCase):
+    def test_second_request_skips_user_lookup(self):
+        self.login(self.create_account())
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.client.get("/api/v1/users/").status_code, 200)
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(self.client.get("/api/v1/users/").status_code, 200)
+        self.assertEqual(len(second), len(first) - 1)
+        self.assertEqual(token_cache.stats()["hits"], 1)
+
+    def test_saving_user_invalidates_cached_tokens(self):
+        account = self.create_account()
+        self.login(account)
+        self.client.get("/api/v1/users/")
+        self.assertEqual(token_cache.stats()["size"], 1)
+        account.is_active = False
+        account.save()
+        self.assertEqual(token_cache.stats()["size"], 0)
+        self.assertEqual(self.client.get("/api/v1/users/").status_code, 401)
+
+    def test_expired_and_evicted_entries(self):
+        cache = TokenCache(max_size=2)
+        user = Account(id=1)
+        cache.set("expired", user, {"exp": time.time() - 1})
+        self.assertIsNone(cache.get("expired"))
+        for raw_token in ("a", "b", "c"):
+            cache.set(raw_token, user, {"exp": time.time() + 60})
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_save_in_another_process_invalidates_entry(self):
+        # 同じ共有キャッシュを使う2つのワーカーのトークンのキャッシュ
+        worker_a, worker_b = TokenCache(10, cache="default", timeout=60), TokenCache(10, cache="default", timeout=60)
+        account = self.create_account()
+        token = {"exp": time.time() + 60}
+        worker_b.set("token", account, token, worker_b.generation(account.pk))
+        self.assertIsNotNone(worker_b.get("token"))
+        worker_a.invalidate_user(account.pk)
+        self.assertIsNone(worker_b.get("token"))
+        # 世代を進めた後に取得したユーザーは使える
+        worker_b.set("token", account, token, worker_b.generation(account.pk))
+        self.assertIsNotNone(worker_b.get("token"))
+
+    def test_returns_copy_of_cached_user(self):
+        cache = TokenCache(10)
+        account = self.create_account()
+        cache.set("token", account, {"exp": time.time() + 60})
+        account.username = "changed"
+        first, _ = cache.get("token")
+        first.username = "changed again"
+        second, _ = cache.get("token")
+        self.assertIsNot(first, second)
+        self.assertEqual(second.username, "alice")
+
+    def test_check_requires_shared_cache_with_workers(self):
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        with override_settings(CACHES=locmem, SERVER={**settings.SERVER, "WORKERS": 2}):
+            self.assertEqual([error.id for error in check_token_cache(None)], ["account.E001"])
+            with override_settings(AUTH_TOKEN_CACHE={**settings.AUTH_TOKEN_CACHE, "SIZE": 0}):
+                self.assertEqual(check_token_cache(None), [])
+        with override_settings(CACHES=locmem, SERVER={**settings.SERVER, "WORKERS": 1}):
+            self.assertEqual(check_token_cache(None), [])
+
+
+class ClaimsOnlyAuthenticationTests(AccountTestCase):
+    def test_status_does_not_query_database(self):
+        self.login(self.create_account())
+        with self.assertNumQueries(0):
+            res = self.client.get("/api/v1/status/")
+        self.assertEqual(res.json(), {"status": 1})
+        self.assertEqual(self.client.get("/api/v1/logout/").status_code, 200)
+        self.assertEqual(self.client.get("/api/v1/status/").json(), {"status": 0})
+
+    def test_get_loads_user_once(self):
+        account = self.create_account()
+        self.login(account)
+        with self.assertNumQueries(1):
+            res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["username"], account.username)
+
+    def expired_token(self, account):
+        token = AccessToken.for_user(account)
+        token.set_exp(lifetime=-timedelta(seconds=1))
+        return str(token)
+
+    def test_status_is_zero_for_invalid_tokens(self):
+        account = self.create_account()
+        self.login(account)
+        access_token = self.client.cookies["access_token"].value
+        with mock.patch.object(revocations, "start"):
+            self.client.get("/api/v1/logout/")
+            for token in ["garbage", self.expired_token(account), access_token]:
+                self.client.cookies["access_token"] = token
+                res = self.client.get("/api/v1/status/")
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.json(), {"status": 0})
+
+    def test_get_keeps_error_responses(self):
+        account = self.create_account()
+        self.assertEqual(self.client.get("/api/v1/get/").json(), {"error": "Unauthorized"})
+        for token, error in [("garbage", "Invalid Token"), (self.expired_token(account), "Token has expired")]:
+            self.client.cookies["access_token"] = token
+            res = self.client.get("/api/v1/get/")
+            self.assertEqual(res.status_code, 401)
+            self.assertEqual(res.json(), {"error": error})
+
+    def test_get_rejects_inactive_and_deleted_users(self):
+        account = self.create_account()
+        self.login(account)
+        Account.objects.filter(id=account.id).update(is_active=False)
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), {"error": "User is not active"})
+        Account.objects.filter(id=account.id).delete()
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json(), {"error": "User not found"})
+
+
+def reload_urlconf():
+    """
+    settings.ACCOUNT_ASYNC_ROUTESに合わせてURLconfを読み込み直す
+    """
+    importlib.reload(account_urls)
+    importlib.reload(config_urls)
+    clear_url_caches()
+
+
+class AsyncViewTests(AccountTestCase):
+    """
+    ACCOUNT_ASYNC_ROUTESで全てのルートを非同期版のビューに切り替えて，同期版と同じ応答になることを確認する
+    """
+
+    def setUp(self):
+        super().setUp()
+        routes = override_settings(
+            ACCOUNT_ASYNC_ROUTES=["login/", "refresh/", "logout/", "get/", "status/", "register/"]
+        )
+        routes.enable()
+        # 後に登録したものから実行されるため，設定を戻してからURLconfを読み込み直す
+        self.addCleanup(reload_urlconf)
+        self.addCleanup(routes.disable)
+        reload_urlconf()
+        patcher = mock.patch.object(revocations, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+
+    def test_routes_use_async_views(self):
+        self.assertIs(resolve("/api/v1/login/").func.view_class, AsyncTokenObtainView)
+        self.assertIs(resolve("/api/v1/get/").func.view_class, AsyncGetAccountInfo)
+
+    def test_login(self):
+        account = self.create_account()
+        res = self.client.post(
+            "/api/v1/login/", {"email": account.email, "password": "wrong"}, content_type="application/json"
+        )
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json(), {"detail": "No active account found with the given credentials"})
+        self.assertNotIn("access_token", res.cookies)
+        res = self.login(account)
+        self.assertEqual(res.json(), {"success": 1})
+        self.assertIn("refresh_token", res.cookies)
+        self.assertEqual(self.client.get("/api/v1/status/").json(), {"status": 1})
+
+    def test_login_throttle(self):
+        limiter = RateLimiter({"login": {"ip": "2/min", "email": "10/min"}})
+        with mock.patch("account.ratelimit.rate_limiter", limiter), mock.patch.object(limiter, "start"):
+            for _ in range(2):
+                res = self.client.post(
+                    "/api/v1/login/", {"email": "a@example.com", "password": "x"}, content_type="application/json"
+                )
+                self.assertEqual(res.status_code, 401)
+            res = self.client.post(
+                "/api/v1/login/", {"email": "a@example.com", "password": "x"}, content_type="application/json"
+            )
+        self.assertEqual(res.status_code, 429)
+        self.assertIn("Retry-After", res)
+
+    def test_register_conflict(self):
+        self.create_account("alice")
+        data = {"username": "alice", "email": "other@example.com", "password": PASSWORD}
+        res = self.client.post("/api/v1/register/", data, content_type="application/json")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), ["This username has already used"])
+        data = {"username": "bob", "email": "bob@example.com", "password": PASSWORD}
+        res = self.client.post("/api/v1/register/", data, content_type="application/json")
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json()["username"], "bob")
+
+    def test_refresh_rotation_rejects_reuse(self):
+        self.login(self.create_account())
+        old = self.client.cookies["refresh_token"].value
+        res = self.client.post("/api/v1/refresh/", {"refresh": old}, content_type="application/json")
+        self.assertEqual(res.status_code, 200)
+        new = res.cookies["refresh_token"].value
+        self.assertNotEqual(new, old)
+        res = self.client.post("/api/v1/refresh/", {"refresh": old}, content_type="application/json")
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json()["code"], "token_not_valid")
+        res = self.client.post("/api/v1/refresh/", {"refresh": new}, content_type="application/json")
+        self.assertEqual(res.status_code, 200)
+
+    def test_logout_revokes_tokens(self):
+        self.login(self.create_account())
+        access_token = self.client.cookies["access_token"].value
+        res = self.client.get("/api/v1/logout/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.cookies["access_token"].value, "")
+        self.client.cookies["access_token"] = access_token
+        self.assertEqual(self.client.get("/api/v1/status/").json(), {"status": 0})
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json(), {"error": "Invalid Token"})
+
+    def test_get_not_modified(self):
+        account = self.create_account()
+        self.login(account)
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["username"], account.username)
+        with self.assertNumQueries(0):
+            res = self.client.get("/api/v1/get/", HTTP_IF_NONE_MATCH=res["ETag"])
+        self.assertEqual(res.status_code, 304)
+        Account.objects.filter(id=account.id).update(is_active=False)
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), {"error": "User is not active"})
+
+
+class HashingPoolTests(SimpleTestCase):
+    def test_rejects_when_queue_is_full(self):
+        pool = HashingPool(backend="thread", workers=1, max_queue=0)
+        release = threading.Event()
+        try:
+            running = pool.submit(release.wait)
+            with self.assertRaises(HashingPoolBusy):
+                pool.submit(release.wait)
+            self.assertEqual(pool.rejected, 1)
+            release.set()
+            running.result()
+            self.assertTrue(pool.submit(lambda: True).result())
+        finally:
+            release.set()
+            pool.shutdown()
+
+    @override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+    def test_hash_and_check(self):
+        pool = HashingPool(backend="thread", workers=2)
+        try:
+            encoded = pool.make_password(PASSWORD)
+            self.assertEqual(pool.check_password(PASSWORD, encoded), (True, False))
+            self.assertEqual(pool.check_password("wrong", encoded), (False, False))
+        finally:
+            pool.shutdown()
+
+
+class HashingPoolBusyResponseTests(AccountTestCase):
+    def test_register_returns_503_when_pool_is_busy(self):
+        data = {"username": "bob", "email": "bob@example.com", "password": PASSWORD}
+        with mock.patch.object(hashing_pool, "submit", side_effect=HashingPoolBusy):
+            res = self.client.post("/api/v1/register/", data, content_type="application/json")
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res["Retry-After"], "1")
+        self.assertFalse(Account.objects.filter(username="bob").exists())
+
+
+class RegisterConflictTests(AccountTestCase):
+    def register(self, username, email):
+        data = {"username": username, "email": email, "password": PASSWORD}
+        return self.client.post("/api/v1/register/", data, content_type="application/json")
+
+    def test_duplicate_username_and_email(self):
+        self.create_account("alice")
+        res = self.register("alice", "other@example.com")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), ["This username has already used"])
+        res = self.register("other", "alice@example.com")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), ["This email has already used"])
+        self.assertEqual(Account.objects.count(), 1)
+
+    def test_concurrent_registration_is_mapped_to_conflict(self):
+        self.create_account("alice")
+        # 重複の確認の後に同じメールアドレスで登録された場合(一意制約のIntegrityError)
+        with mock.patch.object(Account.objects, "find_conflicts", side_effect=[set(), {"email"}]):
+            res = self.register("bob", "alice@example.com")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json(), ["This email has already used"])
+
+    def test_register(self):
+        res = self.register("bob", "bob@example.com")
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(Account.objects.get(username="bob").check_password(PASSWORD))
+
+
+class ImportAccountsTests(AccountTestCase):
+    def import_file(self, name, content, **options):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        call_command("import_accounts", path, workers=1, stdout=io.StringIO(), **options)
+        with open(f"{path}.errors.csv", newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_import_csv_reports_conflicts(self):
+        self.create_account("alice")
+        errors = self.import_file(
+            "accounts.csv",
+            "username,email,password\n"
+            f"bob,bob@example.com,{PASSWORD}\n"
+            f"bob,bob2@example.com,{PASSWORD}\n"
+            f"alice,alice2@example.com,{PASSWORD}\n"
+            f"carol,alice@example.com,{PASSWORD}\n"
+            f"dave,not-an-email,{PASSWORD}\n",
+        )
+        errors = {row["line"]: row["error"] for row in errors}
+        self.assertEqual(sorted(errors), ["3", "4", "5", "6"])
+        self.assertEqual(errors["3"], "Duplicated in file")
+        self.assertEqual(errors["4"], "This username has already used")
+        self.assertEqual(errors["5"], "This email has already used")
+        self.assertIn("email", json.loads(errors["6"]))
+        bob = Account.objects.get(username="bob")
+        self.assertTrue(bob.check_password(PASSWORD))
+        self.assertTrue(OutboxEvent.objects.filter(account_id=bob.id, event_type="account.created").exists())
+
+    def test_import_ndjson_in_batches(self):
+        lines = [
+            json.dumps({"username": f"user{i}", "email": f"user{i}@example.com", "password": PASSWORD})
+            for i in range(5)
+        ]
+        errors = self.import_file("accounts.ndjson", "\n".join([*lines, "{broken", "[1]"]) + "\n", batch_size=2)
+        self.assertEqual(Account.objects.count(), 5)
+        self.assertEqual([row["line"] for row in errors], ["6", "7"])
+        self.assertTrue(errors[0]["error"].startswith("Invalid JSON"))
+
+    def test_falls_back_to_row_inserts_on_integrity_error(self):
+        # 重複の確認の後に同じユーザー名で登録された場合は1件ずつ登録し直し，重複した行だけをエラーにする
+        original = HashingPool.make_passwords
+
+        def make_passwords(pool, passwords):
+            self.create_account("bob")
+            return original(pool, passwords)
+
+        with mock.patch.object(HashingPool, "make_passwords", make_passwords):
+            errors = self.import_file(
+                "accounts.csv",
+                f"username,email,password\nbob,bob2@example.com,{PASSWORD}\ncarol,carol@example.com,{PASSWORD}\n",
+            )
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["username"], "bob")
+        self.assertEqual(Account.objects.get(username="bob").email, "bob@example.com")
+        self.assertTrue(Account.objects.filter(username="carol").exists())
+
+
+class AccountExportTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = self.create_account("admin")
+        self.admin.is_staff = True
+        self.admin.save()
+        self.accounts = [self.admin, *(self.create_account(f"user{i}") for i in range(3))]
+
+    def export(self, fmt, **params):
+        self.login(self.admin)
+        res = self.client.get(f"/api/v1/users/export/{fmt}/", params)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.streaming)
+        return res, b"".join(res.streaming_content)
+
+    def test_csv(self):
+        res, content = self.export("csv", fields="id,username,date_joined")
+        self.assertEqual(res["Content-Type"], "text/csv")
+        rows = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(rows[0], ["id", "username", "date_joined"])
+        self.assertEqual([row[:2] for row in rows[1:]], [[str(a.id), a.username] for a in self.accounts])
+        self.assertEqual(rows[1][2], self.admin.date_joined.isoformat())
+
+    def test_csv_escapes_formulas(self):
+        Account.objects.filter(id=self.accounts[1].id).update(username="=HYPERLINK(1)", image="@SUM(A1)")
+        Account.objects.filter(id=self.accounts[2].id).update(username="-2+3", image="+cmd")
+        _, content = self.export("csv", fields="id,username,image")
+        rows = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(rows[2][1:], ["'=HYPERLINK(1)", "'@SUM(A1)"])
+        self.assertEqual(rows[3][1:], ["'-2+3", "'+cmd"])
+        self.assertEqual(rows[1][0], str(self.admin.id))
+
+    def test_gzipped_ndjson(self):
+        res, content = self.export("ndjson", gzip="1")
+        self.assertEqual(res["Content-Type"], "application/gzip")
+        self.assertEqual(res["Content-Disposition"], 'attachment; filename="accounts.ndjson.gz"')
+        rows = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual([row["username"] for row in rows], [a.username for a in self.accounts])
+        self.assertNotIn("password", rows[0])
+
+    def test_invalid_requests(self):
+        self.login(self.admin)
+        self.assertEqual(self.client.get("/api/v1/users/export/xml/").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/users/export/csv/", {"fields": "password"}).status_code, 400)
+
+    def test_admin_only(self):
+        self.login(self.accounts[1])
+        self.assertEqual(self.client.get("/api/v1/users/export/csv/").status_code, 403)
+
+    def test_command_reads_in_chunks(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "accounts.csv")
+        with CaptureQueriesContext(connection) as queries:
+            call_command("export_accounts", path, fields="username", chunk_size=2, stdout=io.StringIO())
+        with open(path, newline="") as f:
+            self.assertEqual([row["username"] for row in csv.DictReader(f)], [a.username for a in self.accounts])
+        # SQLiteではサーバーサイドカーソルがないが，1回のクエリから順に読み出す
+        self.assertEqual(len(queries), 1)
+
+
+class AccountSearchTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        prefix_cache.clear()
+        self.addCleanup(prefix_cache.clear)
+        self.alice = self.create_account("alice")
+        # キーの順ではaliceより前に並ぶ長いユーザー名
+        for i in range(10):
+            self.create_account(f"alaaaa{i:02d}")
+        self.login(self.alice)
+
+    def search(self, q, **params):
+        res = self.client.get("/api/v1/users/search/", {"q": q, **params})
+        self.assertEqual(res.status_code, 200)
+        return [user["username"] for user in res.json()["results"]]
+
+    def test_prefix_ranks_shorter_usernames_first(self):
+        self.assertEqual(self.search("AL", limit=3), ["alice", "alaaaa00", "alaaaa01"])
+
+    def test_exact_match_first(self):
+        self.create_account("alic")
+        self.assertEqual(self.search("alice", limit=2), ["alice"])
+        self.assertEqual(self.search("alic", limit=2), ["alic", "alice"])
+
+    def test_narrower_prefix_is_served_from_cache(self):
+        self.assertEqual(len(self.search("ala", limit=20)), 10)
+        hits = prefix_cache.hits
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search("alaaaa05", limit=20), ["alaaaa05"])
+        self.assertEqual(prefix_cache.hits, hits + 1)
+        self.assertFalse([query for query in queries if "LOWER" in query["sql"]])
+
+    def test_save_invalidates_cache(self):
+        self.assertEqual(self.search("bo"), [])
+        self.create_account("bob")
+        self.assertEqual(self.search("bo"), ["bob"])
+
+    def test_fuzzy_fallback(self):
+        self.assertEqual(self.search("alise"), ["alice"])
+
+    def test_invalid_limit(self):
+        self.assertEqual(self.client.get("/api/v1/users/search/", {"q": "al", "limit": 0}).status_code, 400)
+        self.assertEqual(self.client.get("/api/v1/users/search/").status_code, 400)
+
+
+class ListSink(Sink):
+    """
+    配信されたイベントのidをバッチ毎に記録する．failの回数だけ失敗する
+    """
+
+    def __init__(self, name="list", fail=0):
+        super().__init__(name)
+        self.batches = []
+        self.fail = fail
+
+    def send(self, events):
+        if self.fail:
+            self.fail -= 1
+            raise OSError("unavailable")
+        self.batches.append([event["id"] for event in events])
+
+
+class OutboxRelayTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sink = ListSink()
+        self.relay = OutboxRelay([self.sink], batch_size=2, retry_base=0)
+        self.accounts = [self.create_account(f"user{i}") for i in range(3)]
+        self.ids = list(OutboxEvent.objects.order_by("id").values_list("id", flat=True))
+
+    def checkpoint(self):
+        return OutboxCheckpoint.objects.get(sink="list")
+
+    def test_delivers_in_id_order_and_saves_position(self):
+        self.assertEqual([self.relay.deliver(), self.relay.deliver(), self.relay.deliver()], [2, 1, 0])
+        self.assertEqual(self.sink.batches, [self.ids[:2], self.ids[2:]])
+        self.assertEqual(self.checkpoint().position, self.ids[-1])
+        # 新しいリレーは保存した位置から続ける
+        relay = OutboxRelay([self.sink])
+        self.accounts[0].image = "https://example.com/user0.png"
+        self.accounts[0].save()
+        self.assertEqual(relay.deliver(), 1)
+        self.assertEqual(self.sink.batches[-1], [self.ids[-1] + 1])
+
+    def test_failed_batch_is_resent_from_same_position(self):
+        self.sink.fail = 1
+        with self.assertLogs("account.outbox", "ERROR"):
+            self.assertEqual(self.relay.deliver(), 0)
+        self.assertEqual(self.relay.failures["list"], 1)
+        self.assertEqual(self.relay.deliver(), 2)
+        self.assertEqual(self.sink.batches, [self.ids[:2]])
+        self.assertEqual(self.relay.failures["list"], 0)
+
+    def test_late_commit_is_delivered_after_gap(self):
+        # 2番目のイベントのコミットが遅れた場合
+        late = OutboxEvent.objects.get(id=self.ids[1])
+        late.delete()
+        self.relay.batch_size = 10
+        self.assertEqual(self.relay.deliver(), 2)
+        self.assertEqual(self.sink.batches, [[self.ids[0], self.ids[2]]])
+        self.assertEqual([gap[:2] for gap in self.checkpoint().gaps], [[self.ids[1], self.ids[1]]])
+        self.assertEqual(self.relay.deliver(), 0)
+
+        late.id = self.ids[1]
+        late.save(force_insert=True)
+        self.assertEqual(self.relay.deliver(), 1)
+        self.assertEqual(self.sink.batches[-1], [self.ids[1]])
+        self.assertEqual(self.checkpoint().gaps, [])
+        self.assertEqual(self.checkpoint().position, self.ids[2])
+
+    def test_gives_up_on_missing_ids_after_timeout(self):
+        OutboxEvent.objects.filter(id=self.ids[1]).delete()
+        self.relay.batch_size = 10
+        self.relay.deliver()
+        with mock.patch("account.outbox.time.time", return_value=time.time() + self.relay.gap_timeout):
+            with self.assertLogs("account.outbox", "WARNING") as logs:
+                self.assertEqual(self.relay.deliver(), 0)
+        self.assertIn(str(self.ids[1]), logs.output[0])
+        self.assertEqual(self.relay.skipped["list"], 1)
+        self.assertEqual(self.checkpoint().gaps, [])
+
+    def test_remove_ids(self):
+        self.assertEqual(remove_ids([[1, 5, 0.0], [8, 8, 1.0]], [1, 3, 8]), [[2, 2, 0.0], [4, 5, 0.0]])
+
+    def test_relay_outbox_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "events.ndjson")
+        sinks = {"file": {"BACKEND": "account.outbox.FileSink", "OPTIONS": {"path": path}}}
+        with override_settings(OUTBOX={**settings.OUTBOX, "SINKS": sinks, "BATCH_SIZE": 2}):
+            out = io.StringIO()
+            call_command("relay_outbox", once=True, stdout=out)
+        self.assertIn("file: 3 events delivered", out.getvalue())
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([event["id"] for event in events], self.ids)
+        self.assertEqual(events[0]["type"], "account.created")
+        self.assertEqual(events[0]["account_id"], self.accounts[0].id)
+
+
+class UserCursorPaginationTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.accounts = [self.create_account(f"user{i:02d}") for i in range(25)]
+        self.login(self.accounts[0])
+
+    def test_pages_follow_username_order(self):
+        usernames = []
+        url = "/api/v1/users/?page_size=10"
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                data = self.client.get(url).json()
+                usernames.extend(user["username"] for user in data["results"])
+                url = data["next"]
+        self.assertEqual(usernames, sorted(account.username for account in self.accounts))
+        # 1ページ1クエリ(COUNTなし)と最初のリクエストでのユーザーの取得
+        self.assertEqual(len(queries), 3 + 1)
+
+    def test_previous_page(self):
+        first = self.client.get("/api/v1/users/?page_size=10").json()
+        second = self.client.get(first["next"]).json()
+        self.assertEqual(self.client.get(second["previous"]).json()["results"], first["results"])
+
+    def test_exclude(self):
+        excluded = [self.accounts[1].id, self.accounts[2].id]
+        data = self.client.get("/api/v1/users/", {"exclude": ",".join(map(str, excluded)), "page_size": 100}).json()
+        ids = [user["id"] for user in data["results"]]
+        self.assertEqual(len(ids), 23)
+        self.assertFalse(set(excluded) & set(ids))
+
+    def test_invalid_exclude(self):
+        self.assertEqual(self.client.get("/api/v1/users/", {"exclude": "1,a"}).status_code, 400)
+        too_many = ",".join(str(i) for i in range(101))
+        self.assertEqual(self.client.get("/api/v1/users/", {"exclude": too_many}).status_code, 400)
+
+
+class LoginActivityBufferTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.buffer = LoginActivityBuffer(max_entries=2)
+        patcher = mock.patch.object(self.buffer, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flush_writes_latest_timestamps_in_one_update(self):
+        alice, bob = self.create_account("alice"), self.create_account("bob")
+        self.buffer.record(alice.id)
+        self.buffer.record(bob.id, login=False)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.buffer.flush(), 2)
+        alice.refresh_from_db()
+        bob.refresh_from_db()
+        self.assertIsNotNone(alice.last_login)
+        self.assertEqual(alice.login_date, alice.last_login)
+        # トークンの更新ではlast_loginは変えない
+        self.assertIsNone(bob.last_login)
+        self.assertGreater(bob.login_date, bob.date_joined)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_refresh_after_login_keeps_login_time(self):
+        alice = self.create_account("alice")
+        self.buffer.record(alice.id)
+        self.buffer.record(alice.id, login=False)
+        self.buffer.flush()
+        alice.refresh_from_db()
+        self.assertIsNotNone(alice.last_login)
+        self.assertGreaterEqual(alice.login_date, alice.last_login)
+
+    def test_wakes_up_flusher_when_full(self):
+        with mock.patch.object(self.buffer, "wakeup") as wakeup:
+            self.buffer.record(1)
+            wakeup.assert_not_called()
+            self.buffer.record(2)
+            wakeup.assert_called_once()
+
+    def test_login_does_not_write_account(self):
+        alice = self.create_account("alice")
+        self.login(alice)
+        alice.refresh_from_db()
+        self.assertIsNone(alice.last_login)
+        login_activity.flush()
+        alice.refresh_from_db()
+        self.assertIsNotNone(alice.last_login)
+
+
+class CountingFlusher(PeriodicFlusher):
+    flush_interval = 3600
+
+    def __init__(self):
+        super().__init__()
+        self.flushed = 0
+
+    def flush(self):
+        self.flushed += 1
+
+
+class PeriodicFlusherTests(SimpleTestCase):
+    def test_registers_atexit_once_per_process(self):
+        with mock.patch.object(flusher.atexit, "register") as register, mock.patch.object(
+            flusher, "_registered", False
+        ):
+            first, second = CountingFlusher(), CountingFlusher()
+            first.start()
+            first.stop()
+            first.start()
+            second.start()
+            flusher.stop_flushers()
+        register.assert_called_once_with(flusher.stop_flushers)
+        self.assertEqual((first.flushed, second.flushed), (2, 1))
+        self.assertFalse(flusher._started & {first, second})
+
+    def test_worker_flushes_before_exit(self):
+        server = PreforkServer(lambda scope, receive, send: None)
+        buffer = CountingFlusher()
+        buffer.start()
+        for patcher in [
+            mock.patch("config.server.os.fork", return_value=0),
+            mock.patch.object(server, "_run_worker", side_effect=RuntimeError),
+            mock.patch("config.server.logging.shutdown"),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with mock.patch("config.server.os._exit", side_effect=SystemExit) as exit, mock.patch.object(
+            registry, "write"
+        ) as write, mock.patch("atexit._run_exitfuncs") as run_exitfuncs:
+            with self.assertRaises(SystemExit), self.assertLogs("config.server"):
+                server._spawn_worker()
+        exit.assert_called_once_with(1)
+        self.assertEqual(buffer.flushed, 1)
+        write.assert_called_once_with()
+        run_exitfuncs.assert_not_called()
+
+
+class PresenceTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = PresenceStore(ttl=60)
+        # フラッシュはテストの中で呼び出す
+        patcher = mock.patch.object(self.store, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.accounts = [self.create_account(f"user{i}") for i in range(3)]
+
+    def test_count_reads_rows_written_by_all_processes(self):
+        alice, bob, carol = self.accounts
+        self.store.heartbeat(alice.id)
+        self.assertEqual(self.store.count(), 0)
+        self.store.flush()
+        # 他のプロセスが書き込んだハートビート(人数は次のフラッシュで数える)
+        OnlineUser.objects.create(user=bob)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.store.count(), 1)
+        self.assertEqual(sorted(self.store.online_users()), [alice.id, bob.id])
+        self.store.flush()
+        self.assertEqual(self.store.count(), 2)
+
+    def test_count_is_shared_through_cache(self):
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+        writer, reader = PresenceStore(ttl=60, cache="default"), PresenceStore(ttl=60, cache="default")
+        with mock.patch.object(writer, "start"):
+            writer.heartbeat(self.accounts[0].id)
+        writer.flush()
+        with self.assertNumQueries(0):
+            self.assertEqual(reader.count(), 1)
+        self.assertEqual(reader.local_count(), 0)
+        self.assertEqual(writer.local_count(), 1)
+
+    def test_expired_rows_are_not_counted(self):
+        alice, bob, _ = self.accounts
+        OnlineUser.objects.create(user=alice, last_seen=timezone.now() - timedelta(seconds=61))
+        OnlineUser.objects.create(user=bob)
+        self.assertEqual(self.store.count(), 1)
+        self.assertEqual(self.store.online_users(), [bob.id])
+
+    def test_disconnect_removes_row_on_flush(self):
+        alice = self.accounts[0]
+        self.store.heartbeat(alice.id)
+        self.store.flush()
+        self.store.disconnect(alice.id)
+        self.store.flush()
+        self.assertEqual(self.store.count(), 0)
+
+    def test_heartbeat_of_deleted_user_does_not_drop_batch(self):
+        alice, bob, _ = self.accounts
+        self.store.heartbeat(alice.id)
+        self.store.heartbeat(bob.id)
+        bob.delete()
+        self.assertEqual(self.store.flush(), 2)
+        self.assertEqual(self.store.online_users(), [alice.id])
+
+    def test_failed_flush_is_retried(self):
+        alice = self.accounts[0]
+        self.store.heartbeat(alice.id)
+        with mock.patch.object(OnlineUser.objects, "bulk_create", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.store.flush()
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(self.store.online_users(), [alice.id])
+
+    def test_online_users_view(self):
+        alice = self.accounts[0]
+        self.login(alice)
+        with mock.patch("account.views.presence", self.store):
+            self.assertEqual(self.client.post("/api/v1/presence/heartbeat/").status_code, 200)
+            self.store.flush()
+            res = self.client.get("/api/v1/presence/")
+        self.assertEqual(res.json(), {"count": 1, "users": [alice.id]})
+
+
+def image_bytes(fmt="PNG", size=(64, 48), color=(200, 30, 30)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+class MediaTestCase(AccountTestCase):
+    """
+    アップロードしたファイルを一時ディレクトリに保存する
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self, content, name="image.png"):
+        return self.client.post("/api/v1/image/post/", {"image": SimpleUploadedFile(name, content)})
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root)
+            for root, _, names in os.walk(self.media_root)
+            for name in names
+        )
+
+
+class ContentAddressedUploadTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(variant_pool, "schedule")
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_content_is_stored_once_regardless_of_name(self):
+        content = image_bytes()
+        first = self.upload(content, "photo.PNG")
+        second = self.upload(content, "photo.jpg")
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.json()["file"]["url"], second.json()["file"]["url"])
+        content_hash = hashlib.sha256(content).hexdigest()
+        self.assertEqual(self.stored_files(), [f"images/{content_hash[:2]}/{content_hash}.png"])
+        self.schedule.assert_called_once()
+
+    def test_extension_follows_content(self):
+        res = self.upload(image_bytes("JPEG"), "photo.png")
+        self.assertTrue(res.json()["file"]["url"].endswith(".jpg"))
+
+    def test_concurrent_upload_reuses_stored_file(self):
+        content = image_bytes()
+        self.upload(content)
+        # exists()の後に他のリクエストが同じ内容を保存した場合(最初のexists()だけがFalseを返す)
+        exists = default_storage.exists
+        checked = []
+
+        def racing_exists(name):
+            checked.append(name)
+            return len(checked) > 1 and exists(name)
+
+        with mock.patch.object(default_storage, "exists", side_effect=racing_exists):
+            res = self.upload(content)
+        content_hash = hashlib.sha256(content).hexdigest()
+        self.assertTrue(res.json()["file"]["url"].endswith(f"/{content_hash}.png"))
+        self.assertEqual(len(self.stored_files()), 1)
+        self.schedule.assert_called_once()
+
+    def test_rejects_unknown_content(self):
+        res = self.upload(b"not an image", "image.png")
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(IMAGE_UPLOAD_MAX_SIZE=1024)
+    def test_rejects_large_upload(self):
+        self.assertEqual(self.upload(b"\x89PNG\r\n\x1a\n" + b"0" * 2048).status_code, 413)
+        self.assertEqual(self.stored_files(), [])
+
+
+class ImageVariantTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(variant_pool, "schedule")
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored_original(self, content):
+        self.assertEqual(self.upload(content).status_code, 201)
+        content_hash = hashlib.sha256(content).hexdigest()
+        return content_hash, f"images/{content_hash[:2]}/{content_hash}.png"
+
+    def test_rejects_corrupted_image(self):
+        content = image_bytes(size=(256, 256))
+        res = self.upload(content[: len(content) // 2])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.stored_files(), [])
+        self.schedule.assert_not_called()
+
+    def test_redirects_to_original_until_variant_exists(self):
+        content_hash, original = self.stored_original(image_bytes(size=(400, 300)))
+        res = self.client.get(f"/api/v1/image/{content_hash}/48/")
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(res["Cache-Control"], "no-cache")
+        self.schedule.assert_called_with(original)
+
+        generate_variants(original)
+        res = self.client.get(f"/api/v1/image/{content_hash}/48/")
+        self.assertEqual(res.status_code, 200)
+        with Image.open(io.BytesIO(b"".join(res.streaming_content))) as variant:
+            self.assertEqual(variant.size, (48, 36))
+
+    def test_if_none_match_skips_storage(self):
+        content_hash, original = self.stored_original(image_bytes())
+        generate_variants(original)
+        etag = self.client.get(f"/api/v1/image/{content_hash}/48/")["ETag"]
+        with mock.patch.object(default_storage, "open") as storage_open:
+            res = self.client.get(f"/api/v1/image/{content_hash}/48/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertIn("immutable", res["Cache-Control"])
+        storage_open.assert_not_called()
+
+    def test_unknown_image_and_size(self):
+        content_hash, _ = self.stored_original(image_bytes())
+        self.assertEqual(self.client.get(f"/api/v1/image/{'0' * 64}/48/").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/v1/image/{content_hash}/64/").status_code, 404)
+
+
+class ImageVariantPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = ImageVariantPool(1, max_queue=1, retry_after=60)
+        self.addCleanup(lambda: self.pool._executor and self.pool._executor.shutdown())
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def blocked_generate(self, name):
+        self.release.wait(5)
+
+    def test_skips_pending_and_drops_over_queue(self):
+        with mock.patch("account.images.generate_variants", side_effect=self.blocked_generate):
+            self.assertTrue(self.pool.schedule("a"))
+            self.assertFalse(self.pool.schedule("a"))
+            self.assertTrue(self.pool.schedule("b"))
+            self.assertFalse(self.pool.schedule("c"))
+            self.assertEqual(self.pool.dropped, 1)
+            self.release.set()
+            self.pool._executor.shutdown()
+        self.assertEqual(self.pool.pending(), 0)
+
+    def test_failed_image_is_not_retried_until_retry_after(self):
+        with mock.patch("account.images.generate_variants", side_effect=OSError("cannot identify image")) as generate:
+            with self.assertLogs("account.images", "ERROR"):
+                self.assertTrue(self.pool.schedule("broken"))
+                self.pool._executor.shutdown()
+                self.pool._executor = None
+                self.assertFalse(self.pool.schedule("broken"))
+                self.assertEqual(self.pool.failures(), 1)
+                with mock.patch("account.images.time.monotonic", return_value=time.monotonic() + 61):
+                    self.assertTrue(self.pool.schedule("broken"))
+                self.pool._executor.shutdown()
+        self.assertEqual(generate.call_count, 2)
+
+
+class MetricsEndpointTests(AccountTestCase):
+    @override_settings(METRICS_TOKEN=None, METRICS_ALLOW_ANONYMOUS=False)
+    def test_denied_without_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics/slow-requests/").status_code, 403)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_requires_bearer_token(self):
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+        self.client.get("/api/v1/status/")
+        res = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count{route="/api/v1/status/"}', res.content.decode())
+
+
+class MultiprocessMetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def worker(self, pid, requests, pending):
+        registry = MetricsRegistry(self.directory)
+        histogram = registry.histogram("http_request_duration_seconds", "/api/v1/get/", "Wall time")
+        for _ in range(requests):
+            histogram.observe(0.01)
+        registry.register_collector(
+            lambda: [("logins_total", "counter", {}, requests), ("jobs_pending", "gauge", {}, pending)]
+        )
+        with mock.patch("config.metrics.os.getpid", return_value=pid):
+            registry.write()
+        return registry
+
+    def render(self, registry, pid):
+        with mock.patch("config.metrics.os.getpid", return_value=pid):
+            return registry.render()
+
+    def test_sums_counters_and_labels_gauges_by_worker(self):
+        self.worker(101, 2, 5)
+        text = self.render(self.worker(102, 3, 7), 102)
+        self.assertIn('http_request_duration_seconds_count{route="/api/v1/get/"} 5', text)
+        self.assertIn("logins_total 5", text)
+        self.assertIn('jobs_pending{pid="101"} 5', text)
+        self.assertIn('jobs_pending{pid="102"} 7', text)
+        self.assertEqual(text.count("# TYPE jobs_pending gauge"), 1)
+
+    def test_exited_worker_counters_are_kept(self):
+        self.worker(101, 2, 5)
+        registry = self.worker(102, 3, 7)
+        archive_snapshot(self.directory, 101)
+        self.assertNotIn("101.json", os.listdir(self.directory))
+        text = self.render(registry, 102)
+        self.assertIn("logins_total 5", text)
+        self.assertNotIn('pid="101"', text)
+
+        # 同じワーカーのファイルがまだ残っていても二重に数えない
+        self.worker(103, 1, 0)
+        archive_snapshot(self.directory, 103)
+        self.worker(103, 1, 0)
+        self.assertIn("logins_total 6", self.render(registry, 102))
+
+
+class QueryBudgetTests(AccountTestCase):
+    def test_sql_shape_ignores_values(self):
+        self.assertEqual(
+            sql_shape("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'a''b' LIMIT 21"),
+            sql_shape("SELECT * FROM t WHERE id IN (%s) AND name = 'c' LIMIT 1"),
+        )
+
+    @override_settings(ROOT_URLCONF=__name__, QUERY_BUDGET={"MODE": "raise", "N_PLUS_ONE_THRESHOLD": 3})
+    def test_raises_on_budget_and_n_plus_one(self):
+        for i in range(3):
+            self.create_account(f"user{i}")
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            self.client.get("/api/v1/budget/")
+        report = str(raised.exception)
+        self.assertIn("4 queries (budget 2)", report)
+        self.assertIn("Possible N+1: 3 queries with the same shape", report)
+        self.assertIn("account/tests.py", report)
+
+    @override_settings(ROOT_URLCONF=__name__, QUERY_BUDGET={"MODE": "log", "N_PLUS_ONE_THRESHOLD": 3})
+    def test_logs_in_log_mode(self):
+        self.create_account("alice")
+        with self.assertNoLogs("config.middleware", "WARNING"):
+            self.assertEqual(self.client.get("/api/v1/budget/").status_code, 200)
+        self.create_account("bob")
+        self.create_account("carol")
+        with self.assertLogs("config.middleware", "WARNING") as logs:
+            self.assertEqual(self.client.get("/api/v1/budget/").status_code, 200)
+        self.assertIn("4 queries (budget 2)", logs.output[0])
+
+
+class RevocationStoreTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+        patcher = mock.patch.object(RevocationStore, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.exp = time.time() + 3600
+
+    def test_revocation_reaches_other_process_once(self):
+        first, second = RevocationStore(), RevocationStore()
+        self.assertTrue(first.revoke("jti-1", self.exp))
+        self.assertTrue(second.is_revoked("jti-1"))
+        self.assertFalse(second.revoke("jti-1", self.exp))
+        self.assertFalse(second.is_revoked("jti-2"))
+
+    def test_new_process_starts_from_snapshot(self):
+        writer = RevocationStore(snapshot_every=3)
+        for i in range(5):
+            writer.revoke(f"jti-{i}", self.exp)
+        writer.flush()
+        writer.revoke("jti-5", self.exp)
+
+        cache = caches["default"]
+        requested = []
+        get_many = cache.get_many
+
+        def recording_get_many(keys):
+            requested.extend(keys)
+            return get_many(keys)
+
+        reader = RevocationStore()
+        with mock.patch.object(cache, "get_many", side_effect=recording_get_many):
+            self.assertTrue(all(reader.is_revoked(f"jti-{i}") for i in range(6)))
+        # スナップショットより前の記録は読まない
+        self.assertEqual([key for key in requested if not key.startswith("revocation:snapshot")], ["revocation:6"])
+
+    def test_entry_written_after_sequence_is_picked_up(self):
+        reader = RevocationStore()
+        reader.sync()
+        cache = caches["default"]
+        # revoke()が連番を取得してから記録を書き込むまでの間に同期した場合
+        cache.add(SEQUENCE_KEY, 0, None)
+        cache.incr(SEQUENCE_KEY)
+        reader.sync()
+        cache.set("revocation:1", ("late", self.exp))
+        reader.sync()
+        self.assertTrue(reader.is_revoked("late"))
+
+    def test_warns_about_process_local_cache_with_workers(self):
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        with override_settings(CACHES=locmem, SERVER={**settings.SERVER, "WORKERS": 2}):
+            self.assertEqual([error.id for error in check_revocation_cache(None)], ["account.W001"])
+        with override_settings(CACHES=locmem, SERVER={**settings.SERVER, "WORKERS": 1}):
+            self.assertEqual(check_revocation_cache(None), [])
+        shared = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://"}}
+        with override_settings(CACHES=shared, SERVER={**settings.SERVER, "WORKERS": 2}):
+            self.assertEqual(check_revocation_cache(None), [])
+
+    def test_expired_entries_are_pruned_by_token_exp(self):
+        store = RevocationStore()
+        now = time.time()
+        store.revoke("access", now + 300)
+        store.revoke("refresh", now + 3600 * 24 * 180)
+        with mock.patch("account.revocation.time.time", return_value=now + 301):
+            self.assertEqual(store.compact(), 1)
+            self.assertFalse(store.is_revoked("access"))
+            self.assertTrue(store.is_revoked("refresh"))
+
+    def test_snapshot_writes_only_new_entries(self):
+        writer = RevocationStore(snapshot_every=3)
+        cache = caches["default"]
+        written = []
+        set_ = cache.set
+
+        def recording_set(key, value, *args):
+            if key.startswith("revocation:snapshot:"):
+                written.extend(value)
+            return set_(key, value, *args)
+
+        with mock.patch.object(cache, "set", side_effect=recording_set):
+            for round_ in range(3):
+                for i in range(3):
+                    writer.revoke(f"jti-{round_}-{i}", self.exp)
+                writer.flush()
+        # 各スナップショットは前回以降の3件だけを書き込む
+        self.assertEqual(len(written), 9)
+        reader = RevocationStore()
+        self.assertTrue(all(reader.is_revoked(f"jti-{r}-{i}") for r in range(3) for i in range(3)))
+        self.assertEqual(reader._sequence, 9)
+
+    def test_snapshot_is_rebuilt_when_evicted(self):
+        writer = RevocationStore(snapshot_every=2)
+        for i in range(2):
+            writer.revoke(f"jti-{i}", self.exp)
+        writer.flush()
+        # 別のプロセスがスナップショットから起動した後にヘッダーが追い出された場合
+        other = RevocationStore(snapshot_every=2)
+        other.sync()
+        caches["default"].delete("revocation:snapshot")
+        for i in range(2, 4):
+            other.revoke(f"jti-{i}", self.exp)
+        other.flush()
+        reader = RevocationStore()
+        self.assertTrue(all(reader.is_revoked(f"jti-{i}") for i in range(4)))
+
+
+class LogoutTests(AccountTestCase):
+    def test_logged_out_access_token_is_rejected(self):
+        self.login(self.create_account("alice"))
+        access_token = self.client.cookies["access_token"].value
+        self.assertEqual(self.client.get("/api/v1/get/").status_code, 200)
+        with mock.patch.object(revocations, "start"):
+            self.assertEqual(self.client.get("/api/v1/logout/").status_code, 200)
+            self.client.cookies["access_token"] = access_token
+            self.assertEqual(self.client.get("/api/v1/get/").status_code, 401)
+
+
+class ORJSONRendererTests(SimpleTestCase):
+    data = {
+        "id": 1,
+        "name": "アリス",
+        "label": gettext_lazy("This field is required."),
+        "joined": datetime(2024, 5, 6, 7, 8, 9, 123456, tzinfo=dt_timezone.utc),
+        "birthday": date(2000, 1, 2),
+        "scores": {1: [0.5, None, True]},
+    }
+
+    def test_output_matches_drf(self):
+        expected = JSONRenderer().render(self.data)
+        self.assertEqual(ORJSONRenderer().render(self.data), expected)
+        with mock.patch("config.renderers.orjson", None):
+            self.assertEqual(ORJSONRenderer().render(self.data), expected)
+
+    def test_parser(self):
+        parser = ORJSONParser()
+        self.assertEqual(parser.parse(io.BytesIO('{"a": [1, "あ"]}'.encode())), {"a": [1, "あ"]})
+        with self.assertRaises(ParseError):
+            parser.parse(io.BytesIO(b'{"a": '))
+
+
+@override_settings(READ_REPLICA={"REPLICAS": ["replica"], "STICKY_SECONDS": 5, "CACHE": None})
+class ReplicaRouterTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.router = PrimaryReplicaRouter()
+
+    def test_only_reads_inside_read_replica_go_to_replica(self):
+        self.assertEqual(self.router.db_for_read(Account), "default")
+        with read_replica():
+            self.assertEqual(self.router.db_for_read(Account), "replica")
+            self.assertEqual(self.router.db_for_write(Account), "default")
+        self.assertEqual(self.router.db_for_read(Account), "default")
+
+    def test_saved_user_reads_primary_until_sticky_window_ends(self):
+        alice = self.create_account("alice")
+        with read_replica(alice.id):
+            self.assertEqual(self.router.db_for_read(Account), "default")
+        with mock.patch("config.dbrouter.time.monotonic", return_value=time.monotonic() + 6):
+            with read_replica(alice.id):
+                self.assertEqual(self.router.db_for_read(Account), "replica")
+
+    def test_shared_cache_pins_across_processes(self):
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+        StickyUsers(cache="default").pin(42)
+        self.assertTrue(StickyUsers(cache="default").is_pinned(42))
+        self.assertFalse(StickyUsers().is_pinned(42))
+
+    @override_settings(READ_REPLICA={"REPLICAS": [], "STICKY_SECONDS": 5, "CACHE": None})
+    def test_without_replicas_reads_primary(self):
+        with read_replica():
+            self.assertEqual(self.router.db_for_read(Account), "default")
+
+
+class SchemaCacheTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        self.schema_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.schema_dir, ignore_errors=True)
+        cache_settings = override_settings(SCHEMA_CACHE={"DIR": self.schema_dir, "VERSION": None})
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        for patcher in (
+            mock.patch("config.schema.code_version", return_value="test"),
+            mock.patch.dict(schema._schemas, clear=True),
+            # 生成時のdrf-spectacularの警告を出力しない
+            mock.patch.object(GENERATOR_STATS, "silent", True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("config.schema.generate_schema", side_effect=schema.generate_schema)
+        self.generate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_generated_once_and_revalidated_by_etag(self):
+        res = self.client.get("/api/schema/?format=json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res["Cache-Control"], "no-cache")
+        self.assertIn("/api/v1/login/", json.loads(res.content)["paths"])
+        res = self.client.get("/api/schema/?format=json", HTTP_IF_NONE_MATCH=res["ETag"])
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(self.generate.call_count, 1)
+
+    def test_other_process_reads_schema_from_disk(self):
+        etag = self.client.get("/api/schema/?format=json")["ETag"]
+        schema._schemas.clear()
+        self.assertEqual(self.client.get("/api/schema/?format=json")["ETag"], etag)
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertEqual(os.listdir(self.schema_dir), ["schema-test-default.json"])
+
+    def test_build_schema_and_unknown_language(self):
+        call_command("build_schema", format=["yaml"], stdout=io.StringIO())
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertEqual(self.client.get("/api/schema/?format=yaml&lang=xx").status_code, 200)
+        self.assertEqual(self.generate.call_count, 1)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(RateLimiter, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        limiter = RateLimiter({"login": {"ip": "2/min", "email": "5/min"}})
+        keys = [("ip", "10.0.0.1"), ("email", "a@example.com")]
+        self.assertIsNone(limiter.hit("login", keys))
+        self.assertIsNone(limiter.hit("login", keys))
+        self.assertAlmostEqual(limiter.hit("login", keys), 30, delta=1)
+        self.assertIsNone(limiter.hit("login", [("ip", "10.0.0.2")]))
+        self.assertEqual(limiter.counts[("login", "ip", "rejected")], 1)
+
+    def test_sweeps_full_and_evicts_least_recent_buckets(self):
+        limiter = RateLimiter({"login": {"email": "1/min"}}, shards=1, max_keys=2)
+        for email in ("a", "b", "c"):
+            limiter.hit("login", [("email", email)])
+        self.assertEqual((limiter.count(), limiter.evictions), (2, 1))
+        self.assertIsNone(limiter.hit("login", [("email", "a")]))
+        self.assertIsNotNone(limiter.hit("login", [("email", "c")]))
+        with mock.patch("account.ratelimit.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertEqual(limiter.flush(), 2)
+        self.assertEqual(limiter.count(), 0)
+
+
+class LoginRateLimitTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        limiter = RateLimiter({"login": {"ip": "2/min", "email": "10/min"}})
+        for patcher in (mock.patch("account.ratelimit.rate_limiter", limiter), mock.patch.object(limiter, "start")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def attempt(self, forwarded_for):
+        return self.client.post(
+            "/api/v1/login/",
+            {"email": f"{forwarded_for}@example.com", "password": "wrong"},
+            content_type="application/json",
+            HTTP_X_FORWARDED_FOR=forwarded_for,
+        )
+
+    def test_forwarded_for_cannot_bypass_limit(self):
+        self.assertNotEqual(self.attempt("1.1.1.1").status_code, 429)
+        self.assertNotEqual(self.attempt("2.2.2.2").status_code, 429)
+        res = self.attempt("3.3.3.3")
+        self.assertEqual(res.status_code, 429)
+        self.assertIn("Retry-After", res)
+
+    def test_ident_behind_proxies(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="6.6.6.6, 203.0.113.5")
+        throttle = LoginRateThrottle()
+        self.assertEqual(throttle.get_ident(request), "10.0.0.1")
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, "NUM_PROXIES": 1}):
+            self.assertEqual(throttle.get_ident(request), "203.0.113.5")
+
+
+class AccountVersionTests(AccountTestCase):
+    def setUp(self):
+        super().setUp()
+        caches["default"].clear()
+        self.addCleanup(caches["default"].clear)
+        self.alice = self.create_account("alice")
+        self.login(self.alice)
+
+    def test_not_modified_without_queries(self):
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res["ETag"], f'"{self.alice.id}-{self.alice.version}"')
+        with self.assertNumQueries(0):
+            res = self.client.get("/api/v1/get/", HTTP_IF_NONE_MATCH=res["ETag"])
+        self.assertEqual(res.status_code, 304)
+
+    def test_save_changes_etag_after_commit(self):
+        etag = self.client.get("/api/v1/get/")["ETag"]
+        self.alice.image = "https://example.com/alice.png"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.save()
+        res = self.client.get("/api/v1/get/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res["ETag"], f'"{self.alice.id}-{self.alice.version}"')
+        self.assertEqual(res.json()["image"], "https://example.com/alice.png")
+
+    def test_concurrent_saves_keep_every_increment(self):
+        initial = Account.objects.get(pk=self.alice.pk).version
+        first, second = Account.objects.get(pk=self.alice.pk), Account.objects.get(pk=self.alice.pk)
+        first.image = "https://example.com/1.png"
+        first.save(update_fields=["image"])
+        second.username = "alice2"
+        second.save(update_fields=["username"])
+        self.assertEqual((first.version, second.version), (initial + 1, initial + 2))
+        self.assertEqual(Account.objects.get(pk=self.alice.pk).version, initial + 2)
+        events = OutboxEvent.objects.filter(account_id=self.alice.pk, event_type="account.updated")
+        self.assertEqual(sorted(events.values_list("version", flat=True)), [initial + 1, initial + 2])
+
+    def test_failed_save_keeps_version(self):
+        version = self.alice.version
+        self.alice.email = "bob@example.com"
+        with mock.patch.object(OutboxEvent.objects, "using", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError), transaction.atomic():
+                self.alice.save()
+        self.assertEqual(self.alice.version, version)
+        self.assertEqual(Account.objects.get(pk=self.alice.pk).email, "alice@example.com")
+
+    def test_save_without_changes_writes_nothing(self):
+        alice = Account.objects.get(pk=self.alice.pk)
+        events = OutboxEvent.objects.count()
+        with self.assertNumQueries(0):
+            alice.save()
+            alice.save(update_fields=["username", "email"])
+        self.assertEqual(OutboxEvent.objects.count(), events)
+        self.assertEqual(Account.objects.get(pk=self.alice.pk).version, self.alice.version)
+
+    def test_version_is_returned_by_update(self):
+        alice = Account.objects.get(pk=self.alice.pk)
+        alice.last_login = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            alice.save()
+        # イベントを書き込まない保存はUPDATE ... RETURNINGの1クエリだけ
+        self.assertEqual([query["sql"].split()[0] for query in queries], ["UPDATE"])
+        self.assertEqual(alice.version, self.alice.version + 1)
+        alice.email = "alice2@example.com"
+        with CaptureQueriesContext(connection) as queries:
+            alice.save()
+        self.assertNotIn("SELECT", [query["sql"].split()[0] for query in queries])
+        self.assertEqual(alice.version, Account.objects.get(pk=alice.pk).version)
+
+    def test_deactivation_of_deferred_instance(self):
+        alice = Account.objects.only("id", "username").get(pk=self.alice.pk)
+        alice.is_active = False
+        alice.save()
+        event = OutboxEvent.objects.filter(account_id=alice.pk).latest("id")
+        self.assertEqual(event.event_type, "account.deactivated")
+        self.assertEqual(event.payload["email"], "alice@example.com")
+        self.assertEqual(event.version, Account.objects.get(pk=alice.pk).version)
+        # 遅延読み込みのまま保存したis_activeは変わらない
+        bob = self.create_account("bob")
+        bob = Account.objects.defer("is_active").get(pk=bob.pk)
+        bob.username = "bob2"
+        bob.save()
+        self.assertEqual(OutboxEvent.objects.filter(account_id=bob.pk).latest("id").event_type, "account.updated")
+
+    def test_stale_versions_are_never_current(self):
+        version = self.alice.version
+        # on_commitの記録が前後した場合と，保存と同時にプライマリから古いバージョンを読み取った場合
+        account_versions.record(self.alice.pk, version + 2)
+        account_versions.record(self.alice.pk, version + 1)
+        account_versions.add(self.alice.pk, version)
+        self.assertFalse(account_versions.is_current(self.alice.pk, version))
+        self.assertFalse(account_versions.is_current(self.alice.pk, version + 1))
+        self.assertTrue(account_versions.is_current(self.alice.pk, version + 2))
+
+    def test_replica_reads_do_not_fill_cache(self):
+        user = Account.objects.get(pk=self.alice.pk)
+        user._state.db = "replica"
+        response = add_version_headers(JsonResponse({}), user)
+        self.assertEqual(response["ETag"], f'"{user.pk}-{user.version}"')
+        self.assertFalse(account_versions.is_current(user.pk, user.version))
+        self.assertEqual(self.client.get("/api/v1/get/", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 200)
+
+    def test_save_in_other_process_invalidates_not_modified(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        shared = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}
+        with override_settings(CACHES={**settings.CACHES, "shared": shared}), mock.patch.object(
+            account_versions, "cache_alias", "shared"
+        ):
+            etag = self.client.get("/api/v1/get/")["ETag"]
+            self.assertEqual(self.client.get("/api/v1/get/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            pid = os.fork()
+            if pid == 0:
+                # 別のワーカーでの保存(子プロセスのDBは複製のため，共有するのはキャッシュだけ)
+                code = 1
+                try:
+                    self.alice.image = "https://example.com/alice.png"
+                    with self.captureOnCommitCallbacks(execute=True):
+                        self.alice.save()
+                    code = 0
+                finally:
+                    os._exit(code)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(self.client.get("/api/v1/get/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_check_requires_shared_cache_with_workers(self):
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        with override_settings(CACHES=locmem, SERVER={**settings.SERVER, "WORKERS": 2}):
+            self.assertEqual([error.id for error in check_version_cache(None)], ["account.E002"])
+        with override_settings(CACHES=locmem, SERVER={**settings.SERVER, "WORKERS": 1}):
+            self.assertEqual(check_version_cache(None), [])
+
+
+class MiddlewareProfilesTests(AccountTestCase):
+    def handle(self, request):
+        # MiddlewareProfilesの後に呼び出されるハンドラ(ビューの解決と呼び出しの代わり)
+        self.seen = request
+        view = lambda request: JsonResponse({})  # noqa: E731
+        return self.middleware.process_view(request, view, (), {}) or view(request)
+
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        self.middleware = MiddlewareProfiles(self.handle)
+
+    def test_api_skips_session_and_messages(self):
+        res = self.middleware(self.factory.get("/api/v1/get/"))
+        self.assertFalse(hasattr(self.seen, "session"))
+        self.assertFalse(hasattr(self.seen, "_messages"))
+        self.assertNotIn("X-Frame-Options", res)
+        self.assertIs(self.seen.middleware_chain, dict(self.middleware.chains)["/api/v1/"])
+
+    def test_default_profile_keeps_full_stack(self):
+        res = self.middleware(self.factory.get("/admin/login/"))
+        self.assertTrue(hasattr(self.seen, "session"))
+        self.assertTrue(hasattr(self.seen, "_messages"))
+        self.assertEqual(res["X-Frame-Options"], "DENY")
+
+    def test_process_view_uses_selected_chain(self):
+        # APIでもCsrfViewMiddlewareのprocess_viewは実行する
+        request = self.factory.post("/api/v1/register/")
+        request._dont_enforce_csrf_checks = False
+        self.assertEqual(self.middleware(request).status_code, 403)
+
+    @override_settings(MIDDLEWARE_PROFILES={**settings.MIDDLEWARE_PROFILES, "/api/v1/users/": []})
+    def test_longest_prefix_wins(self):
+        middleware = MiddlewareProfiles(lambda request: JsonResponse({}))
+        self.assertEqual(middleware.select("/api/v1/users/search/").view_middleware, [])
+        self.assertTrue(middleware.select("/api/v1/get/").view_middleware)
+        self.assertIs(middleware.select("/other/"), middleware.default)
+
+    def test_client_requests(self):
+        self.assertEqual(self.client.get("/admin/login/")["X-Frame-Options"], "DENY")
+        self.login(self.create_account("alice"))
+        res = self.client.get("/api/v1/get/")
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn("X-Frame-Options", res)
+
+
+@override_settings(ROOT_URLCONF=__name__, QUERY_BUDGET={"MODE": "raise", "N_PLUS_ONE_THRESHOLD": 3})
+class AsyncMiddlewareTests(TestCase):
+    async def test_async_view_and_middleware_run_on_event_loop(self):
+        loop_thread = threading.get_ident()
+        for route in ("/api/v1/thread/", "/thread/"):
+            with self.subTest(route=route):
+                threads = {}
+                queries = registry.histogram("http_request_db_queries", route)
+                before = queries.snapshot()[1]
+                with record_thread(SameSiteMiddleware, "process_response", threads), record_thread(
+                    InstrumentationMiddleware, "record", threads
+                ), record_thread(QueryBudgetMiddleware, "check", threads):
+                    res = await self.async_client.get(route)
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.json()["thread"], loop_thread)
+                self.assertEqual(
+                    threads,
+                    {
+                        "SameSiteMiddleware": loop_thread,
+                        "InstrumentationMiddleware": loop_thread,
+                        "QueryBudgetMiddleware": loop_thread,
+                    },
+                )
+                self.assertIn("samesite", res.cookies["probe"].output().lower())
+                # 非同期ORMのクエリもリクエストの計測値に集計される
+                self.assertEqual(queries.snapshot()[1] - before, 1)
+
+    def test_sync_request_still_counts_queries(self):
+        queries = registry.histogram("http_request_db_queries", "/api/v1/thread/")
+        before = queries.snapshot()[1]
+        res = self.client.get("/api/v1/thread/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(queries.snapshot()[1] - before, 1)
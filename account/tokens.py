@@ -0,0 +1,61 @@
+"""
+失効・ローテーションに対応したリフレッシュトークン．
+失効の判定はaccount.revocation.revocations(プロセス内の辞書)で行い，DBにはアクセスしない．
+"""
+import jwt
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .revocation import revocations
+
+
+class RevocableRefreshToken(RefreshToken):
+    """
+    simplejwtのblacklistアプリの代わりにrevocationsで失効を管理する．
+    TokenRefreshSerializerはBLACKLIST_AFTER_ROTATIONが有効な場合にローテーション前のトークンのblacklist()を呼ぶ
+    """
+
+    def verify(self, *args, **kwargs):
+        super().verify(*args, **kwargs)
+        if revocations.is_revoked(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_("Token is blacklisted"))
+
+    def blacklist(self):
+        # 同時に同じトークンでリフレッシュされた場合は1つだけを成功させる
+        if not revocations.revoke(self.payload[api_settings.JTI_CLAIM], self.payload["exp"]):
+            raise TokenError(_("Token is blacklisted"))
+
+
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = RevocableRefreshToken
+
+
+def revoke_cookie_tokens(cookies):
+    """
+    ログアウト時にCookieのアクセストークンとリフレッシュトークンを失効させる(不正なトークンは無視する)
+    """
+    for key, token_class in (("access_token", AccessToken), ("refresh_token", RefreshToken)):
+        raw_token = cookies.get(key)
+        if not raw_token:
+            continue
+        try:
+            token = token_class(raw_token)
+        except TokenError:
+            continue
+        revocations.revoke(token[api_settings.JTI_CLAIM], token["exp"])
+
+
+def token_error(raw_token) -> str:
+    """
+    検証に失敗したアクセストークンについて，get/が返すエラーメッセージ(期限切れとそれ以外を区別する)
+    """
+    try:
+        jwt.decode(raw_token, api_settings.SIGNING_KEY, algorithms=[api_settings.ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        return "Token has expired"
+    except jwt.InvalidTokenError:
+        pass
+    return "Invalid Token"
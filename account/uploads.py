@@ -0,0 +1,131 @@
+"""
+画像アップロードをストリーミングで受け取り，内容のハッシュ(SHA-256)をキーに保存する．
+"""
+import hashlib
+import os
+from io import BytesIO
+from typing import Optional
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework import exceptions, status
+
+# multipartの境界やファイル以外のフィールドの分として許容するサイズ
+MULTIPART_OVERHEAD = 64 * 1024
+# ファイルの先頭のバイト列 -> 保存時の拡張子
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+]
+
+
+class UploadTooLarge(exceptions.APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Uploaded file is too large."
+    default_code = "upload_too_large"
+
+
+class HashingFileUploadHandler(FileUploadHandler):
+    """
+    受信したチャンク毎にハッシュを更新しながら保存するアップロードハンドラ．
+    FILE_UPLOAD_MAX_MEMORY_SIZE以下はメモリ，それより大きい場合は一時ファイルに書き込むためメモリ使用量は一定．
+    max_sizeを超えた時点で受信を打ち切りUploadTooLargeを送出する．
+    """
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size or settings.IMAGE_UPLOAD_MAX_SIZE
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Content-Lengthで分かる場合は受信前に拒否する
+        if content_length > self.max_size + MULTIPART_OVERHEAD:
+            raise UploadTooLarge()
+        self.in_memory = content_length <= settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        if self.in_memory:
+            self.file = BytesIO()
+        else:
+            self.file = TemporaryUploadedFile(
+                self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+            )
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > self.max_size:
+            self.upload_interrupted()
+            raise UploadTooLarge()
+        self.hash.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        if self.in_memory:
+            uploaded = InMemoryUploadedFile(
+                self.file,
+                self.field_name,
+                self.file_name,
+                self.content_type,
+                file_size,
+                self.charset,
+                self.content_type_extra,
+            )
+        else:
+            uploaded = self.file
+            uploaded.size = file_size
+        uploaded.content_hash = self.hash.hexdigest()
+        return uploaded
+
+    def upload_interrupted(self):
+        if isinstance(getattr(self, "file", None), TemporaryUploadedFile):
+            temp_location = self.file.temporary_file_path()
+            try:
+                self.file.close()
+                os.remove(temp_location)
+            except FileNotFoundError:
+                pass
+
+
+def image_extension(upload_file) -> Optional[str]:
+    """
+    ファイルの先頭のバイト列から画像の種類を判定して拡張子を返す(対応していない種類の場合はNone)．
+    ファイル名の拡張子は使わないため，同じ内容であればファイル名に関わらず同じパスになる
+    """
+    upload_file.seek(0)
+    head = upload_file.read(12)
+    upload_file.seek(0)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def content_addressed_name(content_hash, ext):
+    """
+    ハッシュから保存先のパスを作る(例: images/ab/abcdef....png)
+    """
+    return f"images/{content_hash[:2]}/{content_hash}{ext}"
+
+
+def save_content_addressed(upload_file, ext):
+    """
+    (保存先のパス, 新たに書き込んだか)を返す．同じ内容のファイルが保存済みであれば書き込まない
+    """
+    name = content_addressed_name(upload_file.content_hash, ext)
+    if default_storage.exists(name):
+        return name, False
+    saved = default_storage.save(name, upload_file)
+    if saved != name:
+        # exists()の後に同じ内容が並行して保存され，ストレージが別名を付けた．内容は同じため保存済みの方を使う
+        default_storage.delete(saved)
+        return name, False
+    return name, True
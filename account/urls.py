@@ -1,23 +1,56 @@
+from django.conf import settings
 from django.urls import path
 
+from config.querybudget import query_budget
+
+from .async_views import (
+    AsyncAccountRegister,
+    AsyncGetAccountInfo,
+    AsyncGetAccountStatus,
+    AsyncTokenDeleteView,
+    AsyncTokenObtainView,
+    AsyncTokenRefreshView,
+)
+from .images import image_variant
 from .views import (
+    AccountExportView,
     AccountRegister,
+    AccountSearchView,
     GetAccountInfo,
     GetAccountStatus,
     ImageRegisterAPIView,
+    OnlineUserView,
+    PresenceHeartbeatView,
     TokenDeleteView,
     TokenObtainView,
     TokenRefreshView,
+    UserView,
     refresh_get,
 )
 
+
+def select(route, view, async_view, **kwargs):
+    """
+    settings.ACCOUNT_ASYNC_ROUTESに含まれるルートは非同期版のビューを使う
+    """
+    if route in settings.ACCOUNT_ASYNC_ROUTES:
+        return path(route, async_view.as_view(), **kwargs)
+    return path(route, view.as_view(), **kwargs)
+
+
 urlpatterns = [
-    path("register/", AccountRegister.as_view()),
-    path("get/", GetAccountInfo.as_view()),
-    path("login/", TokenObtainView.as_view()),
-    path("logout/", TokenDeleteView.as_view()),
-    path("refresh/", TokenRefreshView.as_view()),
-    path("status/", GetAccountStatus.as_view()),
-    path("refresh-token/", refresh_get),
+    select("register/", AccountRegister, AsyncAccountRegister),
+    select("get/", GetAccountInfo, AsyncGetAccountInfo),
+    select("login/", TokenObtainView, AsyncTokenObtainView),
+    select("logout/", TokenDeleteView, AsyncTokenDeleteView),
+    select("refresh/", TokenRefreshView, AsyncTokenRefreshView),
+    select("status/", GetAccountStatus, AsyncGetAccountStatus),
+    path("refresh-token/", query_budget(0)(refresh_get)),
+    path("users/", UserView.as_view()),
+    path("users/search/", AccountSearchView.as_view(), name="accountSearch"),
+    path("users/export/<str:fmt>/", AccountExportView.as_view(), name="accountExport"),
+    path("presence/", OnlineUserView.as_view()),
+    path("presence/heartbeat/", PresenceHeartbeatView.as_view()),
     path("image/post/", ImageRegisterAPIView.as_view(), name="imageRegister"),
+    path("image/<str:content_hash>/<int:size>/", query_budget(0)(image_variant), name="imageVariant"),
 ]
@@ -0,0 +1,105 @@
+"""
+アカウントのバージョン(Account.version)をキャッシュに保持し，get/のETagに使う．
+If-None-Matchのバージョンが最新かはキャッシュだけで判定するため，304の場合はAccountの行を取得しない．
+バージョンはユーザーの保存(コミット後)・削除時にシグナルで記録する(QuerySet.updateはシグナルを発行しないため対象外)．
+"""
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.http import parse_etags, quote_etag
+
+
+class AccountVersions:
+    """
+    記録したバージョン毎にキー(account:version:<user_id>:<version>)を追加し，
+    バージョンvのキーがあってv+1のキーがない場合にvを最新とみなす．
+    保存毎にバージョンは1ずつ増えるため，on_commitの記録の順序が前後しても，保存と同時に読み取った古いバージョンを
+    後から記録しても，古いバージョンを最新とは判定しない(キーは追加するだけで上書きしない)．
+    複数のプロセスで動かす場合はプロセス間で共有するキャッシュ(Redis等)を指定する(checks.check_version_cache)
+    """
+
+    def __init__(self, cache="default", timeout=60 * 60) -> None:
+        self.cache_alias = cache
+        self.timeout = timeout
+
+    @classmethod
+    def from_settings(cls) -> "AccountVersions":
+        conf = settings.ACCOUNT_VERSIONS
+        return cls(cache=conf["CACHE"], timeout=conf["TIMEOUT"])
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def record(self, user_id, version: int) -> None:
+        """
+        保存したバージョンを記録する
+        """
+        self.cache.set(self._key(user_id, version), 1, self.timeout)
+
+    def add(self, user_id, version: int) -> None:
+        """
+        プライマリから読み取ったバージョンを記録する(既に記録されている場合は期限を延ばさない)
+        """
+        self.cache.add(self._key(user_id, version), 1, self.timeout)
+
+    def retire(self, user_id, version: int) -> None:
+        """
+        削除したユーザーのバージョンを最新とみなさないようにする
+        """
+        self.record(user_id, version + 1)
+
+    def is_current(self, user_id, version: int) -> bool:
+        current, following = self._key(user_id, version), self._key(user_id, version + 1)
+        found = self.cache.get_many([current, following])
+        return current in found and following not in found
+
+    def etag(self, user_id, if_none_match: Optional[str]) -> Optional[str]:
+        """
+        If-None-MatchのETagのうち，キャッシュで最新と判定できたものを返す(DBアクセスなし)
+        """
+        prefix = f"{user_id}-"
+        for etag in parse_etags(if_none_match or ""):
+            value = etag.removeprefix("W/").strip('"')
+            if value.startswith(prefix) and value[len(prefix) :].isdigit():
+                if self.is_current(user_id, int(value[len(prefix) :])):
+                    return etag
+        return None
+
+    def _key(self, user_id, version: int) -> str:
+        return f"account:version:{user_id}:{version}"
+
+
+def account_etag(user_id, version: int) -> str:
+    return quote_etag(f"{user_id}-{version}")
+
+
+def add_version_headers(response, user):
+    """
+    取得したアカウントのETagをレスポンスに設定する．
+    レプリカの遅延で古いバージョンを最新と記録しないよう，キャッシュにはプライマリから読み取った場合のみ記録する
+    """
+    if user._state.db == DEFAULT_DB_ALIAS:
+        account_versions.add(user.pk, user.version)
+    response["ETag"] = account_etag(user.pk, user.version)
+    # ブラウザにはキャッシュさせるが，毎回ETagで確認させる
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+account_versions = AccountVersions.from_settings()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def update_account_version(sender, instance, using, **kwargs):
+    # Account.save()が保存したバージョンを(コミット後に)記録する
+    transaction.on_commit(lambda: account_versions.record(instance.pk, instance.version), using=using)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def delete_account_version(sender, instance, **kwargs):
+    account_versions.retire(instance.pk, instance.version)
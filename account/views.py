@@ -1,21 +1,36 @@
 from typing import List
 
-import jwt
 from django.conf import settings
 from django.core.files.storage import default_storage
-from django.http import HttpResponse, JsonResponse
+from django.db import router
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response
 from rest_framework import generics, permissions, response, status
+from rest_framework.exceptions import AuthenticationFailed, NotFound, ValidationError
 from rest_framework.generics import ListAPIView
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.pagination import CursorPagination
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
-from rest_framework.validators import ValidationError
 from rest_framework.views import APIView
 from rest_framework_simplejwt import exceptions as jwt_exp, views as jwt_views
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 
+from config.authenticate import ClaimsOnlyAuthentication, CustomAuthentication
+from config.dbrouter import read_replica
+
+from .activity import login_activity
+from .export import FORMATS, export_stream, iter_rows, parse_fields
+from .images import variant_pool, verify_image
 from .models import Account
-from .serializers import AccountSerializer
+from .presence import presence
+from .ratelimit import LoginRateThrottle, RegisterRateThrottle
+from .search import search_accounts
+from .serializers import AccountReadSerializer, AccountRegisterSerializer, check_conflicts
+from .tokens import revoke_cookie_tokens, token_error
+from .uploads import HashingFileUploadHandler, image_extension, save_content_addressed
+from .versions import account_versions, add_version_headers
 
 
 class TokenObtainView(jwt_views.TokenObtainPairView):
@@ -23,6 +38,9 @@ class TokenObtainView(jwt_views.TokenObtainPairView):
     JWTをCookieにセットして送る
     """
 
+    throttle_classes = [LoginRateThrottle]
+    query_budget = 1
+
     def post(self, request, *args, **kwargs):
         # シリアライザーでバリデーションを行う．
         serializer = self.get_serializer(data=request.data)
@@ -31,6 +49,9 @@ class TokenObtainView(jwt_views.TokenObtainPairView):
         except jwt_exp.TokenError as e:
             raise jwt_exp.InvalidToken(e.args[0])
 
+        # ログイン日時はまとめて書き込む
+        login_activity.record(serializer.user.id)
+
         # レスポンスオブジェクトの作成
         res = response.Response(
             data={
@@ -77,6 +98,8 @@ class TokenRefreshView(jwt_views.TokenRefreshView):
     リフレッシュトークンを使って新しいアクセストークンを作成する
     """
 
+    query_budget = 0
+
     def post(self, request, *args, **kwargs):
         # シリアライザーによるバリデーション
         serializer = self.get_serializer(data=request.data)
@@ -85,6 +108,10 @@ class TokenRefreshView(jwt_views.TokenRefreshView):
         except jwt_exp.TokenError as e:
             raise jwt_exp.InvalidToken(e.args[0])
 
+        # 検証済みのため署名は確認せずにユーザーIDを取り出す
+        refresh = RefreshToken(serializer.initial_data["refresh"], verify=False)
+        login_activity.record(refresh[api_settings.USER_ID_CLAIM], login=False)
+
         # レスポンスオブジェクトの作成
         res = response.Response(status=status.HTTP_200_OK)
         res.set_cookie(
@@ -94,18 +121,28 @@ class TokenRefreshView(jwt_views.TokenRefreshView):
             expires=settings.SIMPLE_JWT["ACCESS_TOKEN_LIFETIME"],
             httponly=True,
         )
+        # ローテーションした場合は新しいリフレッシュトークンに置き換える(古いトークンは失効済み)
+        if "refresh" in serializer.validated_data:
+            res.set_cookie(
+                key="refresh_token",
+                value=serializer.validated_data["refresh"],
+                expires=settings.SIMPLE_JWT["REFRESH_TOKEN_LIFETIME"],
+                httponly=True,
+            )
         return res
 
 
 class TokenDeleteView(APIView):
     """
-    Cookieに保存しているTokenを削除する
+    Cookieに保存しているTokenを失効させて削除する
     """
 
     permission_classes: List[type] = [permissions.AllowAny]
     authentication_classes: List[type] = []
+    query_budget = 0
 
     def get(self, request, *args, **kwargs):
+        revoke_cookie_tokens(request.COOKIES)
         res = response.Response(status=status.HTTP_200_OK)
         res.delete_cookie("access_token")
         res.delete_cookie("refresh_token")
@@ -119,84 +156,238 @@ class AccountRegister(generics.CreateAPIView):
 
     permission_classes: List[type] = [permissions.AllowAny]
     authentication_classes: List[type] = []
-    serializer_class = AccountSerializer
+    serializer_class = AccountRegisterSerializer
     queryset = Account.objects.all()
+    throttle_classes = [RegisterRateThrottle]
+    # 重複の確認，アカウントと変更イベント(アウトボックス)のINSERT(SQLiteではatomicのBEGINも数える)
+    query_budget = 4
 
     def perform_create(self, serializer):
-        queryset = Account.objects.filter(username=self.request.data["username"])
-        if queryset.exists():
-            raise ValidationError("This username has already used")
-
-        queryset = Account.objects.filter(email=self.request.data["email"])
-        if queryset.exists():
-            raise ValidationError("This email has already used")
+        # ユーザー名とメールアドレスの重複を1回のクエリで確認する
+        data = serializer.validated_data
+        check_conflicts(Account.objects.find_conflicts(data["username"], data["email"]))
         serializer.save()
 
 
 class GetAccountInfo(APIView):
     """
-    アカウント情報を取得する
+    アカウント情報を取得する．
+    If-None-MatchがキャッシュのバージョンのETagと一致する場合は，行の取得とシリアライズを行わずに304を返す
     """
 
     permission_classes: List[type] = [permissions.AllowAny]
+    # 認証に失敗した場合も以前と同じ{"error": ...}を返すため，ビューの中でクレームのみで認証する
+    # (304の判定ではAccountの行を参照しない)
+    authentication_classes: List[type] = []
+    query_budget = 1
 
     def get(self, request):
-        jwt_token = request.COOKIES.get("access_token")
-        if not jwt_token:
+        authentication = ClaimsOnlyAuthentication()
+        raw_token = authentication.get_request_token(request)
+        if raw_token is None:
             return Response({"error": "Unauthorized"}, status=status.HTTP_401_UNAUTHORIZED)
         try:
-            payload = jwt.decode(jwt_token, settings.SECRET_KEY, algorithms=["HS256"])
-            loginuser = Account.objects.get(id=payload["user_id"])
-            # アクティブチェック
-            if loginuser.is_active:
-                response = AccountSerializer(loginuser)
-                return Response(response.data, status=status.HTTP_200_OK)
-            return Response({"error": "User is not active"}, status=status.HTTP_400_BAD_REQUEST)
-        except jwt.ExpiredSignatureError:
-            return Response({"error": "Token has expired"}, status=status.HTTP_401_UNAUTHORIZED)
-        except jwt.exceptions.DecodeError:
-            return Response({"error": "Invalid Token"}, status=status.HTTP_401_UNAUTHORIZED)
-        except Account.DoesNotExist:
+            token_user, _ = authentication.authenticate(request)
+        except AuthenticationFailed:
+            return Response({"error": token_error(raw_token)}, status=status.HTTP_401_UNAUTHORIZED)
+        etag = account_versions.etag(token_user.id, request.META.get("HTTP_IF_NONE_MATCH"))
+        if etag is not None:
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                not_modified["ETag"] = etag
+                return not_modified
+
+        with read_replica(token_user.id):
+            user = Account.objects.filter(id=token_user.id).first()
+        if user is None:
             return Response({"error": "User not found"}, status=status.HTTP_401_UNAUTHORIZED)
+        if not user.is_active:
+            return Response({"error": "User is not active"}, status=status.HTTP_400_BAD_REQUEST)
+        response = AccountReadSerializer(user)
+        return add_version_headers(Response(response.data, status=status.HTTP_200_OK), user)
 
 
 class GetAccountStatus(APIView):
+    """
+    有効なトークンを持っているかを返す(クレームのみで判定するためDBアクセスなし)．
+    トークンがない・不正・期限切れ・失効済みの場合は{"status": 0}を返す
+    """
+
     permission_classes: List[type] = [permissions.AllowAny]
+    authentication_classes: List[type] = []
+    query_budget = 0
 
     def get(self, request):
-        # 認証に成功した場合は、ユーザーオブジェクトがrequest.userに設定される
-        if "access_token" in request.COOKIES:
-            if request.user is not None:
-                return Response({"status": 1}, status=status.HTTP_200_OK)
-            else:
-                return Response({"status": 0}, status=status.HTTP_200_OK)
-        else:
-            return Response({"status": 0}, status=status.HTTP_200_OK)
+        try:
+            authenticated = ClaimsOnlyAuthentication().authenticate(request) is not None
+        except AuthenticationFailed:
+            authenticated = False
+        return Response({"status": 1 if authenticated else 0}, status=status.HTTP_200_OK)
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    (username, id)のキーセットでページングする．OFFSETを使わないため深いページでも一定時間で返せる
+    """
+
+    ordering = ("username", "id")
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
 
 
 class UserView(ListAPIView):
-    queryset = Account.objects.all().order_by("username")
-    serializer_class = AccountSerializer
-    pagination_class = LimitOffsetPagination
+    """
+    ユーザー一覧を返す．excludeにカンマ区切りのIDを指定すると除外する
+    """
+
+    permission_classes: List[type] = [permissions.IsAuthenticated]
+    queryset = Account.objects.all()
+    serializer_class = AccountReadSerializer
+    pagination_class = UserCursorPagination
+    max_exclude = 100
+    query_budget = 2
+
+    def list(self, request, *args, **kwargs):
+        # 一覧はレプリカから読み取る
+        with read_replica(request.user.id):
+            return super().list(request, *args, **kwargs)
 
     def get_queryset(self):
-        excludeUsersArr: List[type] = []
+        exclude_ids = self.get_exclude_ids()
+        queryset = super().get_queryset()
+        if exclude_ids:
+            queryset = queryset.exclude(id__in=exclude_ids)
+        return queryset
+
+    def get_exclude_ids(self):
+        value = self.request.query_params.get("exclude")
+        if not value:
+            return []
+        user_ids = value.split(",")
+        if len(user_ids) > self.max_exclude:
+            raise ValidationError({"exclude": [f"Ensure this field has no more than {self.max_exclude} ids."]})
         try:
-            excludeUsers = self.request.query_params.get("exclude")
-            if excludeUsers:
-                userIds = excludeUsers.split(",")
-                for userId in userIds:
-                    excludeUsersArr.append(int(userId))
+            return sorted({int(user_id) for user_id in user_ids})
         except ValueError:
-            return []
-        return super().get_queryset().exclude(id__in=excludeUsersArr)
+            raise ValidationError({"exclude": ["Ensure this field is a comma separated list of ids."]})
+
+
+class AccountExportView(APIView):
+    """
+    アカウントをCSV / NDJSON(export/csv/ または export/ndjson/)でストリーミングして返す(管理者のみ)．
+    fieldsにカンマ区切りでフィールドを指定でき，gzip=1の場合はgzipで圧縮したファイルを返す
+    """
+
+    permission_classes: List[type] = [permissions.IsAdminUser]
+    # ユーザーの取得のみ(行はレスポンスを返した後にストリーミングしながら読み取る)
+    query_budget = 1
+
+    def get(self, request, fmt):
+        if fmt not in FORMATS:
+            raise NotFound()
+        try:
+            fields = parse_fields(request.query_params.get("fields"))
+        except ValueError as e:
+            raise ValidationError({"fields": [str(e)]})
+        compress = request.query_params.get("gzip") in ("1", "true")
+
+        # 読み取りはレスポンスを返した後に行うため，ここで接続先(レプリカ)を決めておく
+        with read_replica(request.user.id):
+            using = router.db_for_read(Account)
+        stream = export_stream(fmt, fields, iter_rows(fields, using=using), compress)
+        res = StreamingHttpResponse(stream, content_type="application/gzip" if compress else FORMATS[fmt])
+        res["Content-Disposition"] = f'attachment; filename="accounts.{fmt}{".gz" if compress else ""}"'
+        return res
+
+
+class AccountSearchView(APIView):
+    """
+    ユーザー名・メールアドレスでユーザーを検索する．
+    qに検索語，limitに件数を指定する．前方一致の結果を先に返し，足りない場合はあいまい検索の結果で補う
+    """
+
+    permission_classes: List[type] = [permissions.IsAuthenticated]
+    authentication_classes: List[type] = [ClaimsOnlyAuthentication]
+    # 前方一致(ユーザー名・メールアドレス)とあいまい検索(SQLiteでは候補の検索と取得)
+    query_budget = 4
+
+    def get(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": ["This field is required."]})
+        conf = settings.ACCOUNT_SEARCH
+        try:
+            limit = int(request.query_params.get("limit", conf["LIMIT"]))
+        except ValueError:
+            raise ValidationError({"limit": ["A valid integer is required."]})
+        if not 1 <= limit <= conf["MAX_LIMIT"]:
+            raise ValidationError({"limit": [f"Ensure this value is between 1 and {conf['MAX_LIMIT']}."]})
+
+        with read_replica(request.user.id):
+            results = search_accounts(query, limit)
+        return Response({"results": AccountReadSerializer(results, many=True).data}, status=status.HTTP_200_OK)
+
+
+class PresenceHeartbeatView(APIView):
+    """
+    オンライン状態を更新する(メモリ上で処理するためDBアクセスなし)
+    """
+
+    permission_classes: List[type] = [permissions.IsAuthenticated]
+    authentication_classes: List[type] = [ClaimsOnlyAuthentication]
+    query_budget = 0
+
+    def post(self, request):
+        presence.heartbeat(request.user.id)
+        return Response({"ttl": presence.ttl}, status=status.HTTP_200_OK)
+
+    def delete(self, request):
+        presence.disconnect(request.user.id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class OnlineUserView(APIView):
+    """
+    オンラインのユーザーIDと人数を返す(全プロセスのハートビートをまとめたOnlineUserから読み取る)
+    """
+
+    permission_classes: List[type] = [permissions.IsAuthenticated]
+    authentication_classes: List[type] = [ClaimsOnlyAuthentication]
+    max_users = 1000
+    query_budget = 2
+
+    def get(self, request):
+        return Response(
+            {"count": presence.count(), "users": presence.online_users(limit=self.max_users)},
+            status=status.HTTP_200_OK,
+        )
 
 
 class ImageRegisterAPIView(APIView):
+    """
+    画像をアップロードする．
+    受信しながらハッシュを計算して内容のハッシュをファイル名に保存し，同じ画像は再度書き込まずに既存のURLを返す．
+    縮小版(バリアント)はバックグラウンドで作成する
+    """
+
     parser_classes: List[type] = [FormParser, MultiPartParser]
+    query_budget = 1
 
     def post(self, request, *args, **kwargs):
-        upload_file = request.data["image"]
-        file_name = default_storage.save(upload_file.name, upload_file)
+        request._request.upload_handlers = [HashingFileUploadHandler(request._request)]
+        upload_file = request.data.get("image")
+        if upload_file is None or not hasattr(upload_file, "content_hash"):
+            raise ValidationError({"image": ["No file was submitted."]})
+        ext = image_extension(upload_file)
+        if ext is None:
+            raise ValidationError({"image": ["Upload a PNG, JPEG, GIF or WebP image."]})
+        # 破損した画像は保存せず，バリアントの作成も依頼しない
+        if not verify_image(upload_file):
+            raise ValidationError({"image": ["Upload a valid image. The file was not an image or was corrupted."]})
+        file_name, created = save_content_addressed(upload_file, ext)
+        if created:
+            # 縮小版の画像はリクエストとは別に作成する
+            variant_pool.schedule(file_name)
         object_url = f"{default_storage.url(file_name)}"
         return Response({"success": 1, "file": {"url": object_url}}, status.HTTP_201_CREATED)
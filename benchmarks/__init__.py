@@ -0,0 +1,64 @@
+"""
+パフォーマンス計測用のスクリプト群．
+`python -m benchmarks.<name> --help` で各ベンチマークのオプションを確認できる．
+"""
+import os
+
+
+def setup_django():
+    """
+    ベンチマーク用の設定(benchmarks.settings)でDjangoを初期化する
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    import django
+
+    django.setup()
+
+
+def reset_database():
+    """
+    ベンチマーク用のDBにマイグレーションを適用し，全データを削除する
+    """
+    from django.core.management import call_command
+
+    call_command("migrate", verbosity=0)
+    call_command("flush", interactive=False, verbosity=0)
+
+
+def use_fast_hasher():
+    """
+    パスワードハッシュを高速なMD5に差し替え，ハッシュ以外の処理の差を計測しやすくする
+    """
+    from django.conf import settings
+    from django.contrib.auth.hashers import reset_hashers
+
+    settings.PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+    reset_hashers(setting="PASSWORD_HASHERS")
+
+
+def seed_accounts(count, batch_size=5000):
+    """
+    ベンチマーク用のアカウントをbulk_createで作成する(パスワードは全員共通のハッシュ)
+    """
+    from django.contrib.auth.hashers import make_password
+
+    from account.models import Account
+
+    password = make_password("benchmark-password")
+    for start in range(0, count, batch_size):
+        Account.objects.bulk_create(
+            Account(username=f"user{i:08d}", email=f"user{i:08d}@example.com", password=password)
+            for i in range(start, min(start + batch_size, count))
+        )
+
+
+def authenticated_client(user, client_class=None):
+    """
+    access_tokenのCookieを設定したテストクライアントを返す
+    """
+    from django.test import Client
+    from rest_framework_simplejwt.tokens import RefreshToken
+
+    client = (client_class or Client)()
+    client.cookies["access_token"] = str(RefreshToken.for_user(user).access_token)
+    return client
@@ -0,0 +1,340 @@
+"""
+認証・アカウントのエンドポイント(register/ login/ refresh/ get/ status/ image/post/)について，
+スループット，p50/p95/p99レイテンシ，1リクエストあたりのクエリ数を計測する．
+Djangoのテストクライアント(client)と，別プロセスで起動したASGIサーバー(asgi, uvicorn)の両方で計測できる．
+クエリ数は/metricsのhttp_request_db_queriesから求める．
+BENCH_DATABASE=postgres を指定するとconfig.settingsのPostgreSQL(POSTGRES_*)を使う．
+
+    python -m benchmarks.endpoints --accounts 1000 --requests 500 --concurrency 1,8 --json before.json
+    python -m benchmarks.endpoints --accounts 1000 --requests 500 --concurrency 1,8 --baseline before.json
+
+--baselineを指定すると同じ条件の結果と比較し，スループットまたはp95がthreshold以上悪化した場合や
+クエリ数が増えた場合は終了コード1で終了する．
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from benchmarks import reset_database, seed_accounts, setup_django
+from benchmarks.utils import latency_summary, print_table, save_json
+
+ENDPOINTS = {
+    "register": "/api/v1/register/",
+    "login": "/api/v1/login/",
+    "refresh": "/api/v1/refresh/",
+    "get": "/api/v1/get/",
+    "status": "/api/v1/status/",
+    "image": "/api/v1/image/post/",
+}
+PASSWORD = "benchmark-password"
+BOUNDARY = "BenchmarkBoundary"
+# アクセストークンを発行するユーザー数
+TOKEN_USERS = 100
+WARMUP = 10
+
+
+class ClientTransport:
+    """
+    Djangoのテストクライアントで同じプロセス内のハンドラを呼び出す
+    """
+
+    def __init__(self):
+        from django.test import Client
+
+        self.client = Client()
+
+    def request(self, method, path, body=b"", content_type="", cookie=""):
+        extra = {"HTTP_COOKIE": cookie} if cookie else {}
+        res = self.client.generic(method, path, body, content_type or "application/octet-stream", **extra)
+        # レスポンスのCookieを次のリクエストに持ち越さない
+        self.client.cookies.clear()
+        return res.status_code, res.content
+
+    def close(self):
+        from django.db import connections
+
+        connections.close_all()
+
+
+class HTTPTransport:
+    """
+    起動したサーバーにKeep-Aliveの接続でリクエストを送る
+    """
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(self, method, path, body=b"", content_type="", cookie=""):
+        headers = {}
+        if content_type:
+            headers["Content-Type"] = content_type
+        if cookie:
+            headers["Cookie"] = cookie
+        self.connection.request(method, path, body or None, headers)
+        res = self.connection.getresponse()
+        return res.status, res.read()
+
+    def close(self):
+        self.connection.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def asgi_server():
+    """
+    uvicornでconfig.asgiを起動し，HTTPTransportを作る関数を返す．
+    /metricsをプロセス内で集計するためワーカーは1プロセスとする
+    """
+    port = free_port()
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": "benchmarks.settings"}
+    command = [sys.executable, "-m", "uvicorn", "config.asgi:application", "--port", str(port)]
+    process = subprocess.Popen([*command, "--no-access-log", "--log-level", "warning"], env=env)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("uvicorn exited before accepting connections (is it installed?)")
+            try:
+                transport = HTTPTransport(port)
+                transport.request("GET", "/metrics")
+                transport.close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield lambda: HTTPTransport(port)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+class Workload:
+    """
+    エンドポイント毎のリクエスト(method, path, body, content_type, cookie)を作る．
+    登録・画像は毎回異なる内容，ログイン・トークンはシード済みのユーザーを順に使う
+    """
+
+    def __init__(self, accounts):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        from account.models import Account
+
+        self.accounts = accounts
+        self.users = list(Account.objects.order_by("id")[:TOKEN_USERS])
+        self.cookies = [f"access_token={RefreshToken.for_user(user).access_token}" for user in self.users]
+        self.sequence = itertools.count()
+
+    def build(self, endpoint):
+        from rest_framework_simplejwt.tokens import RefreshToken
+
+        i = next(self.sequence)
+        path = ENDPOINTS[endpoint]
+        if endpoint == "register":
+            data = {"username": f"bench{i}", "email": f"bench{i}@example.com", "password": PASSWORD}
+            return "POST", path, json.dumps(data).encode(), "application/json", ""
+        if endpoint == "login":
+            data = {"email": f"user{i % self.accounts:08d}@example.com", "password": PASSWORD}
+            return "POST", path, json.dumps(data).encode(), "application/json", ""
+        if endpoint == "refresh":
+            data = {"refresh": str(RefreshToken.for_user(self.users[i % len(self.users)]))}
+            return "POST", path, json.dumps(data).encode(), "application/json", ""
+        if endpoint == "image":
+            content_type = f"multipart/form-data; boundary={BOUNDARY}"
+            return "POST", path, multipart_image(i), content_type, self.cookies[i % len(self.cookies)]
+        return "GET", path, b"", "", self.cookies[i % len(self.cookies)]
+
+
+def multipart_image(i):
+    """
+    内容が毎回異なる(ハッシュが重複しない)小さなPNGをmultipart/form-dataにする
+    """
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (i % 256, i // 256 % 256, i // 65536 % 256)).save(buffer, "PNG")
+    prefix = (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="bench{i}.png"\r\n'
+        "Content-Type: image/png\r\n\r\n"
+    ).encode()
+    return prefix + buffer.getvalue() + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def scrape_queries(transport, route):
+    """
+    /metricsからrouteのクエリ数の(合計, リクエスト数)を取り出す
+    """
+    _, body = transport.request("GET", "/metrics")
+    values = {"sum": 0.0, "count": 0.0}
+    pattern = re.compile(rf'^http_request_db_queries_(sum|count){{route="{re.escape(route)}"}} (\S+)$', re.M)
+    for kind, value in pattern.findall(body.decode()):
+        values[kind] = float(value)
+    return values["sum"], values["count"]
+
+
+def run(make_transport, transport_name, endpoint, requests, concurrency, workload):
+    route = ENDPOINTS[endpoint]
+    control = make_transport()
+    # 初回のみ発生するコスト(URL解決やトークンキャッシュの作成など)を除く
+    for _ in range(WARMUP):
+        control.request(*workload.build(endpoint))
+    prepared = [workload.build(endpoint) for _ in range(requests)]
+    queries_before, count_before = scrape_queries(control, route)
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client(chunk):
+        transport = make_transport()
+        try:
+            for request in chunk:
+                start = time.perf_counter()
+                status, _ = transport.request(*request)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            transport.close()
+
+    threads = [threading.Thread(target=client, args=(prepared[i::concurrency],)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    queries_after, count_after = scrape_queries(control, route)
+    control.close()
+    return {
+        "transport": transport_name,
+        "concurrency": concurrency,
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "statuses": " ".join(f"{code}:{count}" for code, count in sorted(statuses.items())),
+        "req_per_sec": round(len(latencies) / elapsed, 2),
+        "queries_per_req": round((queries_after - queries_before) / max(count_after - count_before, 1), 2),
+        **latency_summary(latencies),
+    }
+
+
+def compare(baseline, rows, threshold):
+    """
+    同じ(transport, concurrency, endpoint)の結果と比べて悪化した項目を返す
+    """
+
+    def key(row):
+        return row["transport"], row["concurrency"], row["endpoint"]
+
+    previous = {key(row): row for row in baseline}
+    regressions = []
+    for row in rows:
+        old = previous.get(key(row))
+        if old is None:
+            continue
+        checks = [
+            ("req_per_sec", row["req_per_sec"] < old["req_per_sec"] * (1 - threshold)),
+            ("p95_ms", row["p95_ms"] > old["p95_ms"] * (1 + threshold)),
+            ("queries_per_req", row["queries_per_req"] > old["queries_per_req"]),
+        ]
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append(
+                    {
+                        "transport": row["transport"],
+                        "concurrency": row["concurrency"],
+                        "endpoint": row["endpoint"],
+                        "metric": metric,
+                        "baseline": old[metric],
+                        "current": row[metric],
+                    }
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=1000, help="事前に作成するアカウント数")
+    parser.add_argument("--requests", type=int, default=200, help="エンドポイント毎のリクエスト数")
+    parser.add_argument("--concurrency", default="1,8", help="カンマ区切りの同時接続数")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="カンマ区切りの計測するエンドポイント")
+    parser.add_argument("--transports", default="client,asgi", help="client(テストクライアント)とasgi(uvicorn)")
+    parser.add_argument("--pbkdf2", action="store_true", help="本番と同じPBKDF2ハッシュを使う")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--baseline", help="比較する以前の結果(JSON)")
+    parser.add_argument("--threshold", type=float, default=0.1, help="悪化とみなす割合(0.1で10%%)")
+    args = parser.parse_args()
+    transports = args.transports.split(",")
+    if not set(transports) <= {"client", "asgi"}:
+        parser.error("--transports must be client and/or asgi")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if not args.pbkdf2:
+        os.environ["BENCH_FAST_HASHER"] = "True"
+    setup_django()
+    from django.conf import settings
+    from django.db import connections
+
+    reset_database()
+    seed_accounts(args.accounts)
+    workload = Workload(args.accounts)
+    endpoints = args.endpoints.split(",")
+    concurrencies = [int(concurrency) for concurrency in args.concurrency.split(",")]
+
+    rows = []
+    try:
+        for transport_name in transports:
+            if transport_name == "client":
+                rows += [
+                    run(ClientTransport, "client", endpoint, args.requests, concurrency, workload)
+                    for concurrency in concurrencies
+                    for endpoint in endpoints
+                ]
+                continue
+            # サーバーのプロセスが同じDBに書き込めるよう接続を閉じておく
+            connections.close_all()
+            with asgi_server() as make_transport:
+                rows += [
+                    run(make_transport, "asgi", endpoint, args.requests, concurrency, workload)
+                    for concurrency in concurrencies
+                    for endpoint in endpoints
+                ]
+    finally:
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+    if baseline is not None:
+        regressions = compare(baseline, rows, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) (threshold {args.threshold:.0%}):")
+            print_table(regressions)
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
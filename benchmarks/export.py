@@ -0,0 +1,98 @@
+"""
+アカウントのエクスポートについて，行数毎のスループット(行/秒)とメモリ使用量を計測する．
+stream: iter_rows + export_stream(export_accountsコマンドと同じ処理)
+endpoint: users/export/csv/ のStreamingHttpResponseを読み切る
+queryset: 比較用．全行のモデルインスタンスをメモリに載せてからCSVにする
+
+    python -m benchmarks.export --rows 10000,100000 --gzip
+"""
+import argparse
+import csv
+import io
+import time
+import tracemalloc
+
+from benchmarks import authenticated_client, reset_database, seed_accounts, setup_django
+from benchmarks.utils import print_table, save_json
+
+
+def export_stream_all(fields, compress):
+    from account.export import export_stream, iter_rows
+
+    return sum(len(chunk) for chunk in export_stream("csv", fields, iter_rows(fields), compress))
+
+
+def export_endpoint(client, fields, compress):
+    query = f"?fields={','.join(fields)}" + ("&gzip=1" if compress else "")
+    res = client.get(f"/api/v1/users/export/csv/{query}")
+    assert res.status_code == 200, res.status_code
+    return sum(len(chunk) for chunk in res.streaming_content)
+
+
+def export_queryset(fields, compress):
+    import gzip
+
+    from account.models import Account
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for account in list(Account.objects.order_by("id")):
+        writer.writerow([getattr(account, field) for field in fields])
+    data = buffer.getvalue().encode()
+    return len(gzip.compress(data) if compress else data)
+
+
+def measure(func, rows):
+    start = time.perf_counter()
+    size = func()
+    elapsed = time.perf_counter() - start
+
+    # メモリ使用量は別に計測する(tracemallocは処理を遅くするため)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "rows_per_sec": round(rows / elapsed, 1),
+        "output_mb": round(size / 1024 / 1024, 2),
+        "peak_memory_mb": round(peak / 1024 / 1024, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,100000", help="カンマ区切りの行数")
+    parser.add_argument("--modes", default="stream,endpoint,queryset", help="カンマ区切りの計測する方法")
+    parser.add_argument("--gzip", action="store_true", help="gzipで圧縮する")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    from account.export import EXPORT_FIELDS
+    from account.models import Account
+
+    fields = list(EXPORT_FIELDS)
+    results = []
+    for rows in [int(rows) for rows in args.rows.split(",")]:
+        reset_database()
+        seed_accounts(rows)
+        admin = Account.objects.order_by("id").first()
+        admin.is_staff = True
+        admin.save(update_fields=["is_staff"])
+        client = authenticated_client(admin)
+        modes = {
+            "stream": lambda: export_stream_all(fields, args.gzip),
+            "endpoint": lambda: export_endpoint(client, fields, args.gzip),
+            "queryset": lambda: export_queryset(fields, args.gzip),
+        }
+        for mode in args.modes.split(","):
+            results.append({"rows": rows, "mode": mode, "gzip": args.gzip, **measure(modes[mode], rows)})
+
+    print_table(results)
+    if args.json:
+        save_json(args.json, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+パスワード検証(ログイン)をワーカープール経由で実行した時のスループットを計測する．
+
+    python -m benchmarks.hashing --workers 1,2,4 --logins 64 --clients 16
+"""
+import argparse
+import threading
+import time
+
+from benchmarks import setup_django
+from benchmarks.utils import latency_summary, print_table, save_json
+
+
+def run(backend, workers, logins, clients, password, encoded):
+    from account.hashers import HashingPool, HashingPoolBusy
+
+    pool = HashingPool(backend=backend, workers=workers, max_queue=clients)
+    latencies = []
+    rejected = 0
+    lock = threading.Lock()
+
+    def client(count):
+        nonlocal rejected
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                pool.check_password(password, encoded)
+            except HashingPoolBusy:
+                with lock:
+                    rejected += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    # ワーカーの起動時間を計測に含めないよう一度実行しておく
+    pool.check_password(password, encoded)
+    threads = [
+        threading.Thread(target=client, args=(logins // clients + (1 if i < logins % clients else 0),))
+        for i in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+
+    return {
+        "backend": backend,
+        "workers": workers,
+        "logins": len(latencies),
+        "rejected": rejected,
+        "logins_per_sec": round(len(latencies) / elapsed, 2),
+        **latency_summary(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["thread", "process", "inline"], default="thread")
+    parser.add_argument("--workers", default="1,2,4", help="カンマ区切りのプールサイズ")
+    parser.add_argument("--logins", type=int, default=64, help="ログイン試行の総数")
+    parser.add_argument("--clients", type=int, default=16, help="同時に試行するクライアント数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.hashers import make_password
+
+    password = "benchmark-password"
+    encoded = make_password(password)
+    rows = [
+        run(args.backend, int(workers), args.logins, args.clients, password, encoded)
+        for workers in args.workers.split(",")
+    ]
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+ミドルウェアの1リクエストあたりのオーバーヘッドを，全てのリクエストで同じミドルウェアを実行する場合(full)と
+URLの接頭辞毎のミドルウェア(profiles，settings.MIDDLEWARE_PROFILES)で比較する．
+noopは何もしないビューでミドルウェアのみのコストを，status/ と get/(304) は実際のエンドポイントを計測する．
+
+    python -m benchmarks.middleware --requests 5000
+"""
+import argparse
+import time
+
+from benchmarks import authenticated_client, reset_database, seed_accounts, setup_django
+from benchmarks.utils import print_table, save_json
+
+# ROOT_URLCONFとして使う(main()でconfig.urlsに何もしないビューを加える)
+urlpatterns: list = []
+
+
+def noop(request):
+    from django.http import HttpResponse
+
+    return HttpResponse(b"")
+
+
+def measure(client, path, requests, headers):
+    for _ in range(50):
+        client.get(path, **headers)
+    start = time.perf_counter()
+    for _ in range(requests):
+        res = client.get(path, **headers)
+    elapsed = time.perf_counter() - start
+    return res.status_code, elapsed / requests * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000, help="ケース毎のリクエスト数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.test import override_settings
+    from django.urls import include, path
+
+    from account.models import Account
+
+    urlpatterns.extend([path("api/v1/noop/", noop), path("noop/", noop), path("", include("config.urls"))])
+    reset_database()
+    seed_accounts(1)
+    user = Account.objects.get()
+    etag = authenticated_client(user).get("/api/v1/get/")["ETag"]
+
+    stacks = {
+        "full": [*settings.MIDDLEWARE[:-1], *settings.MIDDLEWARE_PROFILES["default"]],
+        "profiles": settings.MIDDLEWARE,
+    }
+    cases = [
+        ("/api/v1/noop/", {}),
+        ("/api/v1/status/", {}),
+        ("/api/v1/get/", {"HTTP_IF_NONE_MATCH": etag}),
+        ("/noop/", {}),
+    ]
+    results = {}
+    for name, middleware in stacks.items():
+        with override_settings(MIDDLEWARE=middleware, ROOT_URLCONF=__name__):
+            # クライアント毎にミドルウェアを読み込み直す
+            client = authenticated_client(user)
+            for case_path, headers in cases:
+                results[(name, case_path)] = measure(client, case_path, args.requests, headers)
+
+    rows = []
+    for case_path, _ in cases:
+        status, full = results[("full", case_path)]
+        _, profiles = results[("profiles", case_path)]
+        rows.append(
+            {
+                "path": case_path,
+                "status": status,
+                "full_us": round(full, 1),
+                "profiles_us": round(profiles, 1),
+                "saved_us": round(full - profiles, 1),
+                "saved_pct": round((full - profiles) / full * 100, 1),
+            }
+        )
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
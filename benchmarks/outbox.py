@@ -0,0 +1,131 @@
+"""
+アウトボックスのリレー(account.outbox.OutboxRelay)について，バッチサイズ毎の配信スループットを計測する．
+配信先はローカルのHTTPサーバー(HTTPSinkの受信側の代わり)で，--fail-rateの割合のリクエストに503を返して再送させ，
+受信したイベントが欠けずにid順に届いたかと重複した件数を確認する．
+save_ms: アカウント1件の保存(アカウントと変更イベントのINSERT)にかかった時間の平均
+
+    python -m benchmarks.outbox --events 10000 --batch-sizes 10,100,500 --fail-rate 0.1
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks import reset_database, setup_django
+from benchmarks.utils import print_table, save_json
+
+
+class Receiver(ThreadingHTTPServer):
+    """
+    POSTされたイベントのidを記録する．fail_rateの割合で503を返す
+    """
+
+    def __init__(self, fail_rate, seed):
+        super().__init__(("127.0.0.1", 0), ReceiverHandler)
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = []
+        self.requests = 0
+        self.failed = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/events"
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failed = server.rng.random() < server.fail_rate
+            if failed:
+                server.failed += 1
+            else:
+                server.ids.extend(event["id"] for event in body["events"])
+        self.send_response(503 if failed else 204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def seed_events(count):
+    """
+    アカウントを1件ずつ作成して更新し(作成と更新のイベント)，1件あたりの保存時間(秒)を返す
+    """
+    from account.models import Account
+
+    start = time.perf_counter()
+    for i in range(count // 2):
+        account = Account(username=f"user{i:08d}", email=f"user{i:08d}@example.com", password="x")
+        account.save()
+        account.image = f"https://example.com/{i}.png"
+        account.save(update_fields=["image"])
+    return (time.perf_counter() - start) / (count // 2 * 2)
+
+
+def run(receiver, batch_size, expected):
+    from account.models import OutboxCheckpoint
+    from account.outbox import HTTPSink, OutboxRelay
+
+    OutboxCheckpoint.objects.all().delete()
+    receiver.ids, receiver.requests, receiver.failed = [], 0, 0
+    relay = OutboxRelay([HTTPSink("benchmark", receiver.url)], batch_size=batch_size, retry_base=0.01)
+    start = time.perf_counter()
+    while len(set(receiver.ids)) < len(expected):
+        relay.deliver()
+    elapsed = time.perf_counter() - start
+    # 重複を除いた最初の出現順がid順で，全てのイベントが届いていること
+    first_seen = list(dict.fromkeys(receiver.ids))
+    return {
+        "batch_size": batch_size,
+        "events": len(expected),
+        "http_requests": receiver.requests,
+        "failed_requests": receiver.failed,
+        "duplicates": len(receiver.ids) - len(first_seen),
+        "in_order": first_seen == expected,
+        "events_per_sec": round(len(expected) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=10000, help="作成するイベント数(作成と更新で2件ずつ)")
+    parser.add_argument("--batch-sizes", default="10,100,500", help="カンマ区切りのバッチサイズ")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="受信側が503を返す割合")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    # 再送のたびに出力される配信失敗のログを抑える
+    logging.getLogger("account.outbox").disabled = True
+    from account.models import OutboxEvent
+
+    reset_database()
+    save_time = seed_events(args.events)
+    expected = list(OutboxEvent.objects.order_by("id").values_list("id", flat=True))
+
+    receiver = Receiver(args.fail_rate, args.seed)
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    rows = []
+    try:
+        for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+            row = run(receiver, batch_size, expected)
+            rows.append({**row, "save_ms": round(save_time * 1000, 3)})
+    finally:
+        receiver.shutdown()
+
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
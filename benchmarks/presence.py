@@ -0,0 +1,71 @@
+"""
+プレゼンスストアのハートビート処理数/秒と，OnlineUserへのフラッシュにかかる時間を計測する．
+
+    python -m benchmarks.presence --users 50000 --heartbeats 500000 --threads 4
+"""
+import argparse
+import random
+import threading
+import time
+
+from benchmarks import reset_database, seed_accounts, setup_django
+from benchmarks.utils import print_table, save_json
+
+
+def run(users, heartbeats, threads):
+    from account.models import Account, OnlineUser
+    from account.presence import PresenceStore
+
+    store = PresenceStore(ttl=60, flush_interval=3600)
+    user_ids = list(Account.objects.values_list("id", flat=True)[:users])
+
+    def client(count):
+        rng = random.Random()
+        for _ in range(count):
+            store.heartbeat(rng.choice(user_ids))
+
+    per_thread = heartbeats // threads
+    workers = [threading.Thread(target=client, args=(per_thread,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    flush_start = time.perf_counter()
+    flushed = store.flush()
+    flush_elapsed = time.perf_counter() - flush_start
+    store.stop()
+
+    return {
+        "threads": threads,
+        "heartbeats": per_thread * threads,
+        "heartbeats_per_sec": round(per_thread * threads / elapsed),
+        "online": store.count(),
+        "flushed_rows": flushed,
+        "flush_ms": round(flush_elapsed * 1000, 1),
+        "online_user_rows": OnlineUser.objects.count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--heartbeats", type=int, default=500000)
+    parser.add_argument("--threads", default="1,4", help="カンマ区切りのスレッド数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    reset_database()
+    seed_accounts(args.users)
+
+    rows = [run(args.users, args.heartbeats, int(threads)) for threads in args.threads.split(",")]
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+register/ エンドポイントの1件あたりのクエリ数と登録数/秒を計測する．
+ハッシュ計算以外のコストを見るため，既定ではMD5ハッシュを使う(--pbkdf2で本番と同じハッシュ)．
+
+    python -m benchmarks.registration --signups 500
+"""
+import argparse
+import time
+
+from benchmarks import reset_database, setup_django, use_fast_hasher
+from benchmarks.utils import latency_summary, print_table, save_json
+
+
+def run(signups, duplicates):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client()
+    latencies = []
+    queries = []
+    statuses = {}
+    start = time.perf_counter()
+    for i in range(signups):
+        # duplicatesの割合で既存ユーザーと同じユーザー名を送る
+        name = f"user{i - 1}" if duplicates and i and i % duplicates == 0 else f"user{i}"
+        data = {"username": name, "email": f"{name}-{i}@example.com", "password": "benchmark-password"}
+        request_start = time.perf_counter()
+        with CaptureQueriesContext(connection) as captured:
+            res = client.post("/api/v1/register/", data)
+        latencies.append(time.perf_counter() - request_start)
+        queries.append(len(captured))
+        statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        "signups": signups,
+        "statuses": " ".join(f"{code}:{count}" for code, count in sorted(statuses.items())),
+        "signups_per_sec": round(signups / elapsed, 2),
+        "queries_per_signup": round(sum(queries) / len(queries), 2),
+        "max_queries": max(queries),
+        **latency_summary(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signups", type=int, default=500, help="登録リクエストの総数")
+    parser.add_argument("--duplicates", type=int, default=0, help="N件に1件を重複したユーザー名で送る(0で無効)")
+    parser.add_argument("--pbkdf2", action="store_true", help="本番と同じPBKDF2ハッシュを使う")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    reset_database()
+    if not args.pbkdf2:
+        use_fast_hasher()
+
+    rows = [run(args.signups, args.duplicates)]
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
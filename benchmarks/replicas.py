@@ -0,0 +1,102 @@
+"""
+プライマリとレプリカの振り分けを2つのSQLiteファイルで確認する．
+シード後にプライマリのファイルをコピーしてレプリカとし(以降は複製されない，遅延が無限のレプリカ)，
+get/ と users/ の読み取りがどちらに送られるか，ユーザーを保存した直後はプライマリから読む(read-your-writes)かを表示する．
+
+    python -m benchmarks.replicas --sticky-seconds 1
+"""
+import argparse
+import os
+import shutil
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from benchmarks import authenticated_client, reset_database, seed_accounts, setup_django
+from benchmarks.utils import print_table, save_json
+
+
+def count_queries(func):
+    """
+    funcの実行中にデータベース毎に実行したクエリ数を返す
+    """
+    from django.db import connections
+
+    counts: Counter = Counter()
+
+    def wrapper(alias):
+        def execute(execute, sql, params, many, context):
+            counts[alias] += 1
+            return execute(sql, params, many, context)
+
+        return execute
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(wrapper(alias)))
+        result = func()
+    return result, counts
+
+
+def request(scenario, client, path, expected=None):
+    res, counts = count_queries(lambda: client.get(path))
+    data = res.json()
+    seen = data.get("username") if isinstance(data, dict) else None
+    return {
+        "scenario": scenario,
+        "path": path,
+        "status": res.status_code,
+        "primary_queries": counts["default"],
+        "replica_queries": counts["replica"],
+        "username": seen or "",
+        "ok": "" if expected is None else ("yes" if seen == expected else "NO"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=100, help="事前に作成するアカウント数")
+    parser.add_argument("--sticky-seconds", type=int, default=1, help="保存後にプライマリに固定する秒数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    os.environ["BENCH_REPLICA"] = "True"
+    os.environ["READ_REPLICA_STICKY_SECONDS"] = str(args.sticky_seconds)
+    setup_django()
+    from django.conf import settings
+    from django.db import connections
+
+    from account.models import Account
+    from config.authenticate import token_cache
+
+    reset_database()
+    seed_accounts(args.accounts)
+    connections.close_all()
+    shutil.copyfile(settings.DATABASES["default"]["NAME"], settings.DATABASES["replica"]["NAME"])
+
+    user = Account.objects.order_by("id").first()
+    client = authenticated_client(user)
+    rows = [
+        request("initial", client, "/api/v1/get/", user.username),
+        request("initial", client, "/api/v1/users/"),
+    ]
+
+    # プライマリだけを更新する(レプリカには複製されない)
+    user.username = f"{user.username}-renamed"
+    user.save()
+    rows.append(request("just saved", client, "/api/v1/get/", user.username))
+    rows.append(request("just saved", client, "/api/v1/users/"))
+
+    time.sleep(args.sticky_seconds + 0.1)
+    token_cache.clear()
+    stale = Account.objects.using("replica").get(pk=user.pk).username
+    rows.append(request("after window", client, "/api/v1/get/", stale))
+    rows.append(request("after window", client, "/api/v1/users/"))
+
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
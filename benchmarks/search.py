@@ -0,0 +1,116 @@
+"""
+users/search/ のレイテンシ(p50/p95/p99)と1リクエストあたりのクエリ数を計測する．
+ユーザー名は音節を組み合わせて作り(user00000001のような連番ではトライグラムが全員で共通になるため)，
+前方一致(キャッシュなし / あり)と，1文字を入れ替えた検索語でのあいまい検索を計測する．
+
+    python -m benchmarks.search --accounts 1000000 --queries 500
+"""
+import argparse
+import random
+import time
+
+from benchmarks import authenticated_client, reset_database, setup_django
+from benchmarks.utils import latency_summary, print_table, save_json
+
+SYLLABLES = [
+    "a", "i", "u", "e", "o", "ka", "ki", "ku", "ke", "ko", "sa", "shi", "su", "se", "so", "ta", "chi", "tsu",
+    "te", "to", "na", "ni", "nu", "ne", "no", "ha", "hi", "fu", "he", "ho", "ma", "mi", "mu", "me", "mo", "ya",
+    "yu", "yo", "ra", "ri", "ru", "re", "ro", "wa", "n", "ga", "gi", "gu", "ge", "go", "da", "de", "do", "ba",
+]  # fmt: skip
+
+
+def make_name(rng):
+    family = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    given = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+    return f"{family}_{given}"
+
+
+def seed_named_accounts(count, rng, batch_size=10000):
+    """
+    音節を組み合わせたユーザー名のアカウントを作成し，作成したユーザー名を返す
+    """
+    from django.contrib.auth.hashers import make_password
+
+    from account.models import Account
+
+    password = make_password("benchmark-password")
+    names = []
+    for start in range(0, count, batch_size):
+        batch = [f"{make_name(rng)}{i}" for i in range(start, min(start + batch_size, count))]
+        Account.objects.bulk_create(
+            Account(username=name, email=f"{name}@example.com", password=password) for name in batch
+        )
+        names.extend(batch)
+    return names
+
+
+def typo(name, rng):
+    """
+    1文字を別の文字に入れ替える
+    """
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice("aeiouknstm") + name[i + 1 :]
+
+
+def run(client, label, queries, clear_cache):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from account.search import prefix_cache
+
+    latencies = []
+    query_count = 0
+    found = 0
+    for query in queries:
+        if clear_cache:
+            prefix_cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            res = client.get("/api/v1/users/search/", {"q": query})
+            latencies.append(time.perf_counter() - start)
+        assert res.status_code == 200, res.status_code
+        query_count += len(captured)
+        found += len(res.json()["results"])
+    return {
+        "case": label,
+        "requests": len(queries),
+        "queries_per_req": round(query_count / len(queries), 2),
+        "results_per_req": round(found / len(queries), 2),
+        **latency_summary(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=1000000, help="事前に作成するアカウント数")
+    parser.add_argument("--queries", type=int, default=500, help="ケース毎の検索回数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    from account.models import Account
+
+    rng = random.Random(args.seed)
+    reset_database()
+    start = time.perf_counter()
+    names = seed_named_accounts(args.accounts, rng)
+    print(f"Seeded {args.accounts} accounts in {time.perf_counter() - start:.1f}s")
+    client = authenticated_client(Account.objects.order_by("id").first())
+
+    samples = [rng.choice(names) for _ in range(args.queries)]
+    # オートコンプリートでよく入力される短い接頭辞(少数の接頭辞が繰り返し検索される)
+    hot = [rng.choice(SYLLABLES) + rng.choice(SYLLABLES) for _ in range(20)]
+    rows = [
+        run(client, "prefix(2-4 chars, no cache)", [name[: rng.randint(2, 4)] for name in samples], True),
+        run(client, "prefix(hot, cached)", [rng.choice(hot) for _ in samples], False),
+        run(client, "prefix(full name)", samples, True),
+        run(client, "fuzzy(1 typo)", [typo(name.split("_")[0], rng) for name in samples], True),
+    ]
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+アカウントのレスポンスについて，シリアライズ(シリアライザー + JSONレンダラー)とJSONのパースの回数/秒を計測する．
+現在の構成(AccountSerializer + DRFのJSONRenderer/JSONParser)と
+軽量な構成(AccountReadSerializer + ORJSONRenderer/ORJSONParser)を比較する．
+
+    python -m benchmarks.serialization --iterations 2000 --page-size 100
+"""
+import argparse
+import time
+from io import BytesIO
+
+from benchmarks import setup_django
+from benchmarks.utils import print_table, save_json
+
+
+def make_accounts(count):
+    from account.models import Account
+
+    return [
+        Account(
+            id=i,
+            username=f"user{i:08d}",
+            email=f"user{i:08d}@example.com",
+            image=f"/media/images/ab/{i:064x}.png" if i % 2 else None,
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+def measure(func, iterations):
+    # 初回のみ発生するコスト(フィールドの構築など)を除く
+    func()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return round(iterations / (time.perf_counter() - start), 1)
+
+
+def run(stack, serializer_class, renderer, parser, accounts, iterations):
+    one, page = accounts[0], accounts
+    body = renderer.render(serializer_class(page, many=True).data)
+    return {
+        "stack": stack,
+        "object_per_sec": measure(lambda: renderer.render(serializer_class(one).data), iterations),
+        "page_per_sec": measure(lambda: renderer.render(serializer_class(page, many=True).data), iterations // 10),
+        "parse_page_per_sec": measure(lambda: parser.parse(BytesIO(body)), iterations // 10),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000, help="1件のシリアライズの回数(ページは1/10)")
+    parser.add_argument("--page-size", type=int, default=100, help="1ページのアカウント数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.parsers import JSONParser
+    from rest_framework.renderers import JSONRenderer
+
+    from account.serializers import AccountReadSerializer, AccountSerializer
+    from config.renderers import ORJSONParser, ORJSONRenderer
+
+    accounts = make_accounts(args.page_size)
+    rows = [
+        run("AccountSerializer+json", AccountSerializer, JSONRenderer(), JSONParser(), accounts, args.iterations),
+        run(
+            "AccountReadSerializer+orjson",
+            AccountReadSerializer,
+            ORJSONRenderer(),
+            ORJSONParser(),
+            accounts,
+            args.iterations,
+        ),
+    ]
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
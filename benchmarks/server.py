@@ -0,0 +1,150 @@
+"""
+`manage.py serve`(アプリケーションを読み込んでからfork)と `uvicorn --workers`(ワーカー毎にDjangoを読み込む)について，
+起動時間とメモリ使用量を比較する．
+ready_s: 起動してから全てのワーカーがリクエストを受け付けるまでの秒数
+first_schema_ms: 起動後最初のapi/schema/の処理時間
+total_pss_mb: マスターと全てのワーカーのPSS(共有ページをプロセス数で按分)の合計．実際のメモリ使用量に近い
+worker_rss_mb / worker_uss_mb: ワーカー1つあたりのRSSと固有のメモリ(USS)の平均
+stop_s: SIGTERMを送ってから終了するまでの秒数
+
+    python -m benchmarks.server --workers 4 --requests 400
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import reset_database, setup_django
+from benchmarks.endpoints import free_port
+from benchmarks.utils import print_table, save_json
+
+
+def commands(port, workers):
+    manage = [sys.executable, "manage.py", "serve", "--port", str(port), "--workers", str(workers)]
+    return {
+        "serve(wsgi)": [*manage, "--interface", "wsgi"],
+        "serve(asgi)": [*manage, "--interface", "asgi"],
+        "uvicorn --workers": [
+            sys.executable, "-m", "uvicorn", "config.asgi:application",
+            "--port", str(port), "--workers", str(workers), "--no-access-log",
+        ],
+    }  # fmt: skip
+
+
+def descendants(pid):
+    """
+    pidの子孫プロセスのpid(/procのppidから求める)
+    """
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    result, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        start = time.perf_counter()
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        connection.close()
+
+
+def run(name, command, port, workers, requests):
+    from config.server import process_memory
+
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": "benchmarks.settings"}
+    started = time.monotonic()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    # ワーカーはアプリケーションを読み込んでから"Started server process"を出力する
+    booted = []
+    all_booted = threading.Event()
+
+    def read_stderr():
+        for line in process.stderr:
+            if "Started server process" in line:
+                booted.append(time.monotonic())
+                if len(booted) >= workers:
+                    all_booted.set()
+
+    threading.Thread(target=read_stderr, daemon=True).start()
+    try:
+        if not all_booted.wait(60):
+            raise RuntimeError(f"{name}: workers did not start (exit code {process.poll()})")
+        while True:
+            try:
+                status, first_schema = get(port, "/api/schema/")
+                break
+            except OSError:
+                time.sleep(0.01)
+        ready = time.monotonic() - started
+        assert status == 200, status
+
+        # 全てのワーカーがリクエストを処理するよう並行してリクエストを送る
+        paths = ["/api/schema/", "/api/v1/status/", "/metrics"] * (requests // 3)
+        with ThreadPoolExecutor(max_workers=workers * 4) as executor:
+            list(executor.map(lambda path: get(port, path), paths))
+
+        pids = descendants(process.pid)
+        memory = {pid: process_memory(pid) for pid in [process.pid, *pids]}
+        worker_memory = [memory[pid] for pid in pids if memory[pid]]
+        row = {
+            "server": name,
+            "workers": workers,
+            "ready_s": round(ready, 2),
+            "first_schema_ms": round(first_schema * 1000, 1),
+            "total_pss_mb": round(sum(m.get("Pss", 0) for m in memory.values()) / 1024, 1),
+            "worker_rss_mb": round(sum(m["Rss"] for m in worker_memory) / len(worker_memory) / 1024, 1),
+            "worker_uss_mb": round(sum(m["Uss"] for m in worker_memory) / len(worker_memory) / 1024, 1),
+        }
+    finally:
+        stopping = time.monotonic()
+        process.terminate()
+        process.wait(timeout=60)
+    row["stop_s"] = round(time.monotonic() - stopping, 2)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="ワーカープロセス数")
+    parser.add_argument("--requests", type=int, default=400, help="メモリを計測する前に送るリクエスト数")
+    parser.add_argument("--servers", help="カンマ区切りの計測するサーバー(既定は全て)")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    reset_database()
+    rows = []
+    names = args.servers.split(",") if args.servers else list(commands(0, args.workers))
+    for name in names:
+        # 前のサーバーのポートがTIME_WAITで残っていても使えるよう，毎回別のポートを使う
+        port = free_port()
+        rows.append(run(name, commands(port, args.workers)[name], port, args.workers, args.requests))
+
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+ベンチマーク用の設定．
+config.settingsを読み込み，データベースをローカルのSQLiteに差し替える．
+"""
+import os
+import tempfile
+from datetime import timedelta
+
+os.environ.setdefault("SECRET_KEY", "benchmark-insecure-secret-key")
+os.environ.setdefault("ALLOWED_HOSTS", "*")
+
+from config.settings import *  # noqa: E402,F401,F403
+
+DEBUG = False
+
+# 計測中にアクセストークンが失効しないようにする
+SIMPLE_JWT = {**SIMPLE_JWT, "ACCESS_TOKEN_LIFETIME": timedelta(hours=1)}  # noqa: F405
+
+# BENCH_DATABASE=postgres の場合はconfig.settingsのPostgreSQL(POSTGRES_*)をそのまま使う
+if os.environ.get("BENCH_DATABASE") != "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get("BENCH_DB", os.path.join(tempfile.gettempdir(), "english-learning-bench.sqlite3")),
+            # 同時に書き込むベンチマークでロック待ちがエラーにならないようにする
+            "OPTIONS": {"timeout": 30},
+        }
+    }
+
+# BENCH_REPLICA=True の場合は別のSQLiteファイルをレプリカとして使う(benchmarks/replicas.py)
+if os.environ.get("BENCH_REPLICA") == "True":
+    DATABASES["replica"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ.get("BENCH_REPLICA_DB", DATABASES["default"]["NAME"] + ".replica"),
+    }
+    READ_REPLICA = {**READ_REPLICA, "REPLICAS": ["replica"]}  # noqa: F405
+
+# サーバーを別プロセスで起動する場合にもMD5ハッシュを使えるよう環境変数で指定する
+if os.environ.get("BENCH_FAST_HASHER") == "True":
+    PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+# ベンチマークは/metricsからクエリ数を取得する
+METRICS_TOKEN = None
+METRICS_ALLOW_ANONYMOUS = True
+
+# ベンチマークは1台のマシンで動かすため，プロセス内のキャッシュでの失効の共有は確認しない
+SILENCED_SYSTEM_CHECKS = [*SILENCED_SYSTEM_CHECKS, "account.W001"]  # noqa: F405
+
+# 同じIPアドレスから大量にログイン・登録するため，BENCH_RATE_LIMIT=True の場合のみ試行回数を制限する
+RATE_LIMIT = {**RATE_LIMIT, "ENABLED": os.environ.get("BENCH_RATE_LIMIT") == "True"}  # noqa: F405
+
+# アップロードされたファイルの保存先
+MEDIA_ROOT = os.environ.get("BENCH_MEDIA_ROOT", os.path.join(tempfile.gettempdir(), "english-learning-bench-media"))
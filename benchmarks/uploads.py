@@ -0,0 +1,151 @@
+"""
+image/post/ に大きなファイルをアップロードした時のスループット(MB/s)とメモリ使用量を計測する．
+リクエスト本文はファイルから少しずつ読み出してWSGIハンドラに渡すため，クライアント側でメモリに載せない．
+2回目は同じ内容のファイルを送り，書き込みを省略した場合の速度を計測する．
+
+    python -m benchmarks.uploads --sizes 1,50,200
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import setup_django
+from benchmarks.utils import print_table, save_json
+
+BOUNDARY = "BenchmarkBoundary"
+CHUNK_SIZE = 1024 * 1024
+
+
+class MultipartStream:
+    """
+    ファイルを読みながらmultipart/form-dataの本文を返すwsgi.input
+    """
+
+    def __init__(self, path):
+        self.prefix = (
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="image"; filename="{os.path.basename(path)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        self.suffix = f"\r\n--{BOUNDARY}--\r\n".encode()
+        self.length = len(self.prefix) + os.path.getsize(path) + len(self.suffix)
+        self.file = open(path, "rb")
+        self.pending = self.prefix
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        data = b""
+        while len(data) < size:
+            if not self.pending:
+                self.pending = self.file.read(CHUNK_SIZE)
+                if not self.pending:
+                    self.pending, self.suffix = self.suffix, b""
+                    if not self.pending:
+                        break
+            take = size - len(data)
+            data, self.pending = data + self.pending[:take], self.pending[take:]
+        return data
+
+    def readline(self, size=-1):
+        line = b""
+        while not line.endswith(b"\n") and (size is None or size < 0 or len(line) < size):
+            char = self.read(1)
+            if not char:
+                break
+            line += char
+        return line
+
+    def close(self):
+        self.file.close()
+
+
+def upload(path):
+    from django.core.handlers.wsgi import WSGIHandler
+
+    stream = MultipartStream(path)
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/api/v1/image/post/",
+        "SERVER_NAME": "testserver",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": stream,
+        "CONTENT_TYPE": f"multipart/form-data; boundary={BOUNDARY}",
+        "CONTENT_LENGTH": str(stream.length),
+    }
+    statuses = []
+    start = time.perf_counter()
+    response = WSGIHandler()(environ, lambda status, headers: statuses.append(status))
+    elapsed = time.perf_counter() - start
+    response.close()
+    stream.close()
+    return statuses[0], elapsed
+
+
+def make_file(directory, size_mb):
+    """
+    約size_mb MBのPNGを作成する(アップロード時にPillowで検証されるため有効な画像にする)．
+    乱数の画素を無圧縮で保存するため，ファイルサイズは画素数 x 3バイトとほぼ等しい
+    """
+    from PIL import Image
+
+    width = 4096
+    height = max(size_mb * CHUNK_SIZE // (width * 3), 1)
+    path = os.path.join(directory, f"upload-{size_mb}mb.png")
+    Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(path, compress_level=0)
+    return path
+
+
+def run(directory, size_mb):
+    path = make_file(directory, size_mb)
+    status, first = upload(path)
+    _, repeat = upload(path)
+
+    # メモリ使用量は別の内容のファイルで計測する(tracemallocは処理を遅くするため)
+    path = make_file(directory, size_mb)
+    tracemalloc.start()
+    upload(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "size_mb": size_mb,
+        "status": status,
+        "first_mb_per_sec": round(size_mb / first, 1),
+        "repeat_mb_per_sec": round(size_mb / repeat, 1),
+        "peak_memory_mb": round(peak / 1024 / 1024, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,50,200", help="カンマ区切りのファイルサイズ(MB)")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    # PNGのヘッダと各行のフィルタ分だけ指定したサイズより大きくなる
+    settings.IMAGE_UPLOAD_MAX_SIZE = max(sizes) * CHUNK_SIZE * 2
+    directory = tempfile.mkdtemp()
+    try:
+        # 初回のみ発生するコスト(URL解決など)を除くため一度アップロードしておく
+        upload(make_file(directory, 1))
+        rows = [run(directory, size) for size in sizes]
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+users/ のページ取得時間を計測する．
+カーソル(キーセット)ページングで先頭から順にページを辿り，指定したページでのレイテンシを
+同じ位置をLIMIT/OFFSETで取得した場合と比較する．
+
+    python -m benchmarks.user_list --pages 10000 --page-size 20
+"""
+import argparse
+import time
+
+from benchmarks import authenticated_client, reset_database, seed_accounts, setup_django
+from benchmarks.utils import print_table, save_json
+
+
+def checkpoints(pages):
+    page = 1
+    while page <= pages:
+        yield page
+        page *= 10
+    if page // 10 != pages:
+        yield pages
+
+
+def offset_latency(page, page_size, repeat):
+    from account.models import Account
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        list(Account.objects.order_by("username")[(page - 1) * page_size : page * page_size])
+    return (time.perf_counter() - start) / repeat
+
+
+def run(pages, page_size, repeat):
+    from account.models import Account
+
+    client = authenticated_client(Account.objects.order_by("id").first())
+    targets = set(checkpoints(pages))
+    rows = []
+    url = f"/api/v1/users/?page_size={page_size}"
+    # 初回のみ発生するコスト(URL解決やシリアライザの構築)を除くため一度取得しておく
+    client.get(url)
+    for page in range(1, pages + 1):
+        if page in targets:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                res = client.get(url)
+            cursor_ms = (time.perf_counter() - start) / repeat * 1000
+            rows.append(
+                {
+                    "page": page,
+                    "cursor_ms": round(cursor_ms, 3),
+                    "offset_query_ms": round(offset_latency(page, page_size, repeat) * 1000, 3),
+                }
+            )
+        else:
+            res = client.get(url)
+        url = res.json()["next"]
+        if url is None:
+            break
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=10000, help="辿るページ数")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5, help="計測するページを取得する回数")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    setup_django()
+    reset_database()
+    seed_accounts(args.pages * args.page_size + 1)
+
+    rows = run(args.pages, args.page_size, args.repeat)
+    print_table(rows)
+    if args.json:
+        save_json(args.json, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import json
+import math
+from typing import Dict, List, Sequence
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """
+    最近傍法でパーセンタイルを求める(valuesが空なら0)
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def latency_summary(latencies: Sequence[float]) -> Dict[str, float]:
+    """
+    秒単位のレイテンシ列からp50/p95/p99(ミリ秒)を返す
+    """
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def print_table(rows: List[Dict]) -> None:
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    widths = {c: max(len(c), *(len(str(row.get(c, ""))) for row in rows)) for c in columns}
+    print("  ".join(c.rjust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row.get(c, "")).rjust(widths[c]) for c in columns))
+
+
+def save_json(path: str, data) -> None:
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
@@ -1,6 +1,27 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
 from rest_framework import exceptions
 from rest_framework.authentication import CSRFCheck
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from account.revocation import revocations
+
+from .dbrouter import read_replica
+from .metrics import timed
+
+# ユーザー毎の世代(ユーザーを保存・削除する毎に1増やす)
+GENERATION_KEY = "auth:generation:{}"
 
 
 def enforce_csrf(get_response):
@@ -16,22 +37,241 @@ def enforce_csrf(get_response):
     return middleware
 
 
+class TokenCache:
+    """
+    検証済みトークンとユーザーを保持するプロセス内のLRUキャッシュ．
+    エントリはトークンのexpで失効し，ユーザーの保存・削除時に破棄される．
+    他のプロセスでの保存・削除は，cacheに指定した共有キャッシュのユーザー毎の世代で伝える
+    (エントリは保存時の世代と一致する場合のみ使う)．
+    返すユーザーはリクエスト毎のコピーで，キャッシュ内のインスタンスは変更されない．
+    """
+
+    def __init__(self, max_size: int, cache: Optional[str] = None, timeout: Optional[int] = None):
+        self.max_size = max_size
+        self.cache_alias = cache
+        # 世代を保持する秒数(アクセストークンの有効期間以上)
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Any, Tuple[Any, Any, float, int]]" = OrderedDict()
+        self._keys_by_user: Dict[Any, Set[Any]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "TokenCache":
+        conf = settings.AUTH_TOKEN_CACHE
+        lifetime = settings.SIMPLE_JWT["ACCESS_TOKEN_LIFETIME"]
+        return cls(conf["SIZE"], cache=conf["CACHE"], timeout=int(lifetime.total_seconds()) + 60)
+
+    def get(self, raw_token) -> Optional[Tuple[Any, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(raw_token)
+            if entry is None or entry[2] <= now:
+                if entry is not None:
+                    self._remove(raw_token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(raw_token)
+        user, validated_token, _, generation = entry
+        if self.generation(user.pk) != generation:
+            # 他のプロセスでユーザーが保存・削除された
+            with self._lock:
+                if self._entries.get(raw_token) is entry:
+                    self._remove(raw_token)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return copy.copy(user), validated_token
+
+    def set(self, raw_token, user, validated_token, generation: int = 0) -> None:
+        """
+        generationはユーザーを取得する前にgeneration()で取得した世代
+        """
+        if self.max_size <= 0:
+            return
+        exp = validated_token.get("exp")
+        if exp is None:
+            return
+        with self._lock:
+            if raw_token in self._entries:
+                self._remove(raw_token)
+            self._entries[raw_token] = (copy.copy(user), validated_token, float(exp), generation)
+            self._keys_by_user.setdefault(user.pk, set()).add(raw_token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def generation(self, user_id) -> int:
+        if self.cache_alias is None or self.max_size <= 0:
+            return 0
+        return caches[self.cache_alias].get(GENERATION_KEY.format(user_id), 0)
+
+    def invalidate_user(self, user_id) -> None:
+        """
+        このプロセスのエントリを破棄し，共有キャッシュの世代を進めて他のプロセスのエントリも使わせない
+        """
+        with self._lock:
+            for raw_token in self._keys_by_user.pop(user_id, set()):
+                self._entries.pop(raw_token, None)
+        if self.cache_alias is None or self.max_size <= 0:
+            return
+        cache = caches[self.cache_alias]
+        key = GENERATION_KEY.format(user_id)
+        cache.add(key, 0, self.timeout)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # addとincrの間に失効した
+            cache.set(key, 1, self.timeout)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+    def _remove(self, raw_token) -> None:
+        user = self._entries.pop(raw_token)[0]
+        keys = self._keys_by_user.get(user.pk)
+        if keys is not None:
+            keys.discard(raw_token)
+            if not keys:
+                del self._keys_by_user[user.pk]
+
+
+token_cache = TokenCache.from_settings()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_token_cache(sender, instance, **kwargs):
+    """
+    ユーザーが更新・削除されたら，全てのプロセスでキャッシュ済みのトークンを使わせない
+    (QuerySet.updateはシグナルを発行しないため対象外)
+    """
+    token_cache.invalidate_user(instance.pk)
+
+
 class CustomAuthentication(JWTAuthentication):
     """
     CookieのJWTトークンを使用して認証を行う．
     ヘッダーにAuthorizationがある場合はそちらを使用．
+    検証済みのトークンはtoken_cacheに保持し，署名検証とユーザー取得を省略する．
     """
 
-    def authenticate(self, request):
+    def get_request_token(self, request):
         header = self.get_header(request)
 
         if header is None:
-            raw_token = request.COOKIES.get("access_token") or None
-        else:
-            raw_token = self.get_raw_token(header)
+            return request.COOKIES.get("access_token") or None
+        return self.get_raw_token(header)
+
+    def authenticate(self, request):
+        raw_token = self.get_request_token(request)
+        if raw_token is None:
+            return None
+
+        with timed("auth"):
+            cached = token_cache.get(raw_token)
+            if cached is not None:
+                self.check_revoked(cached[1])
+                enforce_csrf(request)
+                return cached
+
+            validated_token = self.get_validated_token(raw_token)
+            self.check_revoked(validated_token)
+            enforce_csrf(request)
+            # ユーザーの取得中に保存された場合にエントリを使わせないよう，取得前の世代を記録する
+            generation = token_cache.generation(validated_token.get(api_settings.USER_ID_CLAIM))
+            user = self.get_user(validated_token)
+            token_cache.set(raw_token, user, validated_token, generation)
+        return user, validated_token
+
+    async def aauthenticate(self, request):
+        """
+        非同期ビュー用のauthenticate(ユーザー取得に非同期ORMを使う)
+        """
+        raw_token = self.get_request_token(request)
         if raw_token is None:
             return None
 
-        validated_token = self.get_validated_token(raw_token)
-        enforce_csrf(request)
-        return self.get_user(validated_token), validated_token
+        with timed("auth"):
+            cached = token_cache.get(raw_token)
+            if cached is not None:
+                self.check_revoked(cached[1])
+                return cached
+
+            validated_token = self.get_validated_token(raw_token)
+            self.check_revoked(validated_token)
+            generation = token_cache.generation(validated_token.get(api_settings.USER_ID_CLAIM))
+            user = await self.aget_user(validated_token)
+            token_cache.set(raw_token, user, validated_token, generation)
+        return user, validated_token
+
+    def check_revoked(self, validated_token):
+        """
+        ログアウトで失効させたトークンを拒否する(プロセス内の辞書を参照するだけでDBアクセスなし)
+        """
+        if revocations.is_revoked(validated_token[api_settings.JTI_CLAIM]):
+            raise InvalidToken(_("Token is blacklisted"))
+
+    def get_user(self, validated_token):
+        # ユーザーはレプリカから取得する(保存直後のユーザーはプライマリ)
+        with read_replica(validated_token.get(api_settings.USER_ID_CLAIM)):
+            return super().get_user(validated_token)
+
+    async def aget_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        try:
+            with read_replica(user_id):
+                user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        return user
+
+
+class ClaimsOnlyAuthentication(CustomAuthentication):
+    """
+    トークンのクレームのみからユーザー(TokenUser)を組み立てる．
+    Accountの行を参照しないビューのauthentication_classesに指定するとDBアクセスが発生しない．
+    """
+
+    def authenticate(self, request):
+        raw_token = self.get_request_token(request)
+        if raw_token is None:
+            return None
+
+        with timed("auth"):
+            validated_token = self.get_validated_token(raw_token)
+            self.check_revoked(validated_token)
+            enforce_csrf(request)
+            user = self.get_user(validated_token)
+        return user, validated_token
+
+    async def aauthenticate(self, request):
+        # DBアクセスがないためそのまま呼び出す
+        return self.authenticate(request)
+
+    def get_user(self, validated_token):
+        return JWTStatelessUserAuthentication.get_user(self, validated_token)
@@ -0,0 +1,104 @@
+"""
+読み取り専用のクエリをレプリカに振り分けるDBルーター．
+read_replica()の中で実行した読み取りだけをレプリカに送り，それ以外の読み取りと書き込みはプライマリ(default)を使う．
+ユーザーを保存した直後(STICKY_SECONDS秒)は，そのユーザーのread_replica()もプライマリを使う(read-your-writes)．
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+_use_replica: ContextVar[bool] = ContextVar("use_replica", default=False)
+
+
+class StickyUsers:
+    """
+    保存したユーザーを一定時間プライマリに固定する．cacheを指定すると他のプロセスとも共有する
+    """
+
+    # 期限切れのエントリを削除する件数の目安
+    prune_size = 10000
+
+    def __init__(self, seconds=5, cache=None) -> None:
+        self.seconds = seconds
+        self.cache_alias = cache
+        # user_id -> 固定を解除する時刻(time.monotonic())
+        self._until: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "StickyUsers":
+        conf = settings.READ_REPLICA
+        return cls(seconds=conf["STICKY_SECONDS"], cache=conf["CACHE"])
+
+    def pin(self, user_id: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._until[user_id] = now + self.seconds
+            if len(self._until) > self.prune_size:
+                self._until = {key: until for key, until in self._until.items() if until > now}
+        if self.cache_alias:
+            caches[self.cache_alias].set(self._cache_key(user_id), 1, self.seconds)
+
+    def is_pinned(self, user_id: int) -> bool:
+        until = self._until.get(user_id)
+        if until is not None and until > time.monotonic():
+            return True
+        if self.cache_alias:
+            return caches[self.cache_alias].get(self._cache_key(user_id)) is not None
+        return False
+
+    def _cache_key(self, user_id: int) -> str:
+        return f"sticky-primary:{user_id}"
+
+
+sticky_users = StickyUsers.from_settings()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def pin_saved_user(sender, instance, **kwargs):
+    """
+    保存直後のユーザーの読み取りはレプリカの遅延の影響を受けないようプライマリに送る
+    (QuerySet.updateはシグナルを発行しないため対象外)
+    """
+    sticky_users.pin(instance.pk)
+
+
+@contextmanager
+def read_replica(user_id: Optional[int] = None):
+    """
+    この中の読み取りをレプリカに送る．user_idが保存直後のユーザーの場合はプライマリのまま
+    """
+    if not settings.READ_REPLICA["REPLICAS"] or (user_id is not None and sticky_users.is_pinned(user_id)):
+        yield
+        return
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get():
+            return random.choice(settings.READ_REPLICA["REPLICAS"])
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製のため，どの組み合わせでも同じデータベースとみなす
+        databases = {"default", *settings.READ_REPLICA["REPLICAS"]}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
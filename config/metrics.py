@@ -0,0 +1,401 @@
+"""
+リクエスト毎の計測値を固定メモリのヒストグラムに集計し，Prometheusのテキスト形式で出力する．
+prefork(`python manage.py serve`)の各ワーカーは計測値を共有ディレクトリ(MetricsRegistry.directory)に書き出し，
+/metricsでは全てのワーカーの値を合算して出力する．
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 秒単位のバケット(上限)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# 終了したワーカーのcounterとヒストグラムの値をまとめたファイル
+ARCHIVE_FILE = "archive.json"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[Tuple[str, int]], float, int]:
+        """
+        ([(le, 累積件数)], 合計, 件数)を返す
+        """
+        counts, total, count = self.values()
+        return cumulative_counts(self.buckets, counts), total, count
+
+    def values(self) -> Tuple[List[int], float, int]:
+        """
+        (バケット毎の件数, 合計, 件数)を返す
+        """
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+def cumulative_counts(buckets, counts) -> List[Tuple[str, int]]:
+    cumulative = []
+    running = 0
+    for bound, value in zip([*map(str, buckets), "+Inf"], counts):
+        running += value
+        cumulative.append((bound, running))
+    return cumulative
+
+
+class RequestMetrics:
+    """
+    1リクエストの中で計測した値(ミドルウェアがContextVarに設定する)
+    """
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = {}
+        self.queries = 0
+
+    def add(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+current_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar("current_request_metrics", default=None)
+
+
+@contextmanager
+def timed(name: str):
+    """
+    処理時間を現在のリクエストの計測値に加算する(リクエスト外では何もしない)
+    """
+    metrics = current_request_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start)
+
+
+def observe_query(execute, sql, params, many, context):
+    """
+    クエリの実行時間と件数を現在のリクエストの計測値に加算するexecute_wrapper
+    """
+    request_metrics = current_request_metrics.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_metrics.add("db", time.perf_counter() - start)
+        request_metrics.queries += 1
+
+
+Collector = Callable[[], Iterable[Tuple[str, str, Dict[str, str], float]]]
+
+
+class MetricsRegistry:
+    """
+    (メトリクス名, ルート)毎のヒストグラムと，登録されたコレクターの値を保持する．
+    directoryを設定した場合(preforkのワーカー)は計測値を<directory>/<pid>.jsonに書き出し，
+    render()ではディレクトリ内の全てのプロセスの値を合算する
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.help: Dict[str, str] = {}
+        self.collectors: List[Collector] = []
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, route: str, help_text: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+        key = (name, route)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+                self.help.setdefault(name, help_text)
+        return histogram
+
+    def register_collector(self, collector: Collector) -> None:
+        """
+        collectorは(名前, 型(counter/gauge), ラベル, 値)を返す関数
+        """
+        self.collectors.append(collector)
+
+    def snapshot(self) -> Dict:
+        """
+        このプロセスの計測値．プロセス間で合算するためJSONにできる形で返す
+        """
+        histograms = []
+        for (name, route), histogram in sorted(self.histograms.items()):
+            counts, total, count = histogram.values()
+            histograms.append(
+                {
+                    "name": name,
+                    "route": route,
+                    "help": self.help.get(name, ""),
+                    "buckets": list(histogram.buckets),
+                    "counts": counts,
+                    "sum": total,
+                    "count": count,
+                }
+            )
+        samples = []
+        for collector in self.collectors:
+            for name, metric_type, labels, sample in collector():
+                samples.append({"name": name, "type": metric_type, "labels": labels, "value": sample})
+        return {"histograms": histograms, "samples": samples}
+
+    def write(self) -> None:
+        """
+        このプロセスの計測値を<directory>/<pid>.jsonに書き出す(directoryが未設定の場合は何もしない)
+        """
+        if self.directory is not None:
+            write_snapshot(os.path.join(self.directory, f"{os.getpid()}.json"), self.snapshot())
+
+    def start_writer(self, interval: float = 5.0) -> None:
+        """
+        interval秒毎にwrite()するスレッドを起動する(preforkのワーカーで呼び出す)
+        """
+
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write()
+                except Exception:
+                    logger.exception("Failed to write the metrics snapshot")
+
+        threading.Thread(target=run, name="metrics-writer", daemon=True).start()
+
+    def render(self) -> str:
+        if self.directory is None:
+            return render_snapshot(self.snapshot())
+        self.write()
+        return render_snapshot(merge_snapshots(read_snapshots(self.directory)))
+
+
+def write_snapshot(path: str, snapshot: Dict) -> None:
+    # 読み込み中のプロセスに書きかけの内容を見せないよう，別のファイルに書いてから置き換える
+    temporary = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def read_snapshots(directory: str) -> List[Tuple[Optional[int], Dict]]:
+    """
+    ディレクトリ内の(pid, 計測値)．終了したワーカーの値をまとめたarchive.jsonはpidをNoneとし，
+    archive.jsonにまとめ済みのワーカーのファイル(削除される前のもの)は読まない
+    """
+    snapshots: List[Tuple[Optional[int], Dict]] = []
+    archived: List[int] = []
+    try:
+        with open(os.path.join(directory, ARCHIVE_FILE)) as f:
+            archive = json.load(f)
+        archived = archive["pids"]
+        snapshots.append((None, archive))
+    except FileNotFoundError:
+        pass
+    for file_name in sorted(os.listdir(directory)):
+        pid_text, ext = os.path.splitext(file_name)
+        if ext != ".json" or not pid_text.isdigit() or int(pid_text) in archived:
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                snapshots.append((int(pid_text), json.load(f)))
+        except FileNotFoundError:
+            # 読み込む前にarchive.jsonにまとめられた
+            pass
+    return snapshots
+
+
+def archive_snapshot(directory: str, pid: int) -> None:
+    """
+    終了したワーカーのcounterとヒストグラムの値をarchive.jsonに足し合わせ，ワーカーのファイルを削除する
+    (counterが減って見えないようにする)．gaugeは終了したワーカーの値を残さない．マスタープロセスから呼び出す
+    """
+    path = os.path.join(directory, f"{pid}.json")
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    archive_path = os.path.join(directory, ARCHIVE_FILE)
+    try:
+        with open(archive_path) as f:
+            archive = json.load(f)
+    except FileNotFoundError:
+        archive = {"pids": [], "histograms": [], "samples": []}
+    snapshot["samples"] = [sample for sample in snapshot["samples"] if sample["type"] != "gauge"]
+    merged = merge_snapshots([(None, archive), (None, snapshot)])
+    # 削除済みのワーカーのpidは残さない
+    pids = [archived for archived in archive["pids"] if os.path.exists(os.path.join(directory, f"{archived}.json"))]
+    write_snapshot(archive_path, {**merged, "pids": [*pids, pid]})
+    os.remove(path)
+
+
+def merge_snapshots(snapshots: Iterable[Tuple[Optional[int], Dict]]) -> Dict:
+    """
+    プロセス毎の計測値を合算する．ヒストグラムとcounterは足し合わせ，gaugeはpidのラベルを付けてプロセス毎に出力する
+    (pidがNoneの計測値にはラベルを付けない)
+    """
+    histograms: Dict[Tuple[str, str], Dict] = {}
+    samples: Dict[Tuple[str, Tuple], Dict] = {}
+    for pid, snapshot in snapshots:
+        for item in snapshot["histograms"]:
+            key = (item["name"], item["route"])
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = {**item, "counts": list(item["counts"])}
+            elif merged["buckets"] == item["buckets"]:
+                merged["counts"] = [a + b for a, b in zip(merged["counts"], item["counts"])]
+                merged["sum"] += item["sum"]
+                merged["count"] += item["count"]
+        for item in snapshot["samples"]:
+            labels = item["labels"]
+            if item["type"] == "gauge" and pid is not None:
+                labels = {**labels, "pid": str(pid)}
+            sample_key = (item["name"], tuple(sorted(labels.items())))
+            if sample_key in samples:
+                samples[sample_key]["value"] += item["value"]
+            else:
+                samples[sample_key] = {**item, "labels": labels}
+    return {
+        "histograms": [histograms[key] for key in sorted(histograms)],
+        # 同じ名前の値が続くように並べる(コレクターの順序は保つ)
+        "samples": sorted(samples.values(), key=lambda sample: sample["name"]),
+    }
+
+
+def render_snapshot(snapshot: Dict) -> str:
+    lines: List[str] = []
+    declared = set()
+    for item in snapshot["histograms"]:
+        name = item["name"]
+        if name not in declared:
+            lines.append(f"# HELP {name} {item['help']}")
+            lines.append(f"# TYPE {name} histogram")
+            declared.add(name)
+        route_label = escape_label(item["route"])
+        for bound, value in cumulative_counts(item["buckets"], item["counts"]):
+            lines.append(f'{name}_bucket{{route="{route_label}",le="{bound}"}} {value}')
+        lines.append(f'{name}_sum{{route="{route_label}"}} {item["sum"]}')
+        lines.append(f'{name}_count{{route="{route_label}"}} {item["count"]}')
+
+    for sample in snapshot["samples"]:
+        name = sample["name"]
+        if name not in declared:
+            lines.append(f"# TYPE {name} {sample['type']}")
+            declared.add(name)
+        label_text = ",".join(f'{key}="{escape_label(str(v))}"' for key, v in sample["labels"].items())
+        lines.append(f"{name}{{{label_text}}} {sample['value']}" if label_text else f"{name} {sample['value']}")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = MetricsRegistry()
+
+
+class SlowRequestProfiler:
+    """
+    リクエストを処理中のスレッドのスタックを一定間隔でサンプリングし，
+    処理時間の長い上位keep件のリクエストについてflame graph用のfolded形式のスタックを保持する．
+    """
+
+    def __init__(self, enabled: bool = False, interval: float = 0.005, keep: int = 10) -> None:
+        self.enabled = enabled
+        self.interval = interval
+        self.keep = keep
+        # (処理時間, ルート, スタック毎のサンプル数)
+        self.slowest: List[Tuple[float, str, Counter]] = []
+        self._active: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_settings(cls) -> "SlowRequestProfiler":
+        conf = settings.PROFILE_SLOW_REQUESTS
+        return cls(enabled=conf["ENABLED"], interval=conf["INTERVAL"], keep=conf["KEEP"])
+
+    def begin(self) -> None:
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+
+    def end(self, route: str, elapsed: float) -> None:
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+            if stacks is None or (len(self.slowest) >= self.keep and elapsed <= self.slowest[-1][0]):
+                return
+            self.slowest.append((elapsed, route, stacks))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.keep :]
+
+    def folded(self) -> str:
+        """
+        "関数;関数;... サンプル数"の形式(flamegraph.plなどの入力)で出力する
+        """
+        lines = []
+        with self._lock:
+            slowest = list(self.slowest)
+        for elapsed, route, stacks in slowest:
+            lines.append(f"# {route} {elapsed * 1000:.1f}ms")
+            lines.extend(f"{stack} {count}" for stack, count in stacks.most_common())
+        return "\n".join(lines) + "\n"
+
+    def _after_fork(self) -> None:
+        # サンプリング用のスレッドは子プロセスには引き継がれない
+        self._thread = None
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[fold_stack(frame)] += 1
+
+
+def fold_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+slow_requests = SlowRequestProfiler.from_settings()
+os.register_at_fork(after_in_child=slow_requests._after_fork)
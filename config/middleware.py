@@ -1,14 +1,293 @@
+import logging
+import time
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .metrics import COUNT_BUCKETS, RequestMetrics, current_request_metrics, observe_query, registry, slow_requests
+from .querybudget import QueryBudgetExceeded, QueryLog, current_query_log, get_query_budget, log_query
+
+logger = logging.getLogger(__name__)
+
+TIMINGS = [
+    ("auth", "Time spent validating the JWT and loading the user"),
+    ("db", "Time spent executing SQL queries"),
+    ("render", "Time spent rendering the response body"),
+]
+
+
+@receiver(connection_created)
+def install_query_wrappers(sender, connection, **kwargs):
+    """
+    接続毎に1度だけ計測用のexecute_wrapperを追加する．計測対象のリクエストはContextVarで渡すため，
+    非同期ビューの非同期ORM(sync_to_asyncのスレッド)で実行したクエリも同じリクエストに集計される
+    """
+    for wrapper in (observe_query, log_query):
+        if wrapper not in connection.execute_wrappers:
+            # execute_wrapper()は末尾の要素をpopするため，先頭に追加する
+            connection.execute_wrappers.insert(0, wrapper)
+
+
+def adapt(handler, handler_is_async, is_async):
+    """
+    ハンドラを呼び出し元に合わせて同期・非同期に変換する(BaseHandler.adapt_method_modeと同じ)
+    """
+    if is_async and not handler_is_async:
+        return sync_to_async(handler, thread_sensitive=True)
+    if not is_async and handler_is_async:
+        return async_to_sync(handler)
+    return handler
 
 
 class SameSiteMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        response = self.get_response(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if not response.cookies:
+            return response
         for key in response.cookies.keys():
             if response.cookies.get(key):
                 response.cookies[key]["samesite"] = "Lax" if settings.DEBUG else "None"
                 response.cookies[key]["secure"] = not settings.DEBUG
         return response
+
+
+class _MiddlewareChain:
+    """
+    ミドルウェアのリストからハンドラを組み立てる(BaseHandler.load_middlewareと同じ順序)．
+    is_asyncの場合は非同期に対応したミドルウェアを非同期で呼び出し，同期のみのミドルウェアだけをsync_to_asyncで包む
+    """
+
+    def __init__(self, paths, get_response, is_async=False):
+        self.view_middleware = []
+        self.template_response_middleware = []
+        self.exception_middleware = []
+        handler = get_response
+        handler_is_async = is_async
+        for path in reversed(paths):
+            middleware = import_string(path)
+            if not handler_is_async and getattr(middleware, "sync_capable", True):
+                middleware_is_async = False
+            else:
+                middleware_is_async = getattr(middleware, "async_capable", False)
+            adapted = adapt(handler, handler_is_async, middleware_is_async)
+            try:
+                instance = middleware(adapted)
+            except MiddlewareNotUsed:
+                continue
+            if hasattr(instance, "process_view"):
+                method = instance.process_view
+                self.view_middleware.insert(0, adapt(method, iscoroutinefunction(method), is_async))
+            if hasattr(instance, "process_template_response"):
+                self.template_response_middleware.append(instance.process_template_response)
+            if hasattr(instance, "process_exception"):
+                self.exception_middleware.append(instance.process_exception)
+            handler = convert_exception_to_response(instance)
+            handler_is_async = middleware_is_async
+        self.handler = adapt(handler, handler_is_async, is_async)
+
+
+class MiddlewareProfiles:
+    """
+    URLの接頭辞毎に異なるミドルウェアを実行する(settings.MIDDLEWARE_PROFILES)．
+    最も長く一致した接頭辞のミドルウェアを，一致しない場合は"default"のミドルウェアを実行する．
+    process_view / process_template_response / process_exceptionは選んだミドルウェアに振り分ける
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+            # 同期のprocess_viewはDjangoがsync_to_asyncで別スレッドで呼び出すため，非同期版に差し替える
+            self.process_view = self.aprocess_view
+        profiles = settings.MIDDLEWARE_PROFILES
+        self.default = _MiddlewareChain(profiles["default"], get_response, self.is_async)
+        self.chains = sorted(
+            (
+                (prefix, _MiddlewareChain(paths, get_response, self.is_async))
+                for prefix, paths in profiles.items()
+                if prefix != "default"
+            ),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+
+    def select(self, path):
+        for prefix, chain in self.chains:
+            if path.startswith(prefix):
+                return chain
+        return self.default
+
+    def __call__(self, request):
+        request.middleware_chain = chain = self.select(request.path_info)
+        return chain.handler(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        for method in request.middleware_chain.view_middleware:
+            response = method(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        for method in request.middleware_chain.view_middleware:
+            response = await method(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_template_response(self, request, response):
+        for method in request.middleware_chain.template_response_middleware:
+            response = method(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        for method in request.middleware_chain.exception_middleware:
+            response = method(request, exception)
+            if response is not None:
+                return response
+        return None
+
+
+class InstrumentationMiddleware:
+    """
+    ルート毎に処理時間・JWTの検証時間・ORMの時間とクエリ数・レスポンスのレンダリング時間を計測し，
+    config.metrics.registryのヒストグラムに集計する．
+    settings.PROFILE_SLOW_REQUESTSが有効な場合は処理時間の長いリクエストのスタックをサンプリングする
+    (非同期の場合はイベントループのスタックをリクエスト毎に分けられないため，サンプリングしない)．
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.profiler = slow_requests if slow_requests.enabled else None
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        if self.profiler is not None:
+            self.profiler.begin()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request_metrics.reset(token)
+            route = self.get_route(request)
+            if self.profiler is not None:
+                self.profiler.end(route, elapsed)
+        self.record(route, elapsed, request_metrics)
+        return response
+
+    async def __acall__(self, request):
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request_metrics.reset(token)
+        self.record(self.get_route(request), elapsed, request_metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRFのResponseはこの後にレンダリングされる
+        request_metrics = current_request_metrics.get()
+        if request_metrics is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda r: request_metrics.add("render", time.perf_counter() - start))
+        return response
+
+    def get_route(self, request):
+        match = getattr(request, "resolver_match", None)
+        return f"/{match.route}" if match is not None else "unmatched"
+
+    def record(self, route, elapsed, request_metrics):
+        registry.histogram("http_request_duration_seconds", route, "Wall time of the request").observe(elapsed)
+        registry.histogram("http_request_db_queries", route, "Number of SQL queries", COUNT_BUCKETS).observe(
+            request_metrics.queries
+        )
+        for name, help_text in TIMINGS:
+            registry.histogram(f"http_request_{name}_seconds", route, help_text).observe(
+                request_metrics.timings.get(name, 0.0)
+            )
+
+
+class QueryBudgetMiddleware:
+    """
+    ビューのクエリバジェットを超えたリクエストと，同じ形のSQLを繰り返したリクエスト(N+1)を報告する．
+    settings.QUERY_BUDGET["MODE"]が"log"なら警告をログに出力し，"raise"ならQueryBudgetExceededを送出する．
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        conf = settings.QUERY_BUDGET
+        if conf["MODE"] not in ("log", "raise"):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.mode = conf["MODE"]
+        self.threshold = conf["N_PLUS_ONE_THRESHOLD"]
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        query_log = QueryLog()
+        token = current_query_log.set(query_log)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_query_log.reset(token)
+        self.check(request, query_log)
+        return response
+
+    async def __acall__(self, request):
+        query_log = QueryLog()
+        token = current_query_log.set(query_log)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_query_log.reset(token)
+        self.check(request, query_log)
+        return response
+
+    def check(self, request, query_log):
+        budget = get_query_budget(getattr(request, "resolver_match", None))
+        messages = query_log.violations(budget, self.threshold)
+        if messages:
+            report = "\n".join([f"{request.method} {request.path}", *messages])
+            if self.mode == "raise":
+                raise QueryBudgetExceeded(report)
+            logger.warning(report)
@@ -0,0 +1,123 @@
+"""
+ビュー毎のクエリ数の上限(クエリバジェット)と，同じ形のSQLの繰り返し(N+1)の検出．
+バジェットはビュークラスのquery_budget属性，またはurls.pyでquery_budget(n)(view)として指定する．
+settings.QUERY_BUDGET["MODE"]が"log"の場合は警告をログに出力し，"raise"の場合はQueryBudgetExceededを送出する．
+"""
+import os
+import re
+import traceback
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+# 呼び出し元として表示するプロジェクト内のフレーム数
+CALL_SITE_DEPTH = 3
+# 計測用のフレームは呼び出し元に含めない
+INSTRUMENTATION_FILES = {
+    __file__,
+    *(os.path.join(os.path.dirname(__file__), name) for name in ("middleware.py", "metrics.py")),
+}
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(limit: int):
+    """
+    ビュークラスまたはビュー関数にクエリ数の上限を設定するデコレーター
+    """
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def get_query_budget(resolver_match) -> Optional[int]:
+    if resolver_match is None:
+        return None
+    func = resolver_match.func
+    budget = getattr(func, "query_budget", None)
+    if budget is None:
+        budget = getattr(getattr(func, "view_class", None), "query_budget", None)
+    return budget
+
+
+def sql_shape(sql: str) -> str:
+    """
+    パラメーターの値やIN句の要素数を除いたSQLの形
+    """
+    sql = re.sub(r"\(\s*%s(\s*,\s*%s)*\s*\)", "(...)", sql)
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    return re.sub(r"\b\d+\b", "?", sql)
+
+
+def call_site() -> Tuple[str, ...]:
+    """
+    クエリを発行したプロジェクト内のフレーム(内側から順)
+    """
+    base_dir = str(settings.BASE_DIR)
+    frames = []
+    for frame in reversed(traceback.extract_stack()):
+        filename = frame.filename
+        if not filename.startswith(base_dir) or "site-packages" in filename or filename in INSTRUMENTATION_FILES:
+            continue
+        frames.append(f"{filename[len(base_dir) + 1 :]}:{frame.lineno} in {frame.name}")
+        if len(frames) >= CALL_SITE_DEPTH:
+            break
+    return tuple(frames)
+
+
+class QueryLog:
+    """
+    1リクエストの中で実行したクエリの形と呼び出し元を記録する
+    """
+
+    def __init__(self) -> None:
+        self.queries: List[Tuple[str, Tuple[str, ...]]] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql_shape(sql), call_site()))
+        return execute(sql, params, many, context)
+
+    def repeated(self, threshold: int) -> Dict[str, List[Tuple[str, ...]]]:
+        """
+        threshold回以上実行された形と，その呼び出し元
+        """
+        sites: Dict[str, List[Tuple[str, ...]]] = defaultdict(list)
+        for shape, site in self.queries:
+            sites[shape].append(site)
+        return {shape: found for shape, found in sites.items() if len(found) >= threshold}
+
+    def violations(self, budget: Optional[int], threshold: int) -> List[str]:
+        messages = []
+        if budget is not None and len(self.queries) > budget:
+            lines = [f"{len(self.queries)} queries (budget {budget}):"]
+            lines += [f"  {shape}\n    at {format_site(site)}" for shape, site in self.queries]
+            messages.append("\n".join(lines))
+        for shape, sites in self.repeated(threshold).items():
+            lines = [f"Possible N+1: {len(sites)} queries with the same shape:", f"  {shape}"]
+            lines += [f"    at {format_site(site)}" for site in sorted(set(sites))]
+            messages.append("\n".join(lines))
+        return messages
+
+
+current_query_log: ContextVar[Optional[QueryLog]] = ContextVar("current_query_log", default=None)
+
+
+def log_query(execute, sql, params, many, context):
+    """
+    現在のリクエストのQueryLogにクエリを記録するexecute_wrapper(QueryBudgetMiddlewareが設定する)
+    """
+    query_log = current_query_log.get()
+    if query_log is None:
+        return execute(sql, params, many, context)
+    return query_log(execute, sql, params, many, context)
+
+
+def format_site(site: Tuple[str, ...]) -> str:
+    return " <- ".join(site) if site else "(outside the project)"
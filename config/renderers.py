@@ -0,0 +1,38 @@
+"""
+orjsonを使うJSONのレンダラーとパーサー．orjsonがインストールされていない場合はDRFの実装(標準のjson)で処理する．
+"""
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+_encoder = JSONEncoder()
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson is not None else 0
+
+
+class ORJSONRenderer(renderers.JSONRenderer):
+    """
+    indent等を指定された場合(ブラウザブルAPIなど)はDRFのJSONRendererで処理する
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.get_indent(accepted_media_type or "", renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b""
+        # orjsonが扱えない型(遅延評価の文字列など)と，DRFと形式が異なる日時(UTCの"Z"，ミリ秒まで)はDRFのエンコーダーで変換する
+        return orjson.dumps(data, default=_encoder.default, option=OPTIONS)
+
+
+class ORJSONParser(parsers.JSONParser):
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
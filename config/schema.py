@@ -0,0 +1,129 @@
+"""
+OpenAPIスキーマを1回だけ生成し，メモリとディスクにキャッシュして配信する．
+キャッシュはコードのバージョン(settings.SCHEMA_CACHE["VERSION"]，未指定の場合はソースコードのハッシュ)毎に分ける．
+ビルド時に `python manage.py build_schema` で生成しておくと，最初のリクエストでも生成しない．
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import nullcontext
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Type
+
+import drf_spectacular
+import rest_framework
+from django.apps import apps
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+from drf_spectacular.settings import spectacular_settings
+from drf_spectacular.utils import extend_schema
+from drf_spectacular.views import SCHEMA_KWARGS, SpectacularAPIView
+from rest_framework.renderers import BaseRenderer
+
+RENDERERS: Dict[str, Type[BaseRenderer]] = {"yaml": OpenApiYamlRenderer, "json": OpenApiJsonRenderer}
+
+# (バージョン, 形式, 言語) -> (内容, ETag)
+_schemas: Dict[Tuple[str, str, str], Tuple[bytes, str]] = {}
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def code_version() -> str:
+    """
+    スキーマに影響するソースコード(プロジェクト内のアプリとconfig)とライブラリのバージョンのハッシュ
+    """
+    if settings.SCHEMA_CACHE["VERSION"]:
+        return settings.SCHEMA_CACHE["VERSION"]
+    base_dir = Path(settings.BASE_DIR)
+    directories = {Path(__file__).parent}
+    directories.update(
+        Path(config.path) for config in apps.get_app_configs() if Path(config.path).is_relative_to(base_dir)
+    )
+    digest = hashlib.sha256(f"{drf_spectacular.__version__}:{rest_framework.VERSION}".encode())
+    for path in sorted(path for directory in directories for path in directory.rglob("*.py")):
+        digest.update(str(path.relative_to(base_dir)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def schema_language(lang: Optional[str]) -> str:
+    """
+    クエリパラメーターのlangを，settings.LANGUAGESに含まれる場合のみ使う(それ以外は既定の言語)
+    """
+    if lang and settings.USE_I18N and lang in dict(settings.LANGUAGES):
+        return lang
+    return ""
+
+
+def generate_schema(fmt: str, lang: str = "") -> bytes:
+    generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+    with translation.override(lang) if lang else nullcontext():
+        schema = generator.get_schema(request=None, public=spectacular_settings.SERVE_PUBLIC)
+        renderer = RENDERERS[fmt]()
+        return renderer.render(schema, renderer_context={})
+
+
+def cache_path(version: str, fmt: str, lang: str) -> Path:
+    return Path(settings.SCHEMA_CACHE["DIR"]) / f"schema-{version}-{lang or 'default'}.{fmt}"
+
+
+def write_schema(path: Path, content: bytes) -> None:
+    # 他のプロセスが書き込み途中のファイルを読まないよう，一時ファイルに書いてから置き換える
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".schema-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def get_schema(fmt: str, lang: str = "", build: bool = False) -> Tuple[bytes, str]:
+    """
+    (内容, ETag)を返す．メモリ，ディスクの順に探し，どちらにもなければ生成して両方に保存する．
+    buildがTrueの場合はキャッシュを無視して生成する
+    """
+    key = (code_version(), fmt, lang)
+    cached = None if build else _schemas.get(key)
+    if cached is not None:
+        return cached
+    with _lock:
+        cached = None if build else _schemas.get(key)
+        if cached is None:
+            path = cache_path(*key)
+            if path.exists() and not build:
+                content = path.read_bytes()
+            else:
+                content = generate_schema(fmt, lang)
+                write_schema(path, content)
+            cached = _schemas[key] = (content, quote_etag(hashlib.sha256(content).hexdigest()[:32]))
+    return cached
+
+
+class CachedSpectacularAPIView(SpectacularAPIView):
+    """
+    キャッシュしたスキーマを返すSpectacularAPIView．If-None-Matchが一致する場合は304を返す
+    """
+
+    @extend_schema(**SCHEMA_KWARGS)
+    def get(self, request, *args, **kwargs):
+        renderer = request.accepted_renderer
+        lang = schema_language(request.GET.get("lang"))
+        content, etag = get_schema(renderer.format, lang)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        content_type = request.accepted_media_type
+        if renderer.charset:
+            content_type = f"{content_type}; charset={renderer.charset}"
+        res = HttpResponse(content, content_type=content_type)
+        res["ETag"] = etag
+        # 毎回ETagで確認させる(コードが更新されればETagが変わる)
+        res["Cache-Control"] = "no-cache"
+        res["Content-Disposition"] = f'inline; filename="{spectacular_settings.TITLE or "schema"}.{renderer.format}"'
+        return res
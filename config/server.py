@@ -0,0 +1,365 @@
+"""
+アプリケーションを1回だけ読み込んでからワーカープロセスをforkする，prefork型のサーバー(`python manage.py serve`)．
+ワーカーは読み込み済みのメモリ(Django・DRF・drf-spectacularのモジュール，URLconf，スキーマ)をcopy-on-writeで共有し，
+uvicornでWSGI / ASGIのアプリケーションを動かす．
+ワーカーはリクエスト数(max_requests)かメモリ使用量(max_memory_mb)の上限で入れ替え，
+SIGTERM / SIGINTでは処理中のリクエストを待ってから終了する．SIGHUPでは全てのワーカーを入れ替える．
+"""
+import gc
+import logging
+import os
+import random
+import select
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import time
+from importlib import import_module
+from typing import Callable, Dict, List, Optional
+
+import uvicorn
+from django.conf import settings
+from django.db import connections
+from django.utils import translation
+
+from account.flusher import stop_flushers
+from config.metrics import archive_snapshot, registry
+
+logger = logging.getLogger(__name__)
+
+INTERFACES = {"wsgi": "config.wsgi", "asgi": "config.asgi"}
+MEMORY_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+# ワーカーの起動完了の通知(pid)
+_READY = struct.Struct("=i")
+
+
+def process_memory(pid: int) -> Dict[str, int]:
+    """
+    /proc/<pid>/smaps_rollupのメモリ使用量(KB)．取得できない場合(Linux以外)は空の辞書を返す
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+    memory = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in MEMORY_FIELDS:
+            memory[name] = int(value.split()[0])
+    if memory:
+        memory["Uss"] = memory["Private_Clean"] + memory["Private_Dirty"]
+    return memory
+
+
+def load_application(interface: str):
+    """
+    アプリケーションと，通常は最初のリクエストで読み込まれるもの(URLconfとビュー，スキーマ，翻訳)を読み込む
+    """
+    from config.schema import RENDERERS, get_schema
+
+    application = import_module(INTERFACES[interface]).application
+    import_module(settings.ROOT_URLCONF)
+    for fmt in RENDERERS:
+        try:
+            get_schema(fmt)
+        except Exception:
+            logger.exception("Failed to preload the %s schema", fmt)
+    for code, _ in settings.LANGUAGES if settings.USE_I18N else []:
+        with translation.override(code):
+            translation.gettext("")
+    return application
+
+
+class _WorkerServer(uvicorn.Server):
+    """
+    起動完了をマスターに通知し，マスターが終了した場合は自身も終了するuvicornのサーバー
+    """
+
+    def __init__(self, config: uvicorn.Config, ready_fd: int) -> None:
+        super().__init__(config)
+        self.ready_fd = ready_fd
+        self.master_pid = os.getppid()
+
+    async def startup(self, sockets=None) -> None:
+        await super().startup(sockets=sockets)
+        os.write(self.ready_fd, _READY.pack(os.getpid()))
+
+    async def on_tick(self, counter: int) -> bool:
+        if os.getppid() != self.master_pid:
+            self.should_exit = True
+        return await super().on_tick(counter)
+
+
+class PreforkServer:
+    """
+    listenしたソケットとアプリケーションを用意してからworkers個のワーカーをforkし，
+    終了・入れ替えたワーカーを補充し続ける．on_readyは最初のワーカーが全て起動した時に呼び出す
+    """
+
+    def __init__(
+        self,
+        application,
+        interface: str = "wsgi",
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        workers: int = 1,
+        max_requests: int = 0,
+        max_requests_jitter: int = 0,
+        max_memory_mb: int = 0,
+        graceful_timeout: int = 30,
+        check_interval: float = 1.0,
+        access_log: bool = False,
+        metrics_dir: Optional[str] = None,
+        metrics_interval: float = 5.0,
+        on_ready: Optional[Callable[["PreforkServer"], None]] = None,
+    ) -> None:
+        if interface not in INTERFACES:
+            raise ValueError(f"Unknown interface: {interface}")
+        self.interface = interface
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_memory_mb = max_memory_mb
+        self.graceful_timeout = graceful_timeout
+        self.check_interval = check_interval
+        # ワーカーが計測値を書き出すディレクトリ(Noneの場合は一時ディレクトリを作成し，終了時に削除する)
+        self.metrics_dir = metrics_dir
+        self.metrics_interval = metrics_interval
+        self.on_ready = on_ready
+        self.config = uvicorn.Config(
+            application,
+            interface="asgi3" if interface == "asgi" else "wsgi",
+            lifespan="off",
+            access_log=access_log,
+            timeout_graceful_shutdown=graceful_timeout,
+        )
+        # pid -> forkした時刻 / 起動が完了するまでの秒数
+        self.spawned: Dict[int, float] = {}
+        self.boot_times: Dict[int, float] = {}
+        # 入れ替えのためにSIGTERMを送ったワーカー(pid -> SIGKILLを送る時刻)
+        self.retiring: Dict[int, float] = {}
+        self.recycled = 0
+        self._signals: List[int] = []
+        self._stopping = False
+        self._reported = False
+        self._listener: Optional[socket.socket] = None
+
+    def run(self) -> None:
+        self._listener = socket.create_server((self.host, self.port), backlog=2048)
+        self._ready_r, self._ready_w = os.pipe()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_w, False)
+        signal.set_wakeup_fd(self._wakeup_w)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, self._handle_signal)
+        metrics_dir = self._prepare_metrics_dir()
+
+        # forkの前に接続を閉じ，読み込み済みのオブジェクトを以降のGCの対象から外す
+        # (GCが参照カウントや世代の情報を書き換えると，共有していたページがワーカー毎にコピーされる)
+        connections.close_all()
+        gc.collect()
+        gc.freeze()
+        try:
+            self._spawn_workers()
+            while self.spawned:
+                self._wait()
+                self._handle_signals()
+                self._reap()
+                if not self._stopping:
+                    self._check_memory()
+                    self._spawn_workers()
+                self._kill_expired()
+        finally:
+            signal.set_wakeup_fd(-1)
+            for fd in (self._ready_r, self._ready_w, self._wakeup_r, self._wakeup_w):
+                os.close(fd)
+            self._listener.close()
+            registry.directory = None
+            if self.metrics_dir is None:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    def stop(self) -> None:
+        """
+        全てのワーカーにSIGTERMを送り，graceful_timeoutを過ぎても終了しないワーカーにはSIGKILLを送る
+        """
+        self._stopping = True
+        for pid in list(self.spawned):
+            self._retire(pid)
+
+    def reload(self) -> None:
+        """
+        全てのワーカーを入れ替える(新しいワーカーを起動し，古いワーカーは処理中のリクエストを終えてから終了する)
+        """
+        for pid in [pid for pid in self.spawned if pid not in self.retiring]:
+            self._retire(pid)
+
+    def memory_report(self) -> List[Dict]:
+        """
+        マスターと各ワーカーのメモリ使用量(MB)と起動時間(ミリ秒)
+        """
+        rows = []
+        for role, pid in [("master", os.getpid()), *(("worker", pid) for pid in self.spawned)]:
+            memory = process_memory(pid)
+            row: Dict = {"role": role, "pid": pid}
+            if pid in self.boot_times:
+                row["boot_ms"] = round(self.boot_times[pid] * 1000, 1)
+            for name in ("Rss", "Pss", "Uss"):
+                if name in memory:
+                    row[f"{name.lower()}_mb"] = round(memory[name] / 1024, 1)
+            if memory:
+                row["shared_mb"] = round((memory["Shared_Clean"] + memory["Shared_Dirty"]) / 1024, 1)
+            rows.append(row)
+        return rows
+
+    def _prepare_metrics_dir(self) -> str:
+        """
+        ワーカーの計測値を合算するディレクトリを用意する．forkの前に呼び出し，ワーカーのregistryに引き継がせる
+        """
+        if self.metrics_dir is None:
+            directory = tempfile.mkdtemp(prefix="metrics-")
+        else:
+            directory = self.metrics_dir
+            os.makedirs(directory, exist_ok=True)
+            # 前回の起動時の値は合算しない
+            for name in os.listdir(directory):
+                if name.endswith(".json"):
+                    os.remove(os.path.join(directory, name))
+        registry.directory = directory
+        return directory
+
+    def _handle_signal(self, signum, frame) -> None:
+        self._signals.append(signum)
+
+    def _handle_signals(self) -> None:
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT) and not self._stopping:
+                logger.info("Shutting down gracefully (timeout %ds)", self.graceful_timeout)
+                self.stop()
+            elif signum == signal.SIGHUP and not self._stopping:
+                logger.info("Recycling all workers")
+                self.reload()
+
+    def _wait(self) -> None:
+        readable, _, _ = select.select([self._ready_r, self._wakeup_r], [], [], self.check_interval)
+        if self._wakeup_r in readable:
+            os.read(self._wakeup_r, 1024)
+        if self._ready_r in readable:
+            data = os.read(self._ready_r, _READY.size * 64)
+            for (pid,) in _READY.iter_unpack(data):
+                if pid in self.spawned:
+                    self.boot_times[pid] = time.monotonic() - self.spawned[pid]
+            if not self._reported and all(pid in self.boot_times for pid in self.spawned):
+                self._reported = True
+                if self.on_ready is not None:
+                    self.on_ready(self)
+
+    def _spawn_workers(self) -> None:
+        while len(self.spawned) - len(self.retiring) < self.workers:
+            self._spawn_worker()
+
+    def _spawn_worker(self) -> None:
+        spawned_at = time.monotonic()
+        pid = os.fork()
+        if pid:
+            self.spawned[pid] = spawned_at
+            return
+        # ここからはワーカープロセス
+        code = 0
+        try:
+            self._run_worker()
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            code = 1
+        finally:
+            # マスターのループに戻らないようos._exit()で終了する(atexitは実行されない)
+            self._shutdown_worker()
+            os._exit(code)
+
+    def _run_worker(self) -> None:
+        # マスターのハンドラーを外す(SIGTERM / SIGINTはuvicornの起動後はuvicornが処理する)
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        for fd in (self._ready_r, self._wakeup_r, self._wakeup_w):
+            os.close(fd)
+        if self.max_requests:
+            self.config.limit_max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        assert self._listener is not None
+        registry.start_writer(self.metrics_interval)
+        _WorkerServer(self.config, self._ready_w).run(sockets=[self._listener])
+
+    def _shutdown_worker(self) -> None:
+        """
+        ワーカーの終了前に，集計・ログ(PeriodicFlusher)の残りをflushし，終了までの計測値をマスターが合算できるよう書き出す
+        """
+        try:
+            stop_flushers()
+            registry.write()
+        except Exception:
+            logger.exception("Worker %d failed to shut down cleanly", os.getpid())
+        finally:
+            logging.shutdown()
+
+    def _retire(self, pid: int) -> None:
+        if pid in self.retiring:
+            return
+        self.retiring[pid] = time.monotonic() + self.graceful_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid not in self.spawned:
+                continue
+            if registry.directory is not None:
+                archive_snapshot(registry.directory, pid)
+            ready = pid in self.boot_times
+            del self.spawned[pid]
+            self.boot_times.pop(pid, None)
+            if self.retiring.pop(pid, None) is None:
+                code = os.waitstatus_to_exitcode(status)
+                if code:
+                    logger.warning("Worker %d exited with %d", pid, code)
+                    if not ready:
+                        # 起動できないワーカーを起動し続けないよう停止する
+                        logger.error("Worker %d failed to boot, shutting down", pid)
+                        self.stop()
+                elif not self._stopping:
+                    # max_requestsに達して終了した
+                    self.recycled += 1
+
+    def _check_memory(self) -> None:
+        if not self.max_memory_mb:
+            return
+        # 起動中のワーカーはまだSIGTERMを処理できないため対象にしない
+        for pid in [pid for pid in self.boot_times if pid not in self.retiring]:
+            uss = process_memory(pid).get("Uss", 0) / 1024
+            if uss > self.max_memory_mb:
+                logger.info("Recycling worker %d (%.1fMB > %dMB)", pid, uss, self.max_memory_mb)
+                self.recycled += 1
+                self._retire(pid)
+
+    def _kill_expired(self) -> None:
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                logger.warning("Killing worker %d (graceful timeout)", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.retiring[pid] = float("inf")
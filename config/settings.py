@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from datetime import timedelta
 from pathlib import Path
+from typing import Any, Dict
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -44,16 +45,38 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "config.middleware.InstrumentationMiddleware",
+    "config.middleware.QueryBudgetMiddleware",
+    # 以降はURLの接頭辞毎にMIDDLEWARE_PROFILESから選ぶ
+    "config.middleware.MiddlewareProfiles",
+]
+# JWT(CustomAuthentication)で認証するAPIではセッション・メッセージ・AuthenticationMiddlewareを使わない．
+# CsrfViewMiddlewareはログイン時にcsrftokenのCookieを設定するために残す
+API_MIDDLEWARE = [
     "config.middleware.SameSiteMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django.contrib.messages.middleware.MessageMiddleware",
-    "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
 ]
+MIDDLEWARE_PROFILES = {
+    "/api/v1/": API_MIDDLEWARE,
+    "/metrics": API_MIDDLEWARE,
+    # admin・スキーマのドキュメントなど
+    "default": [
+        "config.middleware.SameSiteMiddleware",
+        "django.middleware.security.SecurityMiddleware",
+        "django.contrib.sessions.middleware.SessionMiddleware",
+        "django.middleware.common.CommonMiddleware",
+        "django.middleware.csrf.CsrfViewMiddleware",
+        "django.contrib.auth.middleware.AuthenticationMiddleware",
+        "django.contrib.messages.middleware.MessageMiddleware",
+        "django.middleware.clickjacking.XFrameOptionsMiddleware",
+        "corsheaders.middleware.CorsMiddleware",
+    ],
+}
+# adminが必要とするミドルウェアはMIDDLEWARE_PROFILESの"default"で実行するため，MIDDLEWAREの検査を無効にする
+SILENCED_SYSTEM_CHECKS = ["admin.E408", "admin.E409", "admin.E410"]
 
 ROOT_URLCONF = "config.urls"
 
@@ -79,7 +102,7 @@ WSGI_APPLICATION = "config.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
+DATABASES: Dict[str, Dict[str, Any]] = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
         "NAME": os.environ.get("POSTGRES_DB"),
@@ -87,8 +110,35 @@ DATABASES = {
         "PASSWORD": os.environ.get("POSTGRES_PASSWORD"),
         "HOST": "postgres_db",
         "PORT": 5432,
+        # 接続をリクエスト間で再利用し，再利用前に死活確認を行う
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", 60)),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
+# 読み取り用のレプリカ(カンマ区切りのホスト名)．ホスト以外の接続情報はプライマリと同じ
+for index, host in enumerate(host for host in os.environ.get("POSTGRES_REPLICA_HOSTS", "").split(",") if host):
+    DATABASES[f"replica{index + 1}"] = {**DATABASES["default"], "HOST": host, "TEST": {"MIRROR": "default"}}
+
+# read_replica()の中の読み取りをレプリカに送る(config/dbrouter.py)
+DATABASE_ROUTERS = ["config.dbrouter.PrimaryReplicaRouter"]
+# STICKY_SECONDS: ユーザーを保存してからこの秒数の間はそのユーザーの読み取りもプライマリに送る
+# CACHE: 複数のプロセスで保存したユーザーを共有する場合のキャッシュのエイリアス
+READ_REPLICA = {
+    "REPLICAS": [alias for alias in DATABASES if alias != "default"],
+    "STICKY_SECONDS": int(os.environ.get("READ_REPLICA_STICKY_SECONDS", 5)),
+    "CACHE": os.environ.get("READ_REPLICA_CACHE") or None,
+}
+
+
+# キャッシュ．REDIS_URLを指定した場合はRedis(全てのワーカーで共有)，未指定の場合はプロセス内のキャッシュ(LocMemCache)．
+# manage.py serveで複数のワーカーを動かす場合は，トークンの失効・アカウントのバージョンなどを共有するためRedisを指定する
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["REDIS_URL"],
+        }
+    }
 
 
 # Password validation
@@ -111,6 +161,13 @@ AUTH_PASSWORD_VALIDATORS = [
 
 AUTH_USER_MODEL = "account.Account"
 
+# パスワードハッシュ計算用のワーカープール("thread" / "process" / "inline")
+PASSWORD_HASHING_POOL = {
+    "BACKEND": os.environ.get("PASSWORD_HASHING_BACKEND", "thread"),
+    "WORKERS": int(os.environ.get("PASSWORD_HASHING_WORKERS", os.cpu_count() or 1)),
+    "MAX_QUEUE": int(os.environ.get("PASSWORD_HASHING_MAX_QUEUE", 64)),
+}
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=5),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=30 * 6),
@@ -121,6 +178,30 @@ SIMPLE_JWT = {
     "SIGNING_KEY": SECRET_KEY,
     "VERIFYING_KEY": None,
     "AUTH_HEADER_TYPES": ("JWT",),
+    # リフレッシュ毎に新しいリフレッシュトークンを発行し，古いトークンを失効させる(account/tokens.py)
+    "ROTATE_REFRESH_TOKENS": True,
+    "BLACKLIST_AFTER_ROTATION": True,
+    "TOKEN_REFRESH_SERIALIZER": "account.tokens.RevocableTokenRefreshSerializer",
+}
+# 失効させたトークンの同期に使うキャッシュと同期間隔(秒)(account/revocation.py)
+# 複数のプロセスで動かす場合はプロセス間で共有するキャッシュ(Redis等)を指定する(SERVER["WORKERS"]が2以上でプロセス内のキャッシュの場合は警告する)
+# SNAPSHOT_EVERY: 失効がこの件数増える毎に，新しいプロセスが読み込むスナップショットを保存し直す
+TOKEN_REVOCATION = {
+    "CACHE": os.environ.get("TOKEN_REVOCATION_CACHE", "default"),
+    "SYNC_INTERVAL": int(os.environ.get("TOKEN_REVOCATION_SYNC_INTERVAL", 5)),
+    "SNAPSHOT_EVERY": 1000,
+}
+# get/のETagに使うアカウントのバージョンのキャッシュと保持期間(秒)(account/versions.py)
+# 複数のプロセスで動かす場合はプロセス間で共有するキャッシュ(Redis等)を指定する(SERVER["WORKERS"]が2以上でプロセス内のキャッシュの場合はエラー)
+ACCOUNT_VERSIONS = {
+    "CACHE": os.environ.get("ACCOUNT_VERSION_CACHE", "default"),
+    "TIMEOUT": 60 * 60,
+}
+# 検証済みアクセストークンをプロセス内に保持する件数(SIZE，0で無効)と，
+# ユーザーの保存・削除を他のプロセスに伝える世代のキャッシュ(CACHE，複数のワーカーで動かす場合は共有するキャッシュ)
+AUTH_TOKEN_CACHE = {
+    "SIZE": int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", 10000)),
+    "CACHE": os.environ.get("AUTH_TOKEN_CACHE_CACHE", "default"),
 }
 SESSION_COOKIE_SAMESITE = "None"
 # CORS(クロスドメインリクエスト)でCookieを送信することを許可
@@ -130,8 +211,122 @@ CORS_ORIGIN_WHITELIST = [
     "http://127.0.0.1:3000",
     "http://localhost:3000",
 ]
+# オンライン状態の管理(account/presence.py)
+# TTL秒以内にハートビートがあればオンライン．FLUSH_INTERVAL秒毎にOnlineUserへまとめて書き込み，
+# オンラインの人数と一覧はOnlineUserから求める(他プロセスのハートビートはFLUSH_INTERVAL秒以内に反映される)
+# 人数はフラッシュ毎に数えた値をFLUSH_INTERVAL秒間使う
+# CACHEにキャッシュのエイリアスを指定すると他プロセスとハートビート・人数を共有する
+PRESENCE = {
+    "TTL": int(os.environ.get("PRESENCE_TTL", 60)),
+    "SHARDS": 16,
+    "FLUSH_INTERVAL": int(os.environ.get("PRESENCE_FLUSH_INTERVAL", 10)),
+    "BATCH_SIZE": 1000,
+    "CACHE": os.environ.get("PRESENCE_CACHE") or None,
+}
+# ログイン・登録の試行回数の制限(account/ratelimit.py)
+# RATES: {スコープ: {キーの種類(ip / email): "回数/期間(s/m/h/d)"}}．上限を超えると429とRetry-Afterを返す
+# CACHEにキャッシュのエイリアスを指定すると他プロセスと回数を共有する(固定ウィンドウ)
+# MAX_KEYS: プロセス内で保持するバケットの上限(超えた場合は更新の古いものから削除する)
+# IPアドレスはREMOTE_ADDR．プロキシの後ろで動かす場合はREST_FRAMEWORKのNUM_PROXIES(環境変数NUM_PROXIES)を設定する
+RATE_LIMIT = {
+    "ENABLED": os.environ.get("RATE_LIMIT_ENABLED", "True") == "True",
+    "RATES": {
+        "login": {"ip": "30/min", "email": "10/min"},
+        "register": {"ip": "10/min", "email": "5/min"},
+    },
+    "SHARDS": 16,
+    "CACHE": os.environ.get("RATE_LIMIT_CACHE") or None,
+    "SWEEP_INTERVAL": 60,
+    "MAX_KEYS": 100000,
+}
+# ユーザー検索(account/search.py)
+# LIMIT / MAX_LIMIT: 既定・最大の件数．MIN_FUZZY_LENGTH文字以上の場合は前方一致の結果をあいまい検索で補う
+# FUZZY_THRESHOLD: SQLiteでのあいまい検索の類似度のしきい値(PostgreSQLではpg_trgm.similarity_threshold)
+# CACHE_SIZE / CACHE_TTL: 前方一致の結果をプロセス内に保持する接頭辞の数と秒数
+ACCOUNT_SEARCH = {
+    "LIMIT": 10,
+    "MAX_LIMIT": 50,
+    "MIN_FUZZY_LENGTH": 3,
+    "FUZZY_THRESHOLD": 0.3,
+    "CACHE_SIZE": int(os.environ.get("ACCOUNT_SEARCH_CACHE_SIZE", 10000)),
+    "CACHE_TTL": 30,
+}
+# ログイン日時(last_login / login_date)をまとめて書き込む間隔(秒)と件数(account/activity.py)
+LOGIN_ACTIVITY_BUFFER = {
+    "FLUSH_INTERVAL": int(os.environ.get("LOGIN_ACTIVITY_FLUSH_INTERVAL", 30)),
+    "MAX_ENTRIES": 1000,
+}
+# 非同期版のビュー(account/async_views.py)を使うルート．ASGIで動かす場合に指定する
+# 例: ACCOUNT_ASYNC_ROUTES="login/,refresh/,logout/,get/,status/,register/"
+ACCOUNT_ASYNC_ROUTES = [route for route in os.environ.get("ACCOUNT_ASYNC_ROUTES", "").split(",") if route]
+# ビュー毎のクエリ数の上限とN+1の検出(config/querybudget.py)
+# MODE: "log"(警告を出力) / "raise"(QueryBudgetExceededを送出．テスト用) / "off"
+# N_PLUS_ONE_THRESHOLD: 1リクエストの中で同じ形のSQLをこの回数以上実行した場合にN+1として報告する
+QUERY_BUDGET = {
+    "MODE": os.environ.get("QUERY_BUDGET_MODE", "log" if DEBUG else "off"),
+    "N_PLUS_ONE_THRESHOLD": 3,
+}
+# /metrics(Prometheus形式)を取得する際のBearerトークン．
+# 未設定の場合は/metricsを公開しない(METRICS_ALLOW_ANONYMOUS=Trueの場合のみ認証なしで公開する)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") or None
+METRICS_ALLOW_ANONYMOUS = os.environ.get("METRICS_ALLOW_ANONYMOUS", "False") == "True"
+# 処理時間の長いリクエストのスタックをサンプリングする(/metrics/slow-requests/でfolded形式で取得)
+PROFILE_SLOW_REQUESTS = {
+    "ENABLED": os.environ.get("PROFILE_SLOW_REQUESTS", "False") == "True",
+    "INTERVAL": 0.005,
+    "KEEP": 10,
+}
+# アカウントの変更イベントのアウトボックス(account/outbox.py)．relay_outboxがSINKSの配信先に配信する
+# GAP_TIMEOUT_SECONDS: 配信済みの位置より前で欠けているid(PostgreSQLでコミットが遅れたイベント)を待つ時間．
+#   これを過ぎても現れないidはロールバックされたものとみなす
+# RETENTION_HOURS: 全ての配信先に配信済みで，これより古いイベントを削除する(0は削除しない)
+OUTBOX_SINKS: Dict[str, Any] = {}
+if os.environ.get("OUTBOX_FILE"):
+    OUTBOX_SINKS["file"] = {"BACKEND": "account.outbox.FileSink", "OPTIONS": {"path": os.environ["OUTBOX_FILE"]}}
+if os.environ.get("OUTBOX_HTTP_URL"):
+    OUTBOX_SINKS["http"] = {"BACKEND": "account.outbox.HTTPSink", "OPTIONS": {"url": os.environ["OUTBOX_HTTP_URL"]}}
+OUTBOX = {
+    "SINKS": OUTBOX_SINKS,
+    "BATCH_SIZE": int(os.environ.get("OUTBOX_BATCH_SIZE", 100)),
+    "GAP_TIMEOUT_SECONDS": float(os.environ.get("OUTBOX_GAP_TIMEOUT_SECONDS", 300)),
+    "POLL_INTERVAL": float(os.environ.get("OUTBOX_POLL_INTERVAL", 1)),
+    "RETRY_MAX_SECONDS": 60,
+    "RETENTION_HOURS": int(os.environ.get("OUTBOX_RETENTION_HOURS", 24 * 7)),
+}
+# python manage.py serve(config/server.py)の既定値
+# MAX_REQUESTS: ワーカーを入れ替えるまでのリクエスト数(0は無制限)．全ワーカーが同時に入れ替わらないよう0〜JITTERを加える
+# MAX_MEMORY_MB: ワーカー固有のメモリ(USS)がこれを超えたら入れ替える(0は無制限)
+SERVER = {
+    "INTERFACE": os.environ.get("SERVER_INTERFACE", "wsgi"),
+    # 既定はREDIS_URLを指定した場合はCPU数，未指定の場合はプロセス間で共有するキャッシュがないため1
+    "WORKERS": int(os.environ.get("SERVER_WORKERS", (os.cpu_count() or 1) if os.environ.get("REDIS_URL") else 1)),
+    "MAX_REQUESTS": int(os.environ.get("SERVER_MAX_REQUESTS", 10000)),
+    "MAX_REQUESTS_JITTER": int(os.environ.get("SERVER_MAX_REQUESTS_JITTER", 1000)),
+    "MAX_MEMORY_MB": int(os.environ.get("SERVER_MAX_MEMORY_MB", 0)),
+    "GRACEFUL_TIMEOUT": int(os.environ.get("SERVER_GRACEFUL_TIMEOUT", 30)),
+    # ワーカーの計測値を書き出して/metricsで合算するディレクトリ(未設定の場合は一時ディレクトリ)
+    "METRICS_DIR": os.environ.get("SERVER_METRICS_DIR") or None,
+}
 REST_FRAMEWORK = {
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
+    "DEFAULT_AUTHENTICATION_CLASSES": ["config.authenticate.CustomAuthentication"],
+    # JSONの変換にorjsonを使う(config/renderers.py)
+    "DEFAULT_RENDERER_CLASSES": [
+        "config.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "config.renderers.ORJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
+    # X-Forwarded-Forを追加するプロキシの数．0の場合はX-Forwarded-Forを使わずREMOTE_ADDRをクライアントのIPアドレスとする
+    "NUM_PROXIES": int(os.environ.get("NUM_PROXIES", 0)),
+}
+# api/schema/のキャッシュ(config/schema.py)．VERSIONを指定しない場合はソースコードのハッシュを使う
+SCHEMA_CACHE = {
+    "DIR": os.environ.get("SCHEMA_CACHE_DIR", str(BASE_DIR / ".schema-cache")),
+    "VERSION": os.environ.get("CODE_VERSION") or None,
 }
 SPECTACULAR_SETTINGS = {
     "TITLE": "API一覧",
@@ -157,6 +352,18 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+# アップロードできる画像の最大サイズ(バイト)
+IMAGE_UPLOAD_MAX_SIZE = int(os.environ.get("IMAGE_UPLOAD_MAX_SIZE", 5 * 1024 * 1024))
+# アップロード後に作成する縮小版の画像(account/images.py)
+IMAGE_VARIANT_SIZES = [48, 128, 256]
+IMAGE_VARIANT_FORMAT = "WEBP"
+IMAGE_VARIANT_QUALITY = 80
+IMAGE_VARIANT_WORKERS = int(os.environ.get("IMAGE_VARIANT_WORKERS", 2))
+# 待機できる作成の依頼の数(超えた依頼は捨てる)と，作成に失敗した画像を再試行するまでの秒数
+IMAGE_VARIANT_MAX_QUEUE = int(os.environ.get("IMAGE_VARIANT_MAX_QUEUE", 100))
+IMAGE_VARIANT_RETRY_AFTER = 60 * 60
+IMAGE_VARIANT_MAX_AGE = 60 * 60 * 24 * 365
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
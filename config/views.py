@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+
+from .metrics import registry, slow_requests
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def authorize(request):
+    """
+    settings.METRICS_TOKENが設定されている場合はAuthorization: Bearer <トークン>を要求する．
+    未設定の場合はMETRICS_ALLOW_ANONYMOUSでなければ拒否する．許可しない場合はエラーのレスポンスを返す
+    """
+    if settings.METRICS_TOKEN is None:
+        if settings.METRICS_ALLOW_ANONYMOUS:
+            return None
+        return HttpResponse("Set METRICS_TOKEN to enable metrics\n", status=403, content_type="text/plain")
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    if constant_time_compare(header, f"Bearer {settings.METRICS_TOKEN}"):
+        return None
+    return HttpResponse(status=401)
+
+
+@require_GET
+def metrics(request):
+    denied = authorize(request)
+    if denied is not None:
+        return denied
+    return HttpResponse(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@require_GET
+def slow_request_stacks(request):
+    """
+    処理時間の長いリクエストのスタック(folded形式)．flamegraph.plなどでflame graphにできる
+    """
+    denied = authorize(request)
+    if denied is not None:
+        return denied
+    if not slow_requests.enabled:
+        return HttpResponse("PROFILE_SLOW_REQUESTS is disabled\n", status=404, content_type="text/plain")
+    return HttpResponse(slow_requests.folded(), content_type="text/plain; charset=utf-8")